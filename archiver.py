@@ -2,46 +2,147 @@ import os
 import json
 import zipfile
 import tarfile
+import shutil
 from pathlib import Path
-from typing import Dict, Any
+from typing import Callable, Dict, Any, Optional
 import logging
 
+from discovery import DISCOVERY_MANIFEST_FILENAME
+from distributed import WORK_QUEUE_FILENAME
+from ledger import LEDGER_FILENAME
+from result_sink import RESULTS_DIRNAME, SINK_FILES, ShardedResultSink
+from streaming_archive import CODEC_AUTO, CODEC_EXTENSIONS, StreamingArchive, resolve_codec
+
 logger = logging.getLogger(__name__)
 
 class Archiver:
-    def __init__(self, output_dir: str, archive_format: str = "none"):
+    def __init__(
+        self,
+        output_dir: str,
+        archive_format: str = "none",
+        result_sink: str = SINK_FILES,
+        shard_max_mb: int = 128,
+        archive_codec: str = CODEC_AUTO
+    ):
         self.output_dir = Path(output_dir)
         self.archive_format = archive_format
+        # "stream" appends each result to a compressed tar as it is saved
+        self.streaming_archive = None
+        if archive_format == "stream":
+            codec = resolve_codec(archive_codec)
+            self.streaming_archive = StreamingArchive(self.output_dir / f"results.{CODEC_EXTENSIONS[codec]}", codec)
+        # With a sharded sink, per-image results go to results/*.jsonl|parquet instead of small files
+        self.result_sink = None
+        if result_sink != SINK_FILES:
+            self.result_sink = ShardedResultSink(output_dir, result_sink, shard_max_mb * 1024 * 1024)
         self.success_dir = self.output_dir / "successful"
         self.failed_dir = self.output_dir / "failed"
         self.metadata_dir = self.output_dir / "metadata"
         
         # Create directories
-        self.success_dir.mkdir(parents=True, exist_ok=True)
-        self.failed_dir.mkdir(parents=True, exist_ok=True)
+        if self.result_sink is None:
+            self.success_dir.mkdir(parents=True, exist_ok=True)
+            self.failed_dir.mkdir(parents=True, exist_ok=True)
         self.metadata_dir.mkdir(parents=True, exist_ok=True)
     
-    def save_successful_result(self, image_name: str, result: str, metadata: Dict[str, Any] = None):
-        """Save successful processing result."""
+    def save_successful_result(
+        self,
+        image_name: str,
+        result: str,
+        metadata: Dict[str, Any] = None,
+        on_saved: Optional[Callable[[], Any]] = None
+    ):
+        """Save successful processing result; ``on_saved`` runs once it is on disk."""
+        if self.result_sink:
+            self.result_sink.write({"image": image_name, "status": "successful", "response": result, **(metadata or {})}, on_saved)
+            return
+        
         result_file = self.success_dir / f"{image_name}_result.txt"
         with open(result_file, 'w', encoding='utf-8') as f:
             f.write(result)
+        self._stream(result_file, result)
         
         if metadata:
             metadata_file = self.success_dir / f"{image_name}_metadata.json"
             with open(metadata_file, 'w', encoding='utf-8') as f:
                 json.dump(metadata, f, indent=2)
+            self._stream(metadata_file, json.dumps(metadata, indent=2))
+        if on_saved:
+            on_saved()
     
-    def save_failed_result(self, image_name: str, error_message: str, metadata: Dict[str, Any] = None):
-        """Save failed processing result."""
+    def save_failed_result(
+        self,
+        image_name: str,
+        error_message: str,
+        metadata: Dict[str, Any] = None,
+        on_saved: Optional[Callable[[], Any]] = None
+    ):
+        """Save failed processing result; ``on_saved`` runs once it is on disk."""
+        if self.result_sink:
+            self.result_sink.write({"image": image_name, "status": "failed", "error": error_message, **(metadata or {})}, on_saved)
+            return
+        
         error_file = self.failed_dir / f"{image_name}_error.log"
         with open(error_file, 'w', encoding='utf-8') as f:
             f.write(error_message)
+        self._stream(error_file, error_message)
         
         if metadata:
             metadata_file = self.failed_dir / f"{image_name}_metadata.json"
             with open(metadata_file, 'w', encoding='utf-8') as f:
                 json.dump(metadata, f, indent=2)
+            self._stream(metadata_file, json.dumps(metadata, indent=2))
+        if on_saved:
+            on_saved()
+    
+    def _stream(self, file_path: Path, content: str):
+        """Append a just-written file to the streaming archive, if enabled."""
+        if self.streaming_archive:
+            arcname = file_path.relative_to(self.output_dir).as_posix()
+            self.streaming_archive.add(arcname, content.encode('utf-8'))
+    
+    def save_duplicate_groups(self, groups: Dict[str, Any]):
+        """Save near-duplicate group membership."""
+        groups_file = self.metadata_dir / "duplicate_groups.json"
+        with open(groups_file, 'w', encoding='utf-8') as f:
+            json.dump(groups, f, indent=2)
+    
+    def merge_worker_outputs(self, worker_dirs: Dict[str, Path]):
+        """Move the results of distributed workers into this output layout."""
+        for worker_id, worker_dir in worker_dirs.items():
+            for name, target in (("successful", self.success_dir), ("failed", self.failed_dir)):
+                source = worker_dir / name
+                if not source.is_dir():
+                    continue
+                target.mkdir(parents=True, exist_ok=True)
+                for file_path in sorted(source.iterdir()):
+                    destination = target / file_path.name
+                    os.replace(file_path, destination)
+                    if self.streaming_archive:
+                        self.streaming_archive.add_file(destination, destination.relative_to(self.output_dir).as_posix())
+            
+            # Shard numbers restart in every worker, so prefix them with the worker id
+            shards = worker_dir / RESULTS_DIRNAME
+            if shards.is_dir():
+                merged_shards = self.output_dir / RESULTS_DIRNAME
+                merged_shards.mkdir(parents=True, exist_ok=True)
+                for shard in sorted(shards.iterdir()):
+                    os.replace(shard, merged_shards / f"{worker_id}-{shard.name}")
+        
+        # Timings are moved too, so a later merge into the same directory doesn't repeat them
+        with open(self.metadata_dir / "image_timings.jsonl", 'ab') as merged:
+            for worker_dir in worker_dirs.values():
+                worker_timings = worker_dir / "metadata" / "image_timings.jsonl"
+                if worker_timings.exists():
+                    with open(worker_timings, 'rb') as f:
+                        shutil.copyfileobj(f, merged)
+                    worker_timings.unlink()
+        logger.info(f"Merged results of {len(worker_dirs)} workers into {self.output_dir}")
+    
+    def close(self):
+        """Flush queued result records and finish the current shard."""
+        if self.result_sink:
+            self.result_sink.close()
     
     def save_processing_stats(self, stats: Dict[str, Any]):
         """Save overall processing statistics."""
@@ -59,15 +160,22 @@ class Archiver:
         """Create compressed archive of results."""
         if self.archive_format == "none":
             return
+        if self.streaming_archive:
+            self._finish_streaming_archive()
+            return
         
         archive_name = f"results.{self.archive_format}"
         archive_path = self.output_dir / archive_name
+        # Don't include the archive itself or the live ledger and discovery databases
+        excluded = {archive_name}
+        for database in (LEDGER_FILENAME, DISCOVERY_MANIFEST_FILENAME, WORK_QUEUE_FILENAME):
+            excluded.update({database, f"{database}-wal", f"{database}-shm"})
         
         if self.archive_format == "zip":
             with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
                 for root, dirs, files in os.walk(self.output_dir):
                     for file in files:
-                        if file != archive_name:  # Don't include the archive itself
+                        if file not in excluded:
                             file_path = os.path.join(root, file)
                             arcname = os.path.relpath(file_path, self.output_dir)
                             zipf.write(file_path, arcname)
@@ -75,9 +183,26 @@ class Archiver:
             with tarfile.open(archive_path, 'w:gz') as tar:
                 for root, dirs, files in os.walk(self.output_dir):
                     for file in files:
-                        if file != archive_name:
+                        if file not in excluded:
                             file_path = os.path.join(root, file)
                             arcname = os.path.relpath(file_path, self.output_dir)
                             tar.add(file_path, arcname)
         
-        logger.info(f"Archive created: {archive_path}")
\ No newline at end of file
+        logger.info(f"Archive created: {archive_path}")
+    
+    def _finish_streaming_archive(self):
+        """Add the files that only exist at the end of a run, then close the streamed archive."""
+        # The archive is rewritten on every run, so results kept from earlier (resumed) runs go in too
+        for directory in (self.success_dir, self.failed_dir):
+            if directory.exists():
+                for file_path in sorted(directory.iterdir()):
+                    arcname = file_path.relative_to(self.output_dir).as_posix()
+                    if file_path.is_file() and arcname not in self.streaming_archive.queued_names:
+                        self.streaming_archive.add_file(file_path, arcname)
+        for directory in (self.metadata_dir, self.output_dir / RESULTS_DIRNAME):
+            if directory.exists():
+                for file_path in sorted(directory.rglob("*")):
+                    if file_path.is_file():
+                        self.streaming_archive.add_file(file_path, file_path.relative_to(self.output_dir).as_posix())
+        archive_path = self.streaming_archive.close()
+        logger.info(f"Archive created: {archive_path} (manifest: {self.streaming_archive.manifest_path.name})")
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Offline throughput/latency benchmark for GeminiBatchProcessor.
+
+Usage:
+    python benchmark.py --sizes 1000 10000 100000 --concurrency 50 --latency-mean 0.2 --output bench.json
+
+Each batch size runs in a fresh process against the local mock server (or the
+in-process mock model with ``--transport sdk``), so peak RSS is measured per
+run. Results are printed and optionally written as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import math
+import os
+import queue
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows has no getrusage
+    resource = None
+
+from mock_server import add_behavior_arguments, behavior_from_args
+
+logger = logging.getLogger(__name__)
+
+# Targets from PROJECT_PROPOSAL.md
+TARGET_IMAGES_PER_MINUTE = 10
+TARGET_PEAK_RSS_MB = 2048
+
+def generate_synthetic_images(image_dir: Path, count: int, seed: int = 0):
+    """Write ``count`` small, distinct JPEGs, reusing a previous set of the same size."""
+    from PIL import Image
+
+    marker = image_dir / ".complete"
+    if marker.exists() and marker.read_text() == str(count):
+        return
+    shutil.rmtree(image_dir, ignore_errors=True)
+    image_dir.mkdir(parents=True)
+
+    rng = random.Random(seed)
+    for i in range(count):
+        # Spread files over subdirectories like a real dataset
+        subdir = image_dir / f"{i // 1000:04d}"
+        subdir.mkdir(exist_ok=True)
+        img = Image.new("RGB", (64, 48), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        img.putpixel((i % 64, (i // 64) % 48), (255 - img.getpixel((0, 0))[0], 0, 0))
+        img.save(subdir / f"img_{i:06d}.jpg", quality=85)
+    marker.write_text(str(count))
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct * len(sorted_values) / 100.0) - 1))
+    return sorted_values[rank]
+
+def wait_for_result(child, result_queue, poll_interval: float = 1.0) -> Dict[str, Any]:
+    """Wait for a batch child's report, failing instead of hanging if it dies without one."""
+    while True:
+        try:
+            return result_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            pass
+        if not child.is_alive():
+            # The report may have arrived just before the child exited
+            try:
+                return result_queue.get(timeout=poll_interval)
+            except queue.Empty:
+                raise RuntimeError(f"Benchmark process exited with code {child.exitcode} without reporting results")
+
+def _peak_rss_mb(who) -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _run_batch(options: Dict[str, Any], result_queue):
+    """Run one batch size in a child process and report its measurements."""
+    from config import Config
+    from main import iter_image_files
+    from mock_model import MockGenerativeModel
+    from processor import GeminiBatchProcessor
+    from transport import SdkTransport
+
+    logging.getLogger().setLevel(logging.WARNING)
+    output_dir = options["output_dir"]
+    config = Config(
+        gemini_api_key="benchmark",
+        output_dir=output_dir,
+        max_concurrent_requests=options["concurrency"],
+        max_retries=options["max_retries"]
+    )
+    if options["transport"] == "rest":
+        config.transport = "rest"
+        config.api_base_url = options["server_url"]
+        config.http_connection_limit = max(options["concurrency"], 1)
+    else:
+        config.model_backend = "mock"
+
+    async def run() -> Dict[str, Any]:
+        processor = GeminiBatchProcessor(config)
+        if options["transport"] != "rest":
+            processor.model = MockGenerativeModel(processor.model_name, behavior_from_args(options["behavior"]))
+            processor.transport = SdkTransport(processor.model)
+        started = time.perf_counter()
+        try:
+            stats = await processor.process_image_batch(iter_image_files(options["image_dir"]), options["prompt"])
+        finally:
+            await processor.close()
+        return {"elapsed": time.perf_counter() - started, "stats": stats}
+
+    outcome = asyncio.run(run())
+
+    # Per-image latency and attempt counts come from the run's ledger
+    conn = sqlite3.connect(str(Path(output_dir) / "ledger.sqlite"))
+    rows = conn.execute("SELECT latency, attempts FROM images WHERE latency IS NOT NULL").fetchall()
+    conn.close()
+    latencies = sorted(row[0] for row in rows)
+    attempts = sum(row[1] for row in rows)
+
+    stats = outcome["stats"]
+    elapsed = outcome["elapsed"]
+    result_queue.put({
+        "images": stats["total_images"],
+        "successful": stats["successful"],
+        "failed": stats["failed"],
+        "elapsed_seconds": round(elapsed, 3),
+        "images_per_second": round(stats["total_images"] / elapsed, 2) if elapsed > 0 else 0,
+        "images_per_minute": round(stats["total_images"] * 60 / elapsed, 1) if elapsed > 0 else 0,
+        "latency_seconds": {
+            "p50": round(percentile(latencies, 50), 4),
+            "p95": round(percentile(latencies, 95), 4),
+            "p99": round(percentile(latencies, 99), 4),
+            "max": round(latencies[-1], 4) if latencies else 0.0
+        },
+        "retries": attempts - len(rows),
+        "peak_rss_mb": round(_peak_rss_mb(resource.RUSAGE_SELF) if resource else 0.0, 1),
+        "peak_rss_children_mb": round(_peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else 0.0, 1)
+    })
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server_process(args) -> Tuple[subprocess.Popen, str]:
+    """Launch mock_server.py in its own process so it doesn't skew the client's measurements."""
+    port = _free_port()
+    command = [
+        sys.executable, str(Path(__file__).with_name("mock_server.py")),
+        "--port", str(port),
+        "--latency-distribution", args.latency_distribution,
+        "--latency-mean", str(args.latency_mean),
+        "--latency-spread", str(args.latency_spread),
+        "--rate-limit-rate", str(args.rate_limit_rate),
+        "--retry-after", str(args.retry_after),
+        "--error-rate", str(args.error_rate),
+        "--error-mix", args.error_mix,
+    ]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"{url}/stats", timeout=1).read()
+            return server, url
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Mock server did not start")
+
+def check_targets(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Compare runs against the proposal's throughput and memory targets."""
+    min_throughput = min((run["images_per_minute"] for run in runs), default=0)
+    max_rss = round(max((run["peak_rss_mb"] + run["peak_rss_children_mb"] for run in runs), default=0), 1)
+    return {
+        "images_per_minute": {
+            "target": TARGET_IMAGES_PER_MINUTE,
+            "worst": min_throughput,
+            "passed": min_throughput >= TARGET_IMAGES_PER_MINUTE
+        },
+        "peak_rss_mb": {
+            "target": TARGET_PEAK_RSS_MB,
+            "worst": max_rss,
+            "passed": max_rss <= TARGET_PEAK_RSS_MB
+        }
+    }
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Gemini Batch Processor benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Batch sizes to run')
+    parser.add_argument('--concurrency', type=int, default=50, help='Value passed as --max-concurrent')
+    parser.add_argument('--max-retries', type=int, default=5, help='Maximum retry attempts per image')
+    parser.add_argument('--transport', choices=['rest', 'sdk'], default='rest',
+                        help='rest: HTTP mock server in a separate process; sdk: in-process mock model')
+    parser.add_argument('--prompt', default='Describe this image in one sentence.', help='Prompt sent with every image')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'gemini-bench-data'),
+                        help='Where synthetic image sets are generated and reused')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    parser.add_argument('--check-targets', action='store_true', help='Exit non-zero if a proposal target is missed')
+    add_behavior_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    server, server_url = (None, None)
+    if args.transport == "rest":
+        server, server_url = start_server_process(args)
+        logger.info(f"Mock server running at {server_url}")
+
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    try:
+        for size in args.sizes:
+            image_dir = Path(args.data_dir) / f"{size}"
+            logger.info(f"Preparing {size} synthetic images in {image_dir}")
+            generate_synthetic_images(image_dir, size, seed=args.seed or 0)
+
+            output_dir = tempfile.mkdtemp(prefix=f"gemini-bench-{size}-")
+            options = {
+                "image_dir": str(image_dir),
+                "output_dir": output_dir,
+                "concurrency": args.concurrency,
+                "max_retries": args.max_retries,
+                "transport": args.transport,
+                "server_url": server_url,
+                "prompt": args.prompt,
+                "behavior": argparse.Namespace(**{
+                    key: getattr(args, key) for key in (
+                        "latency_distribution", "latency_mean", "latency_spread", "rate_limit_rate",
+                        "retry_after", "error_rate", "error_mix", "seed"
+                    )
+                })
+            }
+
+            logger.info(f"Running batch of {size} images")
+            result_queue = context.Queue()
+            child = context.Process(target=_run_batch, args=(options, result_queue))
+            child.start()
+            try:
+                result = wait_for_result(child, result_queue)
+            except RuntimeError as e:
+                # Killed by the OOM killer or crashed; a negative code is the signal number
+                logger.error(f"Batch of {size} images failed: {str(e)}")
+                sys.exit(1)
+            finally:
+                child.join()
+                shutil.rmtree(output_dir, ignore_errors=True)
+
+            logger.info(
+                f"{size} images: {result['images_per_second']} img/s, "
+                f"p50 {result['latency_seconds']['p50']}s, p99 {result['latency_seconds']['p99']}s, "
+                f"peak RSS {result['peak_rss_mb']} MB"
+            )
+            runs.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "transport": args.transport,
+        "concurrency": args.concurrency,
+        "behavior": {
+            "latency_distribution": args.latency_distribution,
+            "latency_mean": args.latency_mean,
+            "latency_spread": args.latency_spread,
+            "rate_limit_rate": args.rate_limit_rate,
+            "error_rate": args.error_rate,
+            "error_mix": args.error_mix,
+            "seed": args.seed
+        },
+        "runs": runs,
+        "targets": check_targets(runs)
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.check_targets and not all(target["passed"] for target in report["targets"].values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
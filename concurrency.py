@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from retry_handler import ERROR_RATE_LIMIT, ERROR_TIMEOUT, classify_error
+
+logger = logging.getLogger(__name__)
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_OVERLOAD = "overload"
+OUTCOME_ERROR = "error"
+OUTCOME_CANCELLED = "cancelled"  # the call was abandoned; says nothing about the API
+
+# Maximum number of limit changes kept for processing_stats.json
+LIMIT_HISTORY_SIZE = 500
+
+def is_overload_error(error: Exception) -> bool:
+    """Check whether an error signals that the API is saturated (429 or timeout)."""
+    return classify_error(error).category in (ERROR_RATE_LIMIT, ERROR_TIMEOUT)
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD (additive increase, multiplicative decrease) limit on in-flight API calls.
+
+    After every full window of successful calls (one window equals the current
+    limit), the limit grows by ``increase_step`` as long as latency and error
+    rate stay healthy. An overload signal (429 or timeout) multiplies the limit
+    by ``decrease_factor``. Only one decrease happens per congestion event:
+    overloads from calls that started before the last decrease are ignored.
+    With ``min_limit == max_limit`` this behaves like a plain semaphore.
+    """
+
+    def __init__(
+        self,
+        min_limit: int,
+        max_limit: int,
+        initial_limit: int = None,
+        increase_step: int = 1,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+        max_error_rate: float = 0.1
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        if initial_limit is None:
+            initial_limit = self.min_limit
+        self.limit = min(max(initial_limit, self.min_limit), self.max_limit)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        self._start_time = time.monotonic()
+        self._last_decrease = float("-inf")
+        self._window_successes = 0
+        self._window_errors = 0
+        self._latency_ewma = None
+        self._latency_baseline = None
+        self.increases = 0
+        self.decreases = 0
+        self.limit_history = deque([(0.0, self.limit)], maxlen=LIMIT_HISTORY_SIZE)
+
+    @property
+    def adaptive(self) -> bool:
+        return self.min_limit < self.max_limit
+
+    async def acquire(self) -> float:
+        """Wait for a free slot and return the call's start time."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return time.monotonic()
+
+    def try_acquire(self) -> Optional[float]:
+        """Take a slot only if one is free right now; returns the start time, or None."""
+        if self.in_flight >= self.limit:
+            return None
+        self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started_at: float, outcome: str):
+        """Free a slot and feed the call's outcome back into the controller."""
+        async with self._condition:
+            self.in_flight -= 1
+            if outcome == OUTCOME_SUCCESS:
+                self._on_success(time.monotonic() - started_at)
+            elif outcome == OUTCOME_OVERLOAD:
+                self._on_overload(started_at)
+            elif outcome == OUTCOME_ERROR:
+                self._window_errors += 1
+            self._condition.notify_all()
+
+    def _on_success(self, latency: float):
+        if self._latency_ewma is None:
+            self._latency_ewma = latency
+        else:
+            self._latency_ewma = 0.8 * self._latency_ewma + 0.2 * latency
+        if self._latency_baseline is None or self._latency_ewma < self._latency_baseline:
+            self._latency_baseline = self._latency_ewma
+
+        self._window_successes += 1
+        window = self._window_successes + self._window_errors
+        if window < self.limit:
+            return
+
+        error_rate = self._window_errors / window
+        latency_healthy = self._latency_ewma <= self._latency_baseline * self.latency_tolerance
+        self._window_successes = 0
+        self._window_errors = 0
+        if latency_healthy and error_rate <= self.max_error_rate and self.limit < self.max_limit:
+            self._set_limit(min(self.max_limit, self.limit + self.increase_step))
+            self.increases += 1
+
+    def _on_overload(self, started_at: float):
+        # Calls already in flight during the last cut belong to the same congestion event
+        if started_at < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self._window_successes = 0
+        self._window_errors = 0
+        new_limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+        if new_limit < self.limit:
+            self._set_limit(new_limit)
+            self.decreases += 1
+
+    def _set_limit(self, new_limit: int):
+        elapsed = time.monotonic() - self._start_time
+        logger.info(f"Concurrency limit {self.limit} -> {new_limit} (in flight: {self.in_flight})")
+        self.limit = new_limit
+        self.limit_history.append((round(elapsed, 3), new_limit))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get controller state and the recent limit history."""
+        return {
+            "current_limit": self.limit,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "latency_ewma": self._latency_ewma,
+            "limit_history": [list(entry) for entry in self.limit_history]
+        }
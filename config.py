@@ -1,16 +1,72 @@
 import os
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import List, Optional
 
 @dataclass
 class Config:
     gemini_api_key: str
     max_concurrent_requests: int = 5
     max_retries: int = 5
+    retry_budget_ratio: float = 0.1  # retries allowed per request across the run; 0 disables the budget
+    circuit_breaker_threshold: int = 10  # consecutive outage failures before pausing; 0 disables
+    circuit_breaker_timeout: float = 30.0
     output_dir: str = "./output"
     enable_prompt_optimization: bool = False
-    archive_format: str = "none"  # "zip", "tar", or "none"
+    archive_format: str = "none"  # "zip", "tar", "stream", or "none"
+    archive_codec: str = "auto"  # for "stream": "zstd", "gzip" or "auto" (zstd when available)
+    result_sink: str = "files"  # "files" (one file per image), "jsonl" or "parquet" shards
+    result_shard_mb: int = 128
     dry_run: bool = False
+    resume: bool = False
+    include_globs: List[str] = field(default_factory=list)
+    exclude_globs: List[str] = field(default_factory=list)
+    sniff_formats: bool = True  # detect image format from magic bytes instead of the extension
+    discovery_workers: int = 8
+    only_changed: bool = False
+    dedup: bool = False  # send one representative per group of near-duplicate images
+    dedup_method: str = "dhash"  # "dhash" or "phash"
+    dedup_max_distance: int = 4  # Hamming distance (of 64 bits) that counts as a duplicate
+    schedule_order: str = "discovery"  # "discovery", "largest-first" or "smallest-first"
+    schedule_cost: str = "bytes"  # cost estimate for ordering: "bytes" or "pixels"
+    schedule_window: int = 10000  # images buffered for ordering
+    hedge_requests: bool = False  # duplicate requests slower than the latency quantile
+    hedge_quantile: float = 0.95
+    hedge_max_ratio: float = 0.05  # at most this fraction of calls is hedged
+    distributed: bool = False  # claim images from a work queue shared with other workers
+    work_queue_path: Optional[str] = None  # default: work_queue.sqlite in the output directory
+    worker_id: Optional[str] = None  # default: hostname-pid
+    lease_seconds: float = 300.0
+    claim_batch_size: int = 32
+    routes_file: Optional[str] = None  # JSON list of API keys/models to spread requests over
+    watch: bool = False  # keep running and process new images as they arrive
+    watch_backend: str = "auto"  # "auto", "inotify" or "poll"
+    watch_poll_interval: float = 5.0
+    watch_batch_size: int = 100
+    watch_batch_window: float = 2.0  # seconds to gather arrivals into one micro-batch
+    context_file: Optional[str] = None  # text sent before every request (instructions, few-shot examples)
+    context_images: List[str] = field(default_factory=list)  # reference images sent before every request
+    context_cache: str = "auto"  # "auto" caches the shared context through the API, "off" always inlines it
+    context_cache_ttl: float = 3600.0
+    cache_dir: Optional[str] = None
+    cache_max_mb: int = 1024
+    adaptive_concurrency: bool = False
+    min_concurrent_requests: int = 1
+    rpm_limit: int = 0  # 0 disables the requests-per-minute bucket
+    tpm_limit: int = 0  # 0 disables the tokens-per-minute bucket
+    estimated_tokens_per_request: int = 1000
+    rate_limit_state_file: Optional[str] = None
+    preprocess_workers: int = 0  # 0 uses one process per CPU
+    max_image_edge: int = 0  # 0 keeps the original resolution
+    upload_format: str = "original"  # "original", "jpeg", "webp" or "png"
+    upload_quality: int = 85
+    images_per_request: int = 1
+    model_backend: str = "gemini"  # "gemini" or "mock"
+    transport: str = "sdk"  # "sdk" (thread per request) or "rest" (pooled aiohttp)
+    api_base_url: str = "https://generativelanguage.googleapis.com"
+    http_connection_limit: int = 100
+    request_timeout: float = 120.0
+    show_progress: bool = False
+    metrics_port: int = 0  # 0 disables the OpenMetrics endpoint
     
     @classmethod
     def from_env(cls) -> "Config":
@@ -21,5 +77,61 @@ class Config:
             output_dir=os.getenv("OUTPUT_DIR", "./output"),
             enable_prompt_optimization=os.getenv("ENABLE_PROMPT_OPTIMIZATION", "false").lower() == "true",
             archive_format=os.getenv("ARCHIVE_FORMAT", "none"),
-            dry_run=os.getenv("DRY_RUN", "false").lower() == "true"
+            dry_run=os.getenv("DRY_RUN", "false").lower() == "true",
+            resume=os.getenv("RESUME", "false").lower() == "true",
+            cache_dir=os.getenv("CACHE_DIR") or None,
+            cache_max_mb=int(os.getenv("CACHE_MAX_MB", "1024")),
+            adaptive_concurrency=os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true",
+            min_concurrent_requests=int(os.getenv("MIN_CONCURRENT_REQUESTS", "1")),
+            rpm_limit=int(os.getenv("RPM_LIMIT", "0")),
+            tpm_limit=int(os.getenv("TPM_LIMIT", "0")),
+            estimated_tokens_per_request=int(os.getenv("ESTIMATED_TOKENS_PER_REQUEST", "1000")),
+            rate_limit_state_file=os.getenv("RATE_LIMIT_STATE_FILE") or None,
+            preprocess_workers=int(os.getenv("PREPROCESS_WORKERS", "0")),
+            max_image_edge=int(os.getenv("MAX_IMAGE_EDGE", "0")),
+            upload_format=os.getenv("UPLOAD_FORMAT", "original"),
+            upload_quality=int(os.getenv("UPLOAD_QUALITY", "85")),
+            images_per_request=int(os.getenv("IMAGES_PER_REQUEST", "1")),
+            model_backend=os.getenv("MODEL_BACKEND", "gemini"),
+            transport=os.getenv("TRANSPORT", "sdk"),
+            api_base_url=os.getenv("API_BASE_URL", "https://generativelanguage.googleapis.com"),
+            http_connection_limit=int(os.getenv("HTTP_CONNECTION_LIMIT", "100")),
+            request_timeout=float(os.getenv("REQUEST_TIMEOUT", "120")),
+            show_progress=os.getenv("SHOW_PROGRESS", "false").lower() == "true",
+            metrics_port=int(os.getenv("METRICS_PORT", "0")),
+            retry_budget_ratio=float(os.getenv("RETRY_BUDGET_RATIO", "0.1")),
+            circuit_breaker_threshold=int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "10")),
+            circuit_breaker_timeout=float(os.getenv("CIRCUIT_BREAKER_TIMEOUT", "30")),
+            result_sink=os.getenv("RESULT_SINK", "files"),
+            result_shard_mb=int(os.getenv("RESULT_SHARD_MB", "128")),
+            archive_codec=os.getenv("ARCHIVE_CODEC", "auto"),
+            include_globs=[p for p in os.getenv("INCLUDE_GLOBS", "").split(",") if p],
+            exclude_globs=[p for p in os.getenv("EXCLUDE_GLOBS", "").split(",") if p],
+            sniff_formats=os.getenv("SNIFF_FORMATS", "true").lower() == "true",
+            discovery_workers=int(os.getenv("DISCOVERY_WORKERS", "8")),
+            only_changed=os.getenv("ONLY_CHANGED", "false").lower() == "true",
+            dedup=os.getenv("DEDUP", "false").lower() == "true",
+            dedup_method=os.getenv("DEDUP_METHOD", "dhash"),
+            dedup_max_distance=int(os.getenv("DEDUP_MAX_DISTANCE", "4")),
+            schedule_order=os.getenv("SCHEDULE_ORDER", "discovery"),
+            schedule_cost=os.getenv("SCHEDULE_COST", "bytes"),
+            schedule_window=int(os.getenv("SCHEDULE_WINDOW", "10000")),
+            hedge_requests=os.getenv("HEDGE_REQUESTS", "false").lower() == "true",
+            hedge_quantile=float(os.getenv("HEDGE_QUANTILE", "0.95")),
+            hedge_max_ratio=float(os.getenv("HEDGE_MAX_RATIO", "0.05")),
+            distributed=os.getenv("DISTRIBUTED", "false").lower() == "true",
+            work_queue_path=os.getenv("WORK_QUEUE_PATH") or None,
+            worker_id=os.getenv("WORKER_ID") or None,
+            lease_seconds=float(os.getenv("LEASE_SECONDS", "300")),
+            claim_batch_size=int(os.getenv("CLAIM_BATCH_SIZE", "32")),
+            routes_file=os.getenv("ROUTES_FILE") or None,
+            watch=os.getenv("WATCH", "false").lower() == "true",
+            watch_backend=os.getenv("WATCH_BACKEND", "auto"),
+            watch_poll_interval=float(os.getenv("WATCH_POLL_INTERVAL", "5")),
+            watch_batch_size=int(os.getenv("WATCH_BATCH_SIZE", "100")),
+            watch_batch_window=float(os.getenv("WATCH_BATCH_WINDOW", "2")),
+            context_file=os.getenv("CONTEXT_FILE") or None,
+            context_images=[p for p in os.getenv("CONTEXT_IMAGES", "").split(",") if p],
+            context_cache=os.getenv("CONTEXT_CACHE", "auto"),
+            context_cache_ttl=float(os.getenv("CONTEXT_CACHE_TTL", "3600"))
         )
\ No newline at end of file
@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from preprocessor import prepare_image
+from retry_handler import classify_error
+from transport import CachedContent
+
+logger = logging.getLogger(__name__)
+
+CACHE_AUTO = "auto"
+CACHE_OFF = "off"
+
+# A cache is replaced this long before it expires, so no request names a dropped cache
+REFRESH_MARGIN = 120.0
+
+# Backoff between attempts to create a cache after a transient failure
+CREATE_RETRY_BASE_DELAY = 5.0
+CREATE_RETRY_MAX_DELAY = 600.0
+
+def load_context_parts(text_file: Optional[str] = None, image_paths: Optional[List[str]] = None) -> List[Any]:
+    """Read the shared prefix: instructions or few-shot examples from a text file, then reference images."""
+    parts: List[Any] = []
+    if text_file:
+        with open(text_file, 'r', encoding='utf-8') as f:
+            parts.append(f.read())
+    for image_path in image_paths or []:
+        # Validated and, for formats the API does not take, re-encoded like any other image
+        prepared = prepare_image(image_path)
+        parts.append({"mime_type": prepared.mime_type, "data": prepared.data})
+    return parts
+
+def context_digest(parts: List[Any]) -> str:
+    """Stable hash of the prefix, so cached responses are not reused across different contexts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            digest.update(b"t" + part.encode('utf-8'))
+        else:
+            digest.update(b"i" + part["mime_type"].encode('utf-8') + b"\0" + part["data"])
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class SharedContext:
+    """
+    The prefix every request starts with: long instructions, few-shot examples, reference images.
+
+    With caching, the prefix is uploaded once through the transport's
+    context caching (``create_cached_content``) and each request names the
+    cache instead of carrying the prefix. A new cache is created shortly
+    before the old one expires. If the transport cannot cache, for example
+    because the prefix is below the API's minimum cacheable size, the prefix
+    is sent inline with every request instead. Once its replacement is live,
+    the old cache is deleted as soon as no request in flight names it;
+    callers report the end of a request with ``release``. After a transient failure
+    (429, 5xx, network) the prefix is sent inline only until creation,
+    retried with backoff, succeeds.
+    """
+
+    def __init__(self, parts: List[Any], transport: Any = None, mode: str = CACHE_AUTO, ttl_seconds: float = 3600.0):
+        self.parts = parts
+        self.transport = transport
+        self.mode = mode
+        self.ttl_seconds = max(ttl_seconds, 2 * REFRESH_MARGIN)
+        self.digest = context_digest(parts)
+        self._cache: Optional[CachedContent] = None
+        self._lock = asyncio.Lock()
+        self._retry_at = 0.0
+        self._consecutive_failures = 0
+        self._in_use: Dict[str, int] = {}
+        self._retired: Set[str] = set()
+        # Without a transport (routing or dry runs) the prefix is always inlined
+        self._cache_failed = mode == CACHE_OFF or transport is None
+        self.fallback_reason: Optional[str] = "caching disabled" if self._cache_failed else None
+
+        self.caches_created = 0
+        self.caches_deleted = 0
+        self.caches_lost = 0
+        self.create_failures = 0
+        self.requests_cached = 0
+        self.requests_inline = 0
+
+    @staticmethod
+    def _is_fresh(cache: Optional[CachedContent]) -> bool:
+        return cache is not None and time.time() < cache.expires_at - REFRESH_MARGIN
+
+    @staticmethod
+    def _usable(cache: Optional[CachedContent]) -> Optional[CachedContent]:
+        return cache if cache is not None and time.time() < cache.expires_at else None
+
+    async def _current_cache(self) -> Optional[CachedContent]:
+        if self._cache_failed:
+            return None
+        if self._is_fresh(self._cache) or time.time() < self._retry_at:
+            return self._usable(self._cache)
+        async with self._lock:
+            if not self._cache_failed and not self._is_fresh(self._cache) and time.time() >= self._retry_at:
+                await self._create()
+        return None if self._cache_failed else self._usable(self._cache)
+
+    async def _create(self):
+        try:
+            cache = await self.transport.create_cached_content(self.parts, self.ttl_seconds)
+        except Exception as e:
+            self.create_failures += 1
+            self.fallback_reason = str(e)
+            classification = classify_error(e)
+            if isinstance(e, NotImplementedError) or not classification.retryable:
+                self._cache_failed = True
+                logger.warning(f"Could not cache the shared context, sending it with every request: {str(e)}")
+                return
+            self._consecutive_failures += 1
+            delay = classification.retry_after or CREATE_RETRY_BASE_DELAY * 2 ** (self._consecutive_failures - 1)
+            delay = min(delay, CREATE_RETRY_MAX_DELAY)
+            self._retry_at = time.time() + delay
+            logger.warning(f"Could not cache the shared context, trying again in {delay:.0f}s: {str(e)}")
+            return
+        previous, self._cache = self._cache, cache
+        if previous is not None:
+            # Requests in flight may still name the old cache; the last of them deletes it
+            if self._in_use.get(previous.name):
+                self._retired.add(previous.name)
+            else:
+                await self._delete(previous.name)
+        self._consecutive_failures = 0
+        self._retry_at = 0.0
+        self.fallback_reason = None
+        self.caches_created += 1
+        logger.info(f"Cached the shared context as {cache.name} ({cache.token_count} tokens)")
+
+    async def build(self, parts: List[Any]) -> Tuple[List[Any], Optional[str]]:
+        """Contents of one request and the name of the cache they refer to, if any."""
+        cache = await self._current_cache()
+        if cache is None:
+            self.requests_inline += 1
+            return self.parts + parts, None
+        self.requests_cached += 1
+        self._in_use[cache.name] = self._in_use.get(cache.name, 0) + 1
+        return parts, cache.name
+
+    def invalidate(self, cache_name: str):
+        """Forget a cache the API no longer knows (expired early or evicted), so the next request rebuilds it."""
+        if self._cache is not None and self._cache.name == cache_name:
+            logger.warning(f"Context cache {cache_name} was not found, creating a new one")
+            self._cache = None
+            self._retry_at = 0.0
+            self.caches_lost += 1
+
+    async def release(self, cache_name: Optional[str]):
+        """Report that a request built by ``build`` has ended."""
+        if cache_name is None:
+            return
+        remaining = self._in_use.get(cache_name, 0) - 1
+        if remaining > 0:
+            self._in_use[cache_name] = remaining
+            return
+        self._in_use.pop(cache_name, None)
+        if cache_name in self._retired:
+            await self._delete(cache_name)
+
+    async def _delete(self, name: str):
+        self._retired.discard(name)
+        try:
+            await self.transport.delete_cached_content(name)
+        except Exception as e:
+            # It expires on its own; only the storage until then is lost
+            logger.debug(f"Could not delete {name}: {str(e)}")
+            return
+        self.caches_deleted += 1
+
+    async def close(self):
+        """Delete the caches instead of paying for their storage until they expire."""
+        for name in list(self._retired):
+            await self._delete(name)
+        if self._cache is None:
+            return
+        await self._delete(self._cache.name)
+        self._cache = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "parts": len(self.parts),
+            "cache_name": self._cache.name if self._cache else None,
+            "cached_prefix_tokens": self._cache.token_count if self._cache else None,
+            "caches_created": self.caches_created,
+            "caches_deleted": self.caches_deleted,
+            "caches_lost": self.caches_lost,
+            "create_failures": self.create_failures,
+            "requests_cached": self.requests_cached,
+            "requests_inline": self.requests_inline,
+            "fallback_reason": self.fallback_reason
+        }
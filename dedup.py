@@ -0,0 +1,222 @@
+import logging
+import math
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+HASH_DHASH = "dhash"
+HASH_PHASH = "phash"
+
+# Hash size per side; both methods produce hash_size * hash_size bits
+HASH_SIZE = 8
+PHASH_SAMPLE_SIZE = 32
+
+# Hashes with fewer than this many bits set (or unset) are not used for grouping
+MIN_HASH_BITS = 8
+
+# Largest difference of any mean RGB channel (0-255) between images in one group
+MAX_COLOUR_DIFFERENCE = 16
+
+# Representative results kept in memory for members that show up after their representative finished
+MAX_REMEMBERED_RESULTS = 100000
+
+_PHASH_COSINES = [
+    [math.cos((2 * x + 1) * u * math.pi / (2 * PHASH_SAMPLE_SIZE)) for x in range(PHASH_SAMPLE_SIZE)]
+    for u in range(HASH_SIZE)
+]
+
+def _load_thumbnail(image_path: str, size: Tuple[int, int]) -> Tuple[List[int], Tuple[int, ...]]:
+    """Grayscale pixels of a thumbnail and the image's mean RGB colour."""
+    from PIL import Image, ImageStat
+    with Image.open(image_path) as img:
+        # Let JPEG decode at reduced scale; the hash only needs a thumbnail
+        img.draft("RGB", (size[0] * 4, size[1] * 4))
+        thumbnail = img.convert("RGB").resize(size, Image.LANCZOS)
+        mean_colour = tuple(int(round(channel)) for channel in ImageStat.Stat(thumbnail).mean)
+        return list(thumbnail.convert("L").tobytes()), mean_colour
+
+def _dhash(pixels: List[int]) -> int:
+    width = HASH_SIZE + 1
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[row * width + col] > pixels[row * width + col + 1])
+    return value
+
+def _phash(pixels: List[int]) -> int:
+    n = PHASH_SAMPLE_SIZE
+    # Separable DCT, computing only the HASH_SIZE x HASH_SIZE low frequencies
+    rows = [
+        [sum(pixels[y * n + x] * _PHASH_COSINES[u][x] for x in range(n)) for u in range(HASH_SIZE)]
+        for y in range(n)
+    ]
+    coefficients = [
+        sum(rows[y][u] * _PHASH_COSINES[v][y] for y in range(n))
+        for v in range(HASH_SIZE) for u in range(HASH_SIZE)
+    ]
+    # The DC term only reflects overall brightness
+    median = sorted(coefficients[1:])[len(coefficients[1:]) // 2]
+    value = 0
+    for coefficient in coefficients:
+        value = (value << 1) | (coefficient > median)
+    return value
+
+def compute_dhash(image_path: str) -> int:
+    """Difference hash: whether each pixel is brighter than its right neighbour."""
+    pixels, _ = _load_thumbnail(image_path, (HASH_SIZE + 1, HASH_SIZE))
+    return _dhash(pixels)
+
+def compute_phash(image_path: str) -> int:
+    """DCT hash: low-frequency coefficients of a 32x32 thumbnail compared to their median."""
+    pixels, _ = _load_thumbnail(image_path, (PHASH_SAMPLE_SIZE, PHASH_SAMPLE_SIZE))
+    return _phash(pixels)
+
+def compute_image_hash(image_path: str, method: str = HASH_DHASH) -> Tuple[int, Tuple[int, ...]]:
+    """Perceptual hash and mean colour; top-level so it can run in the preprocessing process pool."""
+    if method == HASH_PHASH:
+        pixels, mean_colour = _load_thumbnail(image_path, (PHASH_SAMPLE_SIZE, PHASH_SAMPLE_SIZE))
+        return _phash(pixels), mean_colour
+    pixels, mean_colour = _load_thumbnail(image_path, (HASH_SIZE + 1, HASH_SIZE))
+    return _dhash(pixels), mean_colour
+
+def is_degenerate(hash_value: int) -> bool:
+    """A hash with almost all bits equal comes from a flat or smooth image and identifies nothing."""
+    bits = bin(hash_value).count("1")
+    return bits < MIN_HASH_BITS or bits > HASH_SIZE * HASH_SIZE - MIN_HASH_BITS
+
+def colour_distance(a: Tuple[int, ...], b: Tuple[int, ...]) -> int:
+    return max(abs(x - y) for x, y in zip(a, b))
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance for radius queries on hashes."""
+
+    def __init__(self):
+        self._root = None  # (hash, value, {distance: child})
+        self.size = 0
+
+    def add(self, hash_value: int, value: Any):
+        self.size += 1
+        if self._root is None:
+            self._root = (hash_value, value, {})
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (hash_value, value, {})
+                return
+            node = child
+
+    def find(self, hash_value: int, max_distance: int) -> List[Tuple[int, Any]]:
+        """Return (distance, value) for every entry within ``max_distance``, closest first."""
+        if self._root is None:
+            return []
+        matches = []
+        stack = [self._root]
+        while stack:
+            node_hash, value, children = stack.pop()
+            distance = hamming_distance(hash_value, node_hash)
+            if distance <= max_distance:
+                matches.append((distance, value))
+            # Triangle inequality: only children within [d - r, d + r] can match
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+class Deduplicator:
+    """
+    Online near-duplicate grouping by perceptual hash.
+
+    The first image of a group becomes its representative and is sent to
+    the model; a later image within ``max_distance`` bits of a
+    representative's hash, and with a similar mean colour, joins that group
+    instead. Near-uniform images, whose hashes carry no information, are
+    never grouped. Members that arrive
+    while their representative is in flight wait for it; the processor
+    copies the representative's result to them when it is recorded.
+    """
+
+    def __init__(self, preprocessor, method: str = HASH_DHASH, max_distance: int = 4):
+        self.preprocessor = preprocessor
+        self.method = method
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.groups: Dict[str, List[Dict[str, Any]]] = {}
+        self._in_flight: set = set()
+        self._waiting: Dict[str, List[Tuple[str, Optional[str]]]] = {}
+        self._results: "OrderedDict[str, Any]" = OrderedDict()
+        self.hash_failures = 0
+        self.ungroupable = 0
+
+    async def assign(self, image_path: str) -> Optional[str]:
+        """Return the representative this image duplicates, or None if it is a new representative."""
+        try:
+            signature = await self.preprocessor.run(compute_image_hash, image_path, self.method)
+        except Exception as e:
+            # Unreadable images go through the normal path, which reports the error
+            logger.debug(f"Could not hash {image_path}: {str(e)}")
+            self.hash_failures += 1
+            return None
+
+        hash_value, mean_colour = signature
+        if is_degenerate(hash_value):
+            # Flat images all hash alike; each is sent on its own
+            self.ungroupable += 1
+            return None
+
+        # No await from here on, so lookup and insert are atomic on the event loop
+        for distance, (representative, representative_colour) in self.tree.find(hash_value, self.max_distance):
+            if colour_distance(mean_colour, representative_colour) <= MAX_COLOUR_DIFFERENCE:
+                self.groups.setdefault(representative, []).append({"path": image_path, "distance": distance})
+                return representative
+        self.tree.add(hash_value, (image_path, mean_colour))
+        self._in_flight.add(image_path)
+        return None
+
+    def is_in_flight(self, representative: str) -> bool:
+        return representative in self._in_flight
+
+    def wait_for(self, representative: str, image_path: str, content_hash: Optional[str]):
+        """Queue a member until its representative's result is recorded."""
+        self._waiting.setdefault(representative, []).append((image_path, content_hash))
+
+    def result_for(self, representative: str):
+        return self._results.get(representative)
+
+    def complete(self, representative: str, result) -> List[Tuple[str, Optional[str]]]:
+        """Store a representative's result and return the members that were waiting for it."""
+        if representative not in self._in_flight:
+            return []
+        self._in_flight.discard(representative)
+        self._results[representative] = result
+        if len(self._results) > MAX_REMEMBERED_RESULTS:
+            self._results.popitem(last=False)
+        return self._waiting.pop(representative, [])
+
+    def get_groups(self) -> Dict[str, Any]:
+        """Group membership for metadata/duplicate_groups.json."""
+        return {
+            "method": self.method,
+            "max_distance": self.max_distance,
+            "groups": [
+                {"representative": representative, "members": members}
+                for representative, members in self.groups.items()
+            ]
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "method": self.method,
+            "max_distance": self.max_distance,
+            "representatives": self.tree.size,
+            "groups_with_duplicates": len(self.groups),
+            "duplicates": sum(len(members) for members in self.groups.values()),
+            "hash_failures": self.hash_failures,
+            "ungroupable": self.ungroupable
+        }
@@ -0,0 +1,361 @@
+import fnmatch
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_MANIFEST_FILENAME = "discovery_manifest.sqlite"
+
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')
+
+# Bytes needed to recognise every supported format
+SNIFF_BYTES = 12
+
+# Paths found but not yet consumed; bounds memory when the pipeline is slower than the walk
+OUTPUT_QUEUE_SIZE = 10000
+
+# Manifest rows written per executemany call
+MANIFEST_BATCH_SIZE = 1000
+
+# Paths per manifest lookup query; below SQLite's default limit of 999 bound parameters
+LOOKUP_BATCH_SIZE = 500
+
+_DONE = object()
+
+def sniff_image_format(header: bytes) -> Optional[str]:
+    """Return the canonical extension for an image header, or None if it isn't a supported image."""
+    if header.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return ".webp"
+    if header.startswith(b"BM"):
+        return ".bmp"
+    return None
+
+def sniff_file(path: str) -> Optional[str]:
+    try:
+        with open(path, 'rb') as f:
+            return sniff_image_format(f.read(SNIFF_BYTES))
+    except OSError:
+        return None
+
+class DiscoveryManifest:
+    """
+    Persisted (path, size, mtime) listing of previously discovered files.
+
+    Rows written during a walk are staged in a TEMP table, which belongs to
+    this connection and never reaches the database file, until ``commit``
+    moves them over after the run. A crashed run therefore never marks files
+    as listed, and the database is only written in one short transaction.
+    Only images that were processed successfully are moved, so files that
+    failed or were never reached are listed again by ``--only-changed``.
+    With ``shared`` (several distributed workers, possibly on other hosts)
+    the database uses a rollback journal, because WAL needs shared memory
+    and does not work across hosts on a network filesystem. The connection
+    is shared by the walker threads behind a lock.
+    """
+
+    def __init__(self, db_path: str, shared: bool = False):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), isolation_level=None, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=DELETE" if shared else "PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                format TEXT
+            )
+            """
+        )
+        self.conn.execute("CREATE TEMP TABLE kept_paths (path TEXT PRIMARY KEY)")
+        self.conn.execute(
+            """
+            CREATE TEMP TABLE staged_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                format TEXT
+            )
+            """
+        )
+
+    def lookup(self, paths: List[str]) -> Dict[str, Tuple[int, int, Optional[str]]]:
+        """Return (size, mtime_ns, format) recorded for each known path, including rows not yet committed."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(paths), LOOKUP_BATCH_SIZE):
+                batch = paths[start:start + LOOKUP_BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                # Staged rows are read last, so they win over the committed ones
+                for table in ("main.files", "staged_files"):
+                    rows = self.conn.execute(
+                        f"SELECT path, size, mtime_ns, format FROM {table} WHERE path IN ({placeholders})", batch
+                    )
+                    for path, size, mtime_ns, image_format in rows:
+                        found[path] = (size, mtime_ns, image_format)
+        return found
+
+    def record(self, rows: List[Tuple[str, int, int, Optional[str]]]):
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO staged_files (path, size, mtime_ns, format) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def commit(self, keep: Optional[Callable[[str], bool]] = None):
+        """
+        Move staged rows into the manifest.
+
+        With ``keep``, an image's row is only moved once ``keep(path)`` says
+        it was processed successfully; other rows stay staged for a later
+        commit. Rows of non-images (no format) are always moved.
+        """
+        with self._lock:
+            if keep is None:
+                self.conn.execute("INSERT INTO kept_paths SELECT path FROM staged_files")
+            else:
+                # Collected first: the staged table cannot change while it is being read
+                batch = []
+                for path, image_format in self.conn.execute("SELECT path, format FROM staged_files"):
+                    if image_format is None or keep(path):
+                        batch.append((path,))
+                for start in range(0, len(batch), MANIFEST_BATCH_SIZE):
+                    self.conn.executemany("INSERT INTO kept_paths VALUES (?)", batch[start:start + MANIFEST_BATCH_SIZE])
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO main.files "
+                    "SELECT staged_files.* FROM staged_files JOIN kept_paths USING (path)"
+                )
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            self.conn.execute("DELETE FROM staged_files WHERE path IN (SELECT path FROM kept_paths)")
+            self.conn.execute("DELETE FROM kept_paths")
+
+    def close(self):
+        # Staged rows are dropped with the connection
+        with self._lock:
+            self.conn.close()
+
+class ImageWalker:
+    """
+    Concurrent ``os.scandir`` walker that yields image paths as they are found.
+
+    Directories are scanned in parallel by a thread pool, which hides the
+    per-directory latency of network filesystems. Paths relative to the root
+    are matched against ``include``/``exclude`` globs (a pattern also matches
+    a bare file name; excluded directories are not descended into). With
+    ``sniff`` the format is detected from magic bytes, so misnamed files are
+    found and non-images with image extensions are skipped; otherwise the
+    extension decides. With a ``manifest``, unchanged files reuse their
+    recorded format instead of being re-read, and ``only_changed`` limits the
+    listing to files that are new or changed since the last committed run.
+    ``quiet`` drops the end-of-walk summary, for walks repeated by a watcher.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        include: Optional[Iterable[str]] = None,
+        exclude: Optional[Iterable[str]] = None,
+        extensions: Iterable[str] = SUPPORTED_EXTENSIONS,
+        sniff: bool = True,
+        workers: int = 8,
+        manifest: Optional[DiscoveryManifest] = None,
+        only_changed: bool = False,
+        quiet: bool = False
+    ):
+        self.root = os.path.abspath(root)
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.sniff = sniff
+        self.workers = max(1, workers)
+        self.manifest = manifest
+        self.only_changed = only_changed
+        self.quiet = quiet
+
+        self.files_seen = 0
+        self.images_found = 0
+        self.unchanged_skipped = 0
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def _matches(relative_path: str, patterns: List[str], is_dir: bool = False) -> bool:
+        name = relative_path.rsplit("/", 1)[-1]
+        # A directory also matches patterns for its contents, e.g. "raw/**" prunes "raw"
+        candidates = (relative_path, name, relative_path + "/") if is_dir else (relative_path, name)
+        return any(fnmatch.fnmatch(candidate, p) for p in patterns for candidate in candidates)
+
+    def _relative(self, path: str) -> str:
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def excludes_directory(self, path: str) -> bool:
+        return bool(self.exclude) and self._matches(self._relative(path), self.exclude, is_dir=True)
+
+    def classify_file(self, path: str) -> Optional[str]:
+        """Classify a single file outside a walk, e.g. one reported by a watcher; same rules as a walk."""
+        if not self._wanted(path, os.path.basename(path)):
+            return None
+        try:
+            stat = os.stat(path) if self.manifest is not None else None
+        except OSError:
+            # Gone again before it could be looked at
+            return None
+        pending_rows = []
+        found = self._classify([(path, os.path.basename(path), stat)], pending_rows)
+        if pending_rows:
+            self.manifest.record(pending_rows)
+        return found[0] if found else None
+
+    def _wanted(self, path: str, name: str) -> bool:
+        """Whether a file passes the globs and, without sniffing, the extension filter."""
+        if self.include or self.exclude:
+            relative_path = self._relative(path)
+            if self.include and not self._matches(relative_path, self.include):
+                return False
+            if self.exclude and self._matches(relative_path, self.exclude):
+                return False
+        return self.sniff or os.path.splitext(name)[1].lower() in self.extensions
+
+    def _classify(self, candidates: List[Tuple[str, str, Any]], pending_rows: list) -> List[str]:
+        """
+        Return the paths to yield among (path, name, stat) candidates.
+
+        Candidates are classified in batches, typically the files of one
+        directory, so the manifest is queried once per batch rather than
+        once per file. Without a manifest, stats are not needed and are None.
+        """
+        previous_rows = self.manifest.lookup([path for path, _, _ in candidates]) if self.manifest is not None else {}
+        found = []
+        for path, name, stat in candidates:
+            changed = True
+            previous = previous_rows.get(path)
+            if previous is not None and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+                changed = False
+                image_format = previous[2]
+            else:
+                image_format = sniff_file(path) if self.sniff else os.path.splitext(name)[1].lower()
+                if stat is not None:
+                    pending_rows.append((path, stat.st_size, stat.st_mtime_ns, image_format))
+
+            if image_format is None or image_format not in self.extensions:
+                continue
+            if self.only_changed and not changed:
+                with self._stats_lock:
+                    self.unchanged_skipped += 1
+                continue
+            found.append(path)
+        return found
+
+    def __iter__(self) -> Iterator[str]:
+        if not os.path.isdir(self.root):
+            raise FileNotFoundError(f"Input directory not found: {self.root}")
+
+        output: "queue.Queue" = queue.Queue(maxsize=OUTPUT_QUEUE_SIZE)
+        stopped = threading.Event()
+        pending_lock = threading.Lock()
+        pending = [0]
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="discovery")
+
+        def put(item):
+            # Give up if the consumer went away, instead of blocking forever
+            while not stopped.is_set():
+                try:
+                    output.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        def submit(directory: str):
+            with pending_lock:
+                pending[0] += 1
+            executor.submit(scan, directory)
+
+        def scan(directory: str):
+            pending_rows = []
+            candidates = []
+
+            def classify_candidates():
+                for path in self._classify(candidates, pending_rows):
+                    with self._stats_lock:
+                        self.images_found += 1
+                    put(path)
+                candidates.clear()
+                if len(pending_rows) >= MANIFEST_BATCH_SIZE:
+                    self.manifest.record(pending_rows)
+                    pending_rows.clear()
+
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if stopped.is_set():
+                            return
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not self.excludes_directory(entry.path):
+                                    submit(entry.path)
+                            elif entry.is_file():
+                                with self._stats_lock:
+                                    self.files_seen += 1
+                                if self._wanted(entry.path, entry.name):
+                                    stat = entry.stat() if self.manifest is not None else None
+                                    candidates.append((entry.path, entry.name, stat))
+                        except OSError as e:
+                            logger.warning(f"Skipping {entry.path}: {str(e)}")
+                        if len(candidates) >= LOOKUP_BATCH_SIZE:
+                            classify_candidates()
+                if candidates:
+                    classify_candidates()
+            except OSError as e:
+                logger.warning(f"Could not scan {directory}: {str(e)}")
+            except Exception as e:
+                logger.error(f"Discovery failed in {directory}: {str(e)}")
+            finally:
+                if pending_rows:
+                    self.manifest.record(pending_rows)
+                with pending_lock:
+                    pending[0] -= 1
+                    finished = pending[0] == 0
+                if finished:
+                    put(_DONE)
+
+        submit(self.root)
+        try:
+            while True:
+                item = output.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if self.quiet:
+            return
+        if self.unchanged_skipped:
+            logger.info(f"Skipped {self.unchanged_skipped} unchanged files listed in the discovery manifest")
+        elif not self.images_found:
+            logger.warning(f"No supported image files found in {self.root}")
+
+    def get_stats(self):
+        return {
+            "files_seen": self.files_seen,
+            "images_found": self.images_found,
+            "unchanged_skipped": self.unchanged_skipped
+        }
@@ -0,0 +1,391 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WORK_QUEUE_FILENAME = "work_queue.sqlite"
+WORKERS_DIRNAME = "workers"
+
+ITEM_PENDING = "pending"
+ITEM_LEASED = "leased"
+ITEM_DONE = "done"
+ITEM_FAILED = "failed"
+
+# An image whose lease expired this many times is assumed to take workers down with it
+MAX_CLAIMS = 3
+
+# Paths inserted per transaction while seeding the queue
+SEED_BATCH_SIZE = 1000
+
+# How often completions are written back and leases checked for renewal
+FLUSH_INTERVAL = 1.0
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class WorkQueue:
+    """
+    Lease-based work queue shared by workers through a SQLite file.
+
+    One worker at a time walks the input tree and seeds the queue with paths
+    relative to the input root, so nodes may mount the tree in different
+    places. Workers claim paths in batches under a lease that a background
+    thread renews while the worker is alive; leases of a crashed worker
+    expire and their paths are claimed again by the others. A path whose
+    lease expired ``MAX_CLAIMS`` times is marked failed instead.
+
+    The database uses a rollback journal rather than WAL, because WAL needs
+    shared memory and does not work across hosts on a network filesystem.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        input_root: str,
+        worker_id: Optional[str] = None,
+        lease_seconds: float = 300.0,
+        claim_batch_size: int = 32,
+        poll_interval: float = 1.0
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.input_root = os.path.abspath(input_root)
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.claim_batch_size = max(1, claim_batch_size)
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), isolation_level=None, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS items (
+                    path TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    worker_id TEXT,
+                    lease_expires REAL,
+                    claims INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS items_status ON items (status, lease_expires)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS workers (
+                    worker_id TEXT PRIMARY KEY,
+                    hostname TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    started_at REAL NOT NULL,
+                    heartbeat REAL NOT NULL,
+                    finished INTEGER NOT NULL DEFAULT 0,
+                    stats TEXT
+                )
+                """
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        self._completed: List[Tuple[str, float, str, str]] = []
+        self._completed_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._seed_thread: Optional[threading.Thread] = None
+        self._seed_error: Optional[Exception] = None
+
+        self.claimed = 0
+        self.reclaimed = 0
+        self.seeded = 0
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent claims never interleave
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    @staticmethod
+    def _get_meta(conn: sqlite3.Connection, key: str) -> Optional[str]:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _set_meta(conn: sqlite3.Connection, key: str, value: str):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _relative(self, image_path: str) -> str:
+        return os.path.relpath(os.path.abspath(image_path), self.input_root).replace(os.sep, "/")
+
+    def register(self, resume: bool = False):
+        """
+        Join the current run, or start a new one if the previous run was merged.
+
+        A new run reprocesses everything, or with ``resume`` only the paths
+        that failed or were not completed. Workers joining an interrupted run
+        continue it.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            if self._get_meta(conn, "merged") == "1":
+                conn.execute("DELETE FROM workers")
+                conn.execute("DELETE FROM meta")
+                if resume:
+                    conn.execute(
+                        "UPDATE items SET status = ?, worker_id = NULL, lease_expires = NULL, claims = 0 WHERE status != ?",
+                        (ITEM_PENDING, ITEM_DONE)
+                    )
+                else:
+                    conn.execute("DELETE FROM items")
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO workers (worker_id, hostname, pid, started_at, heartbeat, finished)
+                VALUES (?, ?, ?, ?, ?, 0)
+                """,
+                (self.worker_id, socket.gethostname(), os.getpid(), now, now)
+            )
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name="work-queue-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+        logger.info(f"Worker {self.worker_id} joined work queue {self.db_path}")
+
+    def claimed_paths(self, source: Iterable[str]) -> Iterator[str]:
+        """
+        Yield paths claimed by this worker until the queue is drained.
+
+        ``source`` is only walked if this worker becomes the seeder. While
+        other workers hold unexpired leases this blocks and polls, so the
+        paths of a worker that crashes meanwhile are picked up.
+        """
+        while True:
+            if self._seed_error is not None:
+                raise self._seed_error
+            if not self._is_seeded():
+                self._maybe_start_seeding(source)
+            paths = self._claim()
+            if paths:
+                for path in paths:
+                    yield os.path.join(self.input_root, path)
+                continue
+            if self._is_drained():
+                return
+            time.sleep(self.poll_interval)
+
+    def complete(self, image_path: str, succeeded: bool):
+        """Mark a claimed path as finished; written back by the heartbeat thread."""
+        status = ITEM_DONE if succeeded else ITEM_FAILED
+        with self._completed_lock:
+            self._completed.append((status, time.time(), self._relative(image_path), self.worker_id))
+
+    def is_done(self, image_path: str) -> bool:
+        """Check whether any worker completed a path successfully."""
+        with self._lock:
+            row = self.conn.execute("SELECT status FROM items WHERE path = ?", (self._relative(image_path),)).fetchone()
+        return row is not None and row[0] == ITEM_DONE
+
+    def _is_seeded(self) -> bool:
+        with self._lock:
+            return self._get_meta(self.conn, "seeded") == "1"
+
+    def _maybe_start_seeding(self, source: Iterable[str]):
+        """Become the seeder unless another live worker already is."""
+        if self._seed_thread is not None:
+            return
+        now = time.time()
+        with self._transaction() as conn:
+            seeder = self._get_meta(conn, "seeder")
+            heartbeat = float(self._get_meta(conn, "seeder_heartbeat") or 0)
+            if seeder and seeder != self.worker_id and heartbeat >= now - self.lease_seconds:
+                return
+            if seeder and seeder != self.worker_id:
+                logger.warning(f"Seeder {seeder} stopped responding; {self.worker_id} takes over seeding")
+            self._set_meta(conn, "seeder", self.worker_id)
+            self._set_meta(conn, "seeder_heartbeat", str(now))
+        self._seed_thread = threading.Thread(target=self._seed, args=(source,), name="work-queue-seed", daemon=True)
+        self._seed_thread.start()
+
+    def _seed(self, source: Iterable[str]):
+        try:
+            batch = []
+            for image_path in source:
+                batch.append(self._relative(image_path))
+                if len(batch) >= SEED_BATCH_SIZE:
+                    self._insert(batch)
+                    batch = []
+            if batch:
+                self._insert(batch)
+            with self._transaction() as conn:
+                self._set_meta(conn, "seeded", "1")
+            logger.info(f"Seeded the work queue with {self.seeded} new images")
+        except Exception as e:
+            logger.error(f"Seeding the work queue failed: {str(e)}")
+            self._seed_error = e
+
+    def _insert(self, paths: List[str]):
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (path, status, updated_at) VALUES (?, ?, ?)",
+                [(path, ITEM_PENDING, now) for path in paths]
+            )
+            self.seeded += conn.total_changes - before
+
+    def _claim(self) -> List[str]:
+        now = time.time()
+        with self._transaction() as conn:
+            abandoned = conn.execute(
+                "UPDATE items SET status = ?, worker_id = NULL, updated_at = ? "
+                "WHERE status = ? AND lease_expires < ? AND claims >= ?",
+                (ITEM_FAILED, now, ITEM_LEASED, now, MAX_CLAIMS)
+            ).rowcount
+            if abandoned:
+                logger.warning(f"Gave up on {abandoned} images whose lease expired {MAX_CLAIMS} times")
+            rows = conn.execute(
+                "SELECT path, status FROM items WHERE status = ? OR (status = ? AND lease_expires < ?) LIMIT ?",
+                (ITEM_PENDING, ITEM_LEASED, now, self.claim_batch_size)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE items SET status = ?, worker_id = ?, lease_expires = ?, claims = claims + 1, updated_at = ? "
+                "WHERE path = ?",
+                [(ITEM_LEASED, self.worker_id, now + self.lease_seconds, now, path) for path, _ in rows]
+            )
+        self.claimed += len(rows)
+        self.reclaimed += sum(1 for _, status in rows if status == ITEM_LEASED)
+        return [path for path, _ in rows]
+
+    def _is_drained(self) -> bool:
+        """True once seeding finished and nothing is pending or leased by another worker."""
+        with self._lock:
+            if self._get_meta(self.conn, "seeded") != "1":
+                return False
+            return self.conn.execute(
+                "SELECT 1 FROM items WHERE status = ? OR (status = ? AND worker_id != ?) LIMIT 1",
+                (ITEM_PENDING, ITEM_LEASED, self.worker_id)
+            ).fetchone() is None
+
+    def _flush(self):
+        with self._completed_lock:
+            batch, self._completed = self._completed, []
+        if not batch:
+            return
+        # A path whose lease was taken over by another worker stays with that worker
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE items SET status = ?, lease_expires = NULL, updated_at = ? WHERE path = ? AND worker_id = ?",
+                batch
+            )
+
+    def _renew(self):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE items SET lease_expires = ? WHERE worker_id = ? AND status = ?",
+                (now + self.lease_seconds, self.worker_id, ITEM_LEASED)
+            )
+            conn.execute("UPDATE workers SET heartbeat = ? WHERE worker_id = ?", (now, self.worker_id))
+            if self._seed_thread is not None and self._seed_thread.is_alive():
+                self._set_meta(conn, "seeder_heartbeat", str(now))
+
+    def _heartbeat(self):
+        last_renewal = time.monotonic()
+        while not self._stop.wait(FLUSH_INTERVAL):
+            try:
+                self._flush()
+                if time.monotonic() - last_renewal >= self.lease_seconds / 3:
+                    self._renew()
+                    last_renewal = time.monotonic()
+            except sqlite3.Error as e:
+                logger.warning(f"Work queue heartbeat failed: {str(e)}")
+
+    def _stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        self._flush()
+
+    def finish(self, stats: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Record this worker's stats and check whether the whole run is done.
+
+        Returns ``{"workers": {worker_id: stats}, "queue": counts}`` to the
+        one worker that should merge the outputs, and None to every other.
+        Workers whose heartbeat is older than the lease count as finished.
+        """
+        self._stop_heartbeat()
+        now = time.time()
+        with self._transaction() as conn:
+            released = self._release(conn)
+            if released:
+                logger.warning(f"{released} claimed images were not completed and go back to the queue")
+            conn.execute(
+                "UPDATE workers SET finished = 1, heartbeat = ?, stats = ? WHERE worker_id = ?",
+                (now, json.dumps(stats), self.worker_id)
+            )
+            if self._get_meta(conn, "merged") == "1" or self._get_meta(conn, "seeded") != "1":
+                return None
+            outstanding = conn.execute(
+                "SELECT COUNT(*) FROM items WHERE status IN (?, ?)", (ITEM_PENDING, ITEM_LEASED)
+            ).fetchone()[0]
+            active = conn.execute(
+                "SELECT COUNT(*) FROM workers WHERE finished = 0 AND heartbeat >= ?", (now - self.lease_seconds,)
+            ).fetchone()[0]
+            if outstanding or active:
+                return None
+            self._set_meta(conn, "merged", "1")
+            workers = {
+                worker_id: json.loads(worker_stats) if worker_stats else None
+                for worker_id, worker_stats in conn.execute("SELECT worker_id, stats FROM workers ORDER BY worker_id")
+            }
+            queue = dict(conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+        return {"workers": workers, "queue": queue}
+
+    def close(self):
+        """Stop the heartbeat and hand any paths still leased back to the other workers."""
+        self._stop_heartbeat()
+        with self._transaction() as conn:
+            self._release(conn)
+        self.conn.close()
+    
+    def _release(self, conn: sqlite3.Connection) -> int:
+        return conn.execute(
+            "UPDATE items SET status = ?, worker_id = NULL, lease_expires = NULL, claims = claims - 1 "
+            "WHERE worker_id = ? AND status = ?",
+            (ITEM_PENDING, self.worker_id, ITEM_LEASED)
+        ).rowcount
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "claimed": self.claimed,
+            "reclaimed": self.reclaimed,
+            "seeded": self.seeded
+        }
+
+def merge_worker_stats(run: Dict[str, Any]) -> Dict[str, Any]:
+    """Combine per-worker processing stats into one run summary."""
+    totals = {"total_images": 0, "successful": 0, "failed": 0, "skipped_completed": 0}
+    for stats in run["workers"].values():
+        # A worker that crashed left no stats; its paths were processed by the others
+        for key in totals:
+            totals[key] += (stats or {}).get(key, 0)
+    total = totals["total_images"]
+    return {
+        **totals,
+        "success_rate": totals["successful"] / total if total > 0 else 0,
+        "work_queue": run["queue"],
+        "workers": run["workers"]
+    }
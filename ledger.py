@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+
+LEDGER_FILENAME = "ledger.sqlite"
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Ledger:
+    """
+    Durable per-image processing ledger backed by SQLite.
+
+    Entries are keyed by (path, content hash), so an image that changes on disk
+    is treated as new work. Every state change is committed immediately, which
+    lets a later ``--resume`` run skip images that already succeeded.
+    """
+
+    def __init__(self, output_dir: str):
+        self.db_path = Path(output_dir) / LEDGER_FILENAME
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path), isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                latency REAL,
+                prompt TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (path, content_hash)
+            )
+            """
+        )
+
+    def get_status(self, path: str, content_hash: str) -> Optional[str]:
+        """Return the recorded status for an image, or None if it is unknown."""
+        row = self.conn.execute(
+            "SELECT status FROM images WHERE path = ? AND content_hash = ?",
+            (path, content_hash)
+        ).fetchone()
+        return row[0] if row else None
+
+    def is_completed(self, path: str, content_hash: str) -> bool:
+        """Check whether an image with this exact content already succeeded."""
+        return self.get_status(path, content_hash) == STATUS_SUCCESS
+
+    def has_succeeded(self, path: str) -> bool:
+        """Check whether the most recent outcome recorded for a path, whatever its content, is a success."""
+        row = self.conn.execute(
+            "SELECT status FROM images WHERE path = ? ORDER BY updated_at DESC LIMIT 1", (path,)
+        ).fetchone()
+        return row is not None and row[0] == STATUS_SUCCESS
+
+    def mark_pending(self, path: str, content_hash: str):
+        """Record that an image is about to be processed."""
+        self.conn.execute(
+            """
+            INSERT INTO images (path, content_hash, status, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (path, content_hash) DO UPDATE SET
+                status = excluded.status, updated_at = excluded.updated_at
+            """,
+            (path, content_hash, STATUS_PENDING, time.time())
+        )
+
+    def record_success(self, path: str, content_hash: str, attempts: int, latency: float, prompt: str):
+        """Record a successful result together with the prompt that produced it."""
+        self._record(path, content_hash, STATUS_SUCCESS, attempts, latency, prompt, None)
+
+    def record_failure(self, path: str, content_hash: str, attempts: int, latency: float, error: str):
+        """Record a failed image so a resumed run picks it up again."""
+        self._record(path, content_hash, STATUS_FAILED, attempts, latency, None, error)
+
+    def _record(
+        self,
+        path: str,
+        content_hash: str,
+        status: str,
+        attempts: int,
+        latency: float,
+        prompt: Optional[str],
+        error: Optional[str]
+    ):
+        # Attempts accumulate across runs so repeated failures stay visible
+        self.conn.execute(
+            """
+            INSERT INTO images (path, content_hash, status, attempts, latency, prompt, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path, content_hash) DO UPDATE SET
+                status = excluded.status,
+                attempts = images.attempts + excluded.attempts,
+                latency = excluded.latency,
+                prompt = excluded.prompt,
+                error = excluded.error,
+                updated_at = excluded.updated_at
+            """,
+            (path, content_hash, status, attempts, latency, prompt, error, time.time())
+        )
+
+    def get_summary(self) -> Dict[str, int]:
+        """Count ledger entries by status."""
+        rows = self.conn.execute("SELECT status, COUNT(*) FROM images GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def close(self):
+        """Close the underlying database connection."""
+        self.conn.close()
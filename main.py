@@ -8,12 +8,21 @@ Usage:
 
 import argparse
 import asyncio
+import dataclasses
 import logging
 import os
+import signal
+import socket
+import sys
 from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
 
+from archiver import Archiver
 from config import Config
+from discovery import DISCOVERY_MANIFEST_FILENAME, SUPPORTED_EXTENSIONS, DiscoveryManifest, ImageWalker
+from distributed import WORK_QUEUE_FILENAME, WORKERS_DIRNAME, WorkQueue, merge_worker_stats
 from processor import GeminiBatchProcessor
+from watcher import FolderWatcher, create_watcher
 
 # Configure logging
 logging.basicConfig(
@@ -28,11 +37,93 @@ def parse_arguments():
     parser.add_argument('--input-dir', required=True, help='Input directory containing images')
     parser.add_argument('--prompt', required=True, help='Base prompt for all images')
     parser.add_argument('--output-dir', default='./output', help='Output directory for results')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help='Only process files whose relative path or name matches (repeatable)')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help='Skip matching files and directories (repeatable)')
+    parser.add_argument('--no-sniff', action='store_true',
+                        help='Select images by file extension instead of magic bytes')
+    parser.add_argument('--discovery-workers', type=int, help='Threads scanning directories in parallel')
+    parser.add_argument('--only-changed', action='store_true',
+                        help='Only process files that are new or changed since the last completed run')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Send one representative per group of near-duplicate images and copy its result')
+    parser.add_argument('--dedup-method', choices=['dhash', 'phash'], help='Perceptual hash used for --dedup')
+    parser.add_argument('--dedup-distance', type=int,
+                        help='Maximum Hamming distance (out of 64 bits) between near-duplicates')
+    parser.add_argument('--schedule', choices=['discovery', 'largest-first', 'smallest-first'],
+                        help='Order in which images are sent, by estimated cost')
+    parser.add_argument('--schedule-cost', choices=['bytes', 'pixels'], help='Cost estimate used by --schedule')
+    parser.add_argument('--schedule-window', type=int, help='Images buffered and sorted by --schedule')
+    parser.add_argument('--hedge-requests', action='store_true',
+                        help='Send a duplicate of requests that exceed the observed latency quantile')
+    parser.add_argument('--hedge-quantile', type=float, help='Latency quantile after which a request is hedged')
+    parser.add_argument('--hedge-max-ratio', type=float, help='Maximum fraction of calls that may be hedged')
+    parser.add_argument('--distributed', action='store_true',
+                        help='Claim images from a work queue shared by workers on several hosts')
+    parser.add_argument('--work-queue', help='Shared work queue database (default: work_queue.sqlite in the output dir)')
+    parser.add_argument('--worker-id', help='Unique name of this worker (default: hostname-pid)')
+    parser.add_argument('--lease-seconds', type=float,
+                        help='Seconds before images claimed by an unresponsive worker are claimed again')
+    parser.add_argument('--claim-batch-size', type=int, help='Images claimed from the work queue at a time')
+    parser.add_argument('--local-workers', type=int,
+                        help='Start this many distributed worker processes on this host')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and process new images as they arrive (implies --resume)')
+    parser.add_argument('--watch-backend', choices=['auto', 'inotify', 'poll'],
+                        help='How new files are noticed; auto uses inotify where available')
+    parser.add_argument('--watch-poll-interval', type=float, help='Seconds between scans when polling')
+    parser.add_argument('--watch-batch-size', type=int, help='Maximum images per micro-batch in watch mode')
+    parser.add_argument('--watch-batch-window', type=float,
+                        help='Seconds to gather new arrivals into one micro-batch')
+    parser.add_argument('--context-file',
+                        help='Text sent ahead of every image (long instructions, few-shot examples)')
+    parser.add_argument('--context-image', action='append', metavar='PATH',
+                        help='Reference image sent ahead of every image (repeatable)')
+    parser.add_argument('--context-cache', choices=['auto', 'off'],
+                        help='Upload the shared context once as an API context cache, or always send it inline')
+    parser.add_argument('--context-cache-ttl', type=float, help='Lifetime in seconds of the context cache')
     parser.add_argument('--max-concurrent', type=int, default=5, help='Maximum concurrent requests')
+    parser.add_argument('--adaptive-concurrency', action='store_true',
+                        help='Adjust concurrency between --min-concurrent and --max-concurrent (AIMD)')
+    parser.add_argument('--min-concurrent', type=int, help='Concurrency floor for adaptive mode')
+    parser.add_argument('--rpm-limit', type=int, help='Requests per minute shared by all processes using this key')
+    parser.add_argument('--tpm-limit', type=int, help='Tokens per minute shared by all processes using this key')
+    parser.add_argument('--estimated-tokens-per-request', type=int, help='Tokens reserved per request for --tpm-limit')
+    parser.add_argument('--rate-limit-state-file', help='Shared rate limiter state file (default: per-key file in temp dir)')
     parser.add_argument('--max-retries', type=int, default=5, help='Maximum retry attempts per image')
+    parser.add_argument('--retry-budget-ratio', type=float,
+                        help='Cap retries at this fraction of requests across the run (0 disables)')
+    parser.add_argument('--circuit-breaker-threshold', type=int,
+                        help='Consecutive 429/5xx/timeout failures that pause all workers (0 disables)')
+    parser.add_argument('--circuit-breaker-timeout', type=float,
+                        help='Seconds to pause before probing the API again')
+    parser.add_argument('--preprocess-workers', type=int, help='Processes used to decode and re-encode images (default: CPU count)')
+    parser.add_argument('--max-image-edge', type=int, help='Downscale images so the longest edge is at most this many pixels')
+    parser.add_argument('--upload-format', choices=['original', 'jpeg', 'webp', 'png'], help='Encoding used for uploaded images')
+    parser.add_argument('--upload-quality', type=int, help='JPEG/WebP quality for re-encoded images')
+    parser.add_argument('--images-per-request', type=int, help='Pack several images into one request (short tasks only)')
+    parser.add_argument('--model-backend', choices=['gemini', 'mock'], help='Use the real API or a local offline mock model')
+    parser.add_argument('--transport', choices=['sdk', 'rest'], help='Call the API through the SDK or pooled async HTTP')
+    parser.add_argument('--api-base-url', help='Base URL for the REST transport')
+    parser.add_argument('--routes-file',
+                        help='JSON file of API keys/models to spread requests over, with per-route limits and failover')
+    parser.add_argument('--http-connection-limit', type=int, help='Maximum pooled connections for the REST transport')
+    parser.add_argument('--request-timeout', type=float, help='Per-request timeout in seconds for the REST transport')
+    parser.add_argument('--progress', action='store_true', help='Show a live progress bar with ETA')
+    parser.add_argument('--metrics-port', type=int, help='Serve OpenMetrics at http://0.0.0.0:PORT/metrics')
     parser.add_argument('--enable-prompt-optimization', action='store_true', help='Enable automatic prompt refinement')
-    parser.add_argument('--archive-format', choices=['zip', 'tar', 'none'], default='none', help='Archive format')
+    parser.add_argument('--archive-format', choices=['zip', 'tar', 'stream', 'none'], default='none',
+                        help='Archive format; stream compresses results into a tar while they are written')
+    parser.add_argument('--archive-codec', choices=['auto', 'zstd', 'gzip'],
+                        help='Codec for --archive-format stream (auto prefers zstd)')
+    parser.add_argument('--result-sink', choices=['files', 'jsonl', 'parquet'],
+                        help='Write results as one file per image (default) or as size-rotated JSONL/Parquet shards')
+    parser.add_argument('--result-shard-mb', type=int, help='Rotate result shards at this size')
     parser.add_argument('--dry-run', action='store_true', help='Test without making actual API calls')
+    parser.add_argument('--resume', action='store_true', help='Skip images already completed in a previous run')
+    parser.add_argument('--cache-dir', help='Directory for the on-disk response cache (disabled if not set)')
+    parser.add_argument('--cache-max-mb', type=int, help='Maximum response cache size in MB')
     return parser.parse_args()
 
 def load_config_from_args(args):
@@ -41,37 +132,288 @@ def load_config_from_args(args):
     config = Config.from_env()
     
     # Override with command line arguments
+    if args.include:
+        config.include_globs = args.include
+    if args.exclude:
+        config.exclude_globs = args.exclude
+    config.sniff_formats = config.sniff_formats and not args.no_sniff
+    if args.discovery_workers is not None:
+        config.discovery_workers = args.discovery_workers
+    config.only_changed = args.only_changed or config.only_changed
+    config.dedup = args.dedup or config.dedup
+    if args.dedup_method is not None:
+        config.dedup_method = args.dedup_method
+    if args.dedup_distance is not None:
+        config.dedup_max_distance = args.dedup_distance
+    if args.schedule:
+        config.schedule_order = args.schedule
+    if args.schedule_cost:
+        config.schedule_cost = args.schedule_cost
+    if args.schedule_window is not None:
+        config.schedule_window = args.schedule_window
+    config.hedge_requests = args.hedge_requests or config.hedge_requests
+    if args.hedge_quantile is not None:
+        config.hedge_quantile = args.hedge_quantile
+    if args.hedge_max_ratio is not None:
+        config.hedge_max_ratio = args.hedge_max_ratio
+    config.distributed = args.distributed or bool(args.local_workers) or config.distributed
+    if args.work_queue:
+        config.work_queue_path = args.work_queue
+    if args.worker_id:
+        config.worker_id = args.worker_id
+    if args.lease_seconds is not None:
+        config.lease_seconds = args.lease_seconds
+    if args.claim_batch_size is not None:
+        config.claim_batch_size = args.claim_batch_size
+    config.watch = args.watch or config.watch
+    if args.watch_backend:
+        config.watch_backend = args.watch_backend
+    if args.watch_poll_interval is not None:
+        config.watch_poll_interval = args.watch_poll_interval
+    if args.watch_batch_size is not None:
+        config.watch_batch_size = args.watch_batch_size
+    if args.watch_batch_window is not None:
+        config.watch_batch_window = args.watch_batch_window
+    if args.context_file:
+        config.context_file = args.context_file
+    if args.context_image:
+        config.context_images = args.context_image
+    if args.context_cache:
+        config.context_cache = args.context_cache
+    if args.context_cache_ttl is not None:
+        config.context_cache_ttl = args.context_cache_ttl
     config.max_concurrent_requests = args.max_concurrent
+    config.adaptive_concurrency = args.adaptive_concurrency or config.adaptive_concurrency
+    if args.min_concurrent is not None:
+        config.min_concurrent_requests = args.min_concurrent
+    if args.rpm_limit is not None:
+        config.rpm_limit = args.rpm_limit
+    if args.tpm_limit is not None:
+        config.tpm_limit = args.tpm_limit
+    if args.estimated_tokens_per_request is not None:
+        config.estimated_tokens_per_request = args.estimated_tokens_per_request
+    if args.rate_limit_state_file:
+        config.rate_limit_state_file = args.rate_limit_state_file
+    if args.preprocess_workers is not None:
+        config.preprocess_workers = args.preprocess_workers
+    if args.max_image_edge is not None:
+        config.max_image_edge = args.max_image_edge
+    if args.upload_format:
+        config.upload_format = args.upload_format
+    if args.upload_quality is not None:
+        config.upload_quality = args.upload_quality
+    if args.images_per_request is not None:
+        config.images_per_request = args.images_per_request
+    if args.model_backend:
+        config.model_backend = args.model_backend
+    if args.transport:
+        config.transport = args.transport
+    if args.api_base_url:
+        config.api_base_url = args.api_base_url
+    if args.routes_file:
+        config.routes_file = args.routes_file
+    if args.http_connection_limit is not None:
+        config.http_connection_limit = args.http_connection_limit
+    if args.request_timeout is not None:
+        config.request_timeout = args.request_timeout
+    config.show_progress = args.progress or config.show_progress
+    if args.metrics_port is not None:
+        config.metrics_port = args.metrics_port
     config.max_retries = args.max_retries
+    if args.retry_budget_ratio is not None:
+        config.retry_budget_ratio = args.retry_budget_ratio
+    if args.circuit_breaker_threshold is not None:
+        config.circuit_breaker_threshold = args.circuit_breaker_threshold
+    if args.circuit_breaker_timeout is not None:
+        config.circuit_breaker_timeout = args.circuit_breaker_timeout
     config.output_dir = args.output_dir
     config.enable_prompt_optimization = args.enable_prompt_optimization
     config.archive_format = args.archive_format
+    if args.archive_codec:
+        config.archive_codec = args.archive_codec
+    if args.result_sink:
+        config.result_sink = args.result_sink
+    if args.result_shard_mb is not None:
+        config.result_shard_mb = args.result_shard_mb
     config.dry_run = args.dry_run
+    config.resume = args.resume or config.resume
+    if args.cache_dir:
+        config.cache_dir = args.cache_dir
+    if args.cache_max_mb is not None:
+        config.cache_max_mb = args.cache_max_mb
     
     # Validate API key
-    if not config.gemini_api_key and not args.dry_run:
+    # Routes carry their own keys
+    if not config.gemini_api_key and not args.dry_run and config.model_backend != "mock" and not config.routes_file:
         raise ValueError("GEMINI_API_KEY environment variable is required")
+    # A dry run would mark every queued image as done for the real workers
+    if config.distributed and config.dry_run:
+        raise ValueError("--dry-run cannot be combined with distributed mode")
+    if config.watch:
+        if config.distributed:
+            raise ValueError("--watch cannot be combined with distributed mode")
+        # A restarted daemon must not send the images it already finished again
+        config.resume = True
     
     return config
 
-def get_image_files(input_dir: str, supported_formats=None) -> list:
-    """Get list of supported image files from input directory."""
-    if supported_formats is None:
-        supported_formats = ['.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif']
-    
-    input_path = Path(input_dir)
-    if not input_path.exists():
-        raise FileNotFoundError(f"Input directory not found: {input_dir}")
-    
-    image_files = []
-    for file_path in input_path.rglob("*"):
-        if file_path.suffix.lower() in supported_formats:
-            image_files.append(str(file_path))
+def iter_image_files(input_dir: str, supported_formats=None) -> Iterator[str]:
+    """Lazily yield supported image files from input directory, matched by extension."""
+    return iter(ImageWalker(input_dir, extensions=supported_formats or SUPPORTED_EXTENSIONS, sniff=False))
+
+def build_image_walker(
+    config: Config,
+    input_dir: str,
+    manifest: Optional[DiscoveryManifest] = None,
+    only_changed: Optional[bool] = None,
+    quiet: bool = False
+) -> ImageWalker:
+    """Build the discovery walker for a run from its configuration."""
+    if manifest is None:
+        # Distributed workers share the output directory, possibly from several hosts
+        manifest = DiscoveryManifest(
+            os.path.join(config.output_dir, DISCOVERY_MANIFEST_FILENAME), shared=config.distributed
+        )
+    return ImageWalker(
+        input_dir,
+        include=config.include_globs,
+        exclude=config.exclude_globs,
+        sniff=config.sniff_formats,
+        workers=config.discovery_workers,
+        manifest=manifest,
+        only_changed=config.only_changed if only_changed is None else only_changed,
+        quiet=quiet
+    )
+
+async def run_watch(config: Config, walker: ImageWalker, input_dir: str, prompt: str) -> Dict[str, Any]:
+    """
+    Process the input tree, then keep processing new images in micro-batches.
+
+    The processor, with its model client, connections and worker processes,
+    lives as long as the daemon. Stats are rewritten after every micro-batch;
+    on SIGINT or SIGTERM the current batch is finished, then the results are
+    flushed and archived as at the end of a normal run.
+    """
+    manifest = walker.manifest
+    # Same rules as the initial walk, but only for files not yet in the manifest
+    source = create_watcher(
+        config.watch_backend,
+        lambda: build_image_walker(config, input_dir, manifest, only_changed=True, quiet=True),
+        config.watch_poll_interval
+    )
+    watcher = FolderWatcher(source, config.watch_batch_size, config.watch_batch_window)
+    processor = GeminiBatchProcessor(config)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, watcher.stop)
+    try:
+        # Started before the first walk, so files that land during it are not missed
+        watcher.start()
+        batch = walker
+        while True:
+            await processor.process_images(batch, prompt)
+            # Files queued for a later batch, or that failed, stay staged until they succeed
+            if not config.dry_run:
+                manifest.commit(processor.ledger.has_succeeded)
+            processor.save_stats({"watch": watcher.get_stats()})
+            logger.info(f"Watching {input_dir} for new images")
+            batch = await watcher.next_batch()
+            if not batch:
+                break
+            logger.info(f"Processing {len(batch)} new images")
+        logger.info("Stopping watch mode")
+        return await processor.finish({"watch": watcher.get_stats()})
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        await watcher.close()
+        manifest.close()
+        await processor.close()
+
+async def run_distributed_worker(config: Config, walker: ImageWalker, input_dir: str, prompt: str) -> Dict[str, Any]:
+    """
+    Process images claimed from the shared work queue.
+
+    Each worker writes into its own directory under ``workers/``; the last
+    worker to finish merges them into the output directory and writes the
+    combined stats and archive. Other workers return their own stats.
+    """
+    work_queue = WorkQueue(
+        config.work_queue_path or os.path.join(config.output_dir, WORK_QUEUE_FILENAME),
+        input_dir,
+        worker_id=config.worker_id,
+        lease_seconds=config.lease_seconds,
+        claim_batch_size=config.claim_batch_size
+    )
+    worker_config = dataclasses.replace(
+        config,
+        output_dir=os.path.join(config.output_dir, WORKERS_DIRNAME, work_queue.worker_id),
+        archive_format="none"
+    )
+    work_queue.register(resume=config.resume)
+    processor = GeminiBatchProcessor(worker_config, work_queue=work_queue)
+    try:
+        stats = await processor.process_image_batch(work_queue.claimed_paths(walker), prompt)
+        stats["work_queue"] = work_queue.get_stats()
+        run = work_queue.finish(stats)
+        # After finish, which writes back this worker's completions
+        walker.manifest.commit(work_queue.is_done)
+    finally:
+        walker.manifest.close()
+        await processor.close()
+        work_queue.close()
     
-    if not image_files:
-        logger.warning(f"No supported image files found in {input_dir}")
+    if run is None:
+        logger.info(f"Worker {work_queue.worker_id} finished; another worker merges the results")
+        return stats
     
-    return image_files
+    archiver = Archiver(
+        config.output_dir,
+        config.archive_format,
+        result_sink=config.result_sink,
+        shard_max_mb=config.result_shard_mb,
+        archive_codec=config.archive_codec
+    )
+    workers_dir = Path(config.output_dir) / WORKERS_DIRNAME
+    archiver.merge_worker_outputs({worker_id: workers_dir / worker_id for worker_id in run["workers"]})
+    merged_stats = merge_worker_stats(run)
+    archiver.save_processing_stats(merged_stats)
+    if config.archive_format != "none":
+        archiver.create_archive()
+    return merged_stats
+
+def local_worker_arguments(argv: List[str]) -> List[str]:
+    """Command line for one local worker: the same arguments without --local-workers."""
+    arguments = []
+    skip_value = False
+    for argument in argv:
+        if skip_value:
+            skip_value = False
+        elif argument == '--local-workers':
+            skip_value = True
+        elif not argument.startswith('--local-workers='):
+            arguments.append(argument)
+    return arguments + ['--distributed']
+
+async def run_local_workers(count: int) -> int:
+    """Stand in for several hosts by running distributed workers as local processes."""
+    arguments = local_worker_arguments(sys.argv[1:])
+    processes = [
+        await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), *arguments,
+            '--worker-id', f"{socket.gethostname()}-local{index}"
+        )
+        for index in range(count)
+    ]
+    return_codes = await asyncio.gather(*(process.wait() for process in processes))
+    failed = sum(1 for code in return_codes if code != 0)
+    if failed:
+        logger.error(f"{failed} of {count} local workers failed")
+    return failed
+
+def get_image_files(input_dir: str, supported_formats=None) -> list:
+    """Get list of supported image files from input directory."""
+    return list(iter_image_files(input_dir, supported_formats))
 
 async def main():
     """Main entry point."""
@@ -81,26 +423,48 @@ async def main():
         # Load configuration
         config = load_config_from_args(args)
         
-        # Get image files
-        image_files = get_image_files(args.input_dir)
-        logger.info(f"Found {len(image_files)} images to process")
+        if not Path(args.input_dir).exists():
+            raise FileNotFoundError(f"Input directory not found: {args.input_dir}")
         
-        if not image_files:
-            logger.info("No images to process, exiting.")
+        if args.local_workers:
+            if await run_local_workers(args.local_workers):
+                raise RuntimeError("Some local workers failed")
             return
         
-        # Initialize processor
-        processor = GeminiBatchProcessor(config)
+        # Image files are discovered concurrently and streamed into the pipeline
+        walker = build_image_walker(config, args.input_dir)
         
-        # Process images
         logger.info(f"Starting batch processing with prompt: '{args.prompt}'")
-        stats = await processor.process_image_batch(image_files, args.prompt)
+        if config.watch:
+            stats = await run_watch(config, walker, args.input_dir, args.prompt)
+        elif config.distributed:
+            stats = await run_distributed_worker(config, walker, args.input_dir, args.prompt)
+        else:
+            # Initialize processor
+            processor = GeminiBatchProcessor(config)
+            
+            # Process images
+            try:
+                stats = await processor.process_image_batch(walker, args.prompt)
+                # Only a completed run updates the listing used by --only-changed, and only with
+                # the images that succeeded; failed and unreached ones are listed again next time
+                if not config.dry_run:
+                    walker.manifest.commit(processor.ledger.has_succeeded)
+            finally:
+                walker.manifest.close()
+                await processor.close()
+        
+        if not stats['total_images']:
+            logger.info(f"No images were processed ({stats['skipped_completed']} already completed).")
+            return
         
         # Print summary
         logger.info("Batch processing completed!")
         logger.info(f"Total images: {stats['total_images']}")
         logger.info(f"Successful: {stats['successful']}")
         logger.info(f"Failed: {stats['failed']}")
+        if stats['skipped_completed']:
+            logger.info(f"Skipped (already completed): {stats['skipped_completed']}")
         logger.info(f"Success rate: {stats['success_rate']:.2%}")
         logger.info(f"Results saved to: {config.output_dir}")
         
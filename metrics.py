@@ -0,0 +1,260 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "gemini_batch"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGES = (
+    "discovery",
+    "hashing",
+    "perceptual_hashing",
+    "preprocessing",
+    "circuit_breaker_wait",
+    "rate_limit_wait",
+    "concurrency_wait",
+    "api_call",
+    "backoff_sleep",
+    "archive_write",
+)
+
+# Token kinds reported by the API, by their usage_metadata field
+TOKEN_FIELDS = (
+    ("prompt", "prompt_token_count"),
+    ("response", "candidates_token_count"),
+    ("cached", "cached_content_token_count"),
+    ("total", "total_token_count"),
+)
+
+# Per-image stage durations for the image currently being handled by this task
+current_image_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "current_image_timings", default=None
+)
+
+# Per-image token usage, summed over every attempt, for the image handled by this task
+current_image_tokens: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar(
+    "current_image_tokens", default=None
+)
+
+class Histogram:
+    """Cumulative-bucket histogram in the OpenMetrics style."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.min = value if self.count == 0 else min(self.min, value)
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by linear interpolation within the bucket that contains it.
+
+        Bucket bounds are narrowed to the observed minimum and maximum, so a
+        bucket holding every observation does not report its upper bound.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        running = 0
+        lower = 0.0
+        for upper, bucket_count in zip(self.buckets + (self.max,), self.counts):
+            if bucket_count and running + bucket_count >= rank:
+                low, high = max(lower, self.min), min(upper, self.max)
+                return low + (high - low) * max(0.0, rank - running) / bucket_count
+            running += bucket_count
+            lower = upper
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "total_seconds": round(self.sum, 4),
+            "mean_seconds": round(self.sum / self.count, 4) if self.count else 0.0,
+            "p50_seconds": round(self.quantile(0.5), 4),
+            "p95_seconds": round(self.quantile(0.95), 4),
+            "max_seconds": round(self.max, 4)
+        }
+
+class MetricsRegistry:
+    """
+    Hot-path timing histograms, in-flight gauges and error counters.
+
+    Everything is updated from the event loop thread; the lock only guards
+    against readers such as the metrics endpoint rendering mid-update.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_histograms: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        self.gauges: Dict[str, float] = {"images_in_progress": 0, "api_calls_in_flight": 0}
+        self.gauge_callbacks: Dict[str, Callable[[], float]] = {}
+        self.error_counts: Dict[str, int] = {}
+        self.image_counts: Dict[str, int] = {}
+        self.token_counts: Dict[str, int] = {kind: 0 for kind, _ in TOKEN_FIELDS}
+        self.responses_with_usage = 0
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        """Time a block and record it globally and against the current image."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    def observe_stage(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self.stage_histograms.get(stage)
+            if histogram is None:
+                histogram = self.stage_histograms[stage] = Histogram()
+            histogram.observe(seconds)
+        timings = current_image_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+    def add_gauge(self, name: str, delta: float):
+        with self._lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def register_gauge_callback(self, name: str, callback: Callable[[], float]):
+        """Register a gauge whose value is read when metrics are rendered."""
+        self.gauge_callbacks[name] = callback
+
+    def count_error(self, category: str):
+        with self._lock:
+            self.error_counts[category] = self.error_counts.get(category, 0) + 1
+
+    def count_image(self, status: str):
+        with self._lock:
+            self.image_counts[status] = self.image_counts.get(status, 0) + 1
+
+    def count_tokens(self, usage: Any):
+        """Add a response's usage_metadata to the totals and to the current image."""
+        counts = {kind: int(getattr(usage, field, 0) or 0) for kind, field in TOKEN_FIELDS}
+        with self._lock:
+            for kind, count in counts.items():
+                self.token_counts[kind] += count
+            self.responses_with_usage += 1
+        image_tokens = current_image_tokens.get()
+        if image_tokens is not None:
+            for kind, count in counts.items():
+                image_tokens[kind] = image_tokens.get(kind, 0) + count
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Summaries for processing_stats.json."""
+        with self._lock:
+            return {
+                "stage_timings": {
+                    stage: histogram.summary()
+                    for stage, histogram in self.stage_histograms.items() if histogram.count
+                },
+                "errors_by_category": dict(self.error_counts),
+                "tokens": {**self.token_counts, "responses": self.responses_with_usage}
+            }
+
+    def render_openmetrics(self) -> str:
+        """Render all metrics in the OpenMetrics text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            name = f"{METRIC_PREFIX}_stage_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            lines.append(f"# HELP {name} Time spent per pipeline stage.")
+            for stage, histogram in self.stage_histograms.items():
+                running = 0
+                for upper, bucket_count in zip(histogram.buckets, histogram.counts):
+                    running += bucket_count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{upper}"}} {running}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+
+            name = f"{METRIC_PREFIX}_in_progress"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"# HELP {name} Work currently in flight.")
+            gauges = dict(self.gauges)
+            for gauge_name, callback in self.gauge_callbacks.items():
+                gauges[gauge_name] = callback()
+            for gauge_name, value in gauges.items():
+                lines.append(f'{name}{{kind="{gauge_name}"}} {value}')
+
+            name = f"{METRIC_PREFIX}_errors"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"# HELP {name} Failed attempts by error category.")
+            for category, count in self.error_counts.items():
+                lines.append(f'{name}_total{{category="{category}"}} {count}')
+
+            name = f"{METRIC_PREFIX}_images"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"# HELP {name} Images finished by outcome.")
+            for status, count in self.image_counts.items():
+                lines.append(f'{name}_total{{status="{status}"}} {count}')
+
+            name = f"{METRIC_PREFIX}_tokens"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"# HELP {name} Tokens reported by the API; cached tokens are part of prompt tokens.")
+            for kind, count in self.token_counts.items():
+                lines.append(f'{name}_total{{kind="{kind}"}} {count}')
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    """Serves ``/metrics`` in OpenMetrics text format from the running event loop."""
+
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "0.0.0.0"):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self._runner = None
+
+    async def start(self):
+        # Only loaded when the endpoint is enabled
+        from aiohttp import web
+
+        async def handle_metrics(request: web.Request) -> web.Response:
+            return web.Response(
+                body=self.registry.render_openmetrics().encode("utf-8"),
+                headers={"Content-Type": self.CONTENT_TYPE}
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Metrics available at http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+class TimingLog:
+    """Appends one JSON line per image with its per-stage timings."""
+
+    def __init__(self, path):
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record: Dict[str, Any]):
+        self._file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self._file.close()
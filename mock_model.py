@@ -0,0 +1,210 @@
+import json
+import logging
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from transport import ApiError, CachedContent
+
+logger = logging.getLogger(__name__)
+
+ERROR_MESSAGES = {
+    400: "Request contains an invalid argument.",
+    429: "Resource has been exhausted (e.g. check quota).",
+    500: "An internal error has occurred.",
+    503: "The model is overloaded. Please try again later.",
+}
+
+@dataclass
+class MockBehavior:
+    """
+    Latency and failure profile for the mock model and mock server.
+
+    ``latency_distribution`` is ``fixed``, ``uniform`` (mean +/- spread) or
+    ``lognormal`` (median ``latency_mean``, sigma ``latency_spread``).
+    ``rate_limit_rate`` is the probability of a 429; ``error_rate`` the
+    probability of another error, with the status drawn from ``error_mix``.
+    """
+    latency_distribution: str = "fixed"
+    latency_mean: float = 0.0
+    latency_spread: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 1.0
+    error_rate: float = 0.0
+    error_mix: Dict[int, float] = field(default_factory=lambda: {500: 0.5, 503: 0.5})
+    seed: Optional[int] = None
+
+    def __post_init__(self):
+        self._rng = random.Random(self.seed)
+
+    def sample_latency(self) -> float:
+        if self.latency_distribution == "uniform":
+            return max(0.0, self._rng.uniform(self.latency_mean - self.latency_spread,
+                                              self.latency_mean + self.latency_spread))
+        if self.latency_distribution == "lognormal" and self.latency_mean > 0:
+            return self._rng.lognormvariate(0.0, self.latency_spread) * self.latency_mean
+        return self.latency_mean
+
+    def sample_failure(self) -> Optional[Tuple[int, str]]:
+        """Return (status, message) for a simulated failure, or None for success."""
+        roll = self._rng.random()
+        if roll < self.rate_limit_rate:
+            return 429, ERROR_MESSAGES[429]
+        if roll < self.rate_limit_rate + self.error_rate:
+            statuses = list(self.error_mix)
+            status = self._rng.choices(statuses, weights=[self.error_mix[s] for s in statuses])[0]
+            return status, ERROR_MESSAGES.get(status, "Simulated error")
+        return None
+
+def parse_error_mix(value: str) -> Dict[int, float]:
+    """Parse an error mix such as ``"500=0.5,503=0.3,400=0.2"``."""
+    mix = {}
+    for item in value.split(","):
+        if item.strip():
+            status, weight = item.split("=")
+            mix[int(status)] = float(weight)
+    return mix
+
+def build_mock_answer(prompt: str, images: List[Dict[str, Any]]) -> str:
+    """Deterministic answer describing the images received."""
+    answers = [
+        f"Mock response for image {i + 1} ({image.get('mime_type', 'unknown')}, {len(image['data'])} bytes)"
+        for i, image in enumerate(images)
+    ]
+    if len(images) > 1 and re.search(r"json array", prompt, re.IGNORECASE):
+        return json.dumps([{"index": i + 1, "result": answer} for i, answer in enumerate(answers)])
+    return "\n".join(answers) or f"Mock response to: {prompt}"
+
+def estimate_mock_tokens(prompt: str, images: List[Dict[str, Any]], text: str) -> Tuple[int, int]:
+    """Rough token estimate in the same ballpark as the real API (258 tokens per image)."""
+    return len(prompt.split()) + 258 * len(images), len(text.split())
+
+@dataclass
+class MockUsageMetadata:
+    """Token counts in the shape of the SDK's usage_metadata."""
+    prompt_token_count: int
+    candidates_token_count: int
+    total_token_count: int
+    cached_content_token_count: int = 0
+
+# Returned by the API for a request naming an unknown or expired cache
+CACHE_NOT_FOUND_MESSAGE = "CachedContent not found (or permission denied)"
+
+class MockCacheStore:
+    """
+    In-memory stand-in for the API's ``cachedContents``, used by the mock model and the mock server.
+
+    Entries expire after their TTL like real caches, so refreshing can be exercised.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, Tuple[int, float]] = {}
+        self._next_id = 0
+        self.created = 0
+
+    def create(self, prompt: str, images: List[Dict[str, Any]], ttl_seconds: float) -> Tuple[str, int]:
+        """Store a prefix; returns its name and token count."""
+        token_count, _ = estimate_mock_tokens(prompt, images, "")
+        self._next_id += 1
+        self.created += 1
+        name = f"cachedContents/mock-{self._next_id}"
+        self._entries[name] = (token_count, time.time() + ttl_seconds)
+        return name, token_count
+
+    def token_count(self, name: str) -> Optional[int]:
+        """Tokens of a live cache, or None if it is unknown or expired."""
+        entry = self._entries.get(name)
+        if entry is None or entry[1] <= time.time():
+            self._entries.pop(name, None)
+            return None
+        return entry[0]
+
+    def delete(self, name: str):
+        self._entries.pop(name, None)
+
+def split_contents(contents: List[Any]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Prompt text and image parts of SDK-style contents."""
+    prompt = " ".join(part for part in contents if isinstance(part, str))
+    images = [part for part in contents if isinstance(part, dict) and "data" in part]
+    return prompt, images
+
+@dataclass
+class MockResponse:
+    """Minimal stand-in for a ``GenerateContentResponse``."""
+    text: str
+    usage_metadata: MockUsageMetadata
+
+class MockGenerativeModel:
+    """
+    Offline stand-in for ``genai.GenerativeModel``.
+
+    Answers every request locally with a deterministic description of the
+    images it received. When several images arrive in one request and the
+    prompt asks for a JSON array, it answers in that structured form, so
+    packed requests can be exercised without network access or quota.
+    An optional ``MockBehavior`` adds latency and simulated API errors.
+    A model bound to a ``cached_content`` in a ``MockCacheStore`` counts
+    the cached prefix as cached prompt tokens, like the real API.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "mock-model",
+        behavior: Optional[MockBehavior] = None,
+        cached_content: Optional[str] = None,
+        cache_store: Optional[MockCacheStore] = None
+    ):
+        self.model_name = model_name
+        self.behavior = behavior or MockBehavior()
+        self.cached_content = cached_content
+        self.cache_store = cache_store
+        self.calls = 0
+
+    def generate_content(self, contents: List[Any], **kwargs) -> MockResponse:
+        self.calls += 1
+        latency = self.behavior.sample_latency()
+        if latency > 0:
+            time.sleep(latency)
+
+        failure = self.behavior.sample_failure()
+        if failure is not None:
+            status, message = failure
+            retry_after = self.behavior.retry_after if status == 429 else None
+            raise ApiError(status, message, retry_after)
+
+        cached_tokens = 0
+        if self.cached_content is not None:
+            cached_tokens = self.cache_store.token_count(self.cached_content)
+            if cached_tokens is None:
+                raise ApiError(403, CACHE_NOT_FOUND_MESSAGE)
+
+        prompt, images = split_contents(contents)
+        text = build_mock_answer(prompt, images)
+        prompt_tokens, response_tokens = estimate_mock_tokens(prompt, images, text)
+        prompt_tokens += cached_tokens
+        return MockResponse(
+            text=text,
+            usage_metadata=MockUsageMetadata(
+                prompt_tokens, response_tokens, prompt_tokens + response_tokens, cached_tokens
+            )
+        )
+
+class MockCacheClient:
+    """Context caching for the mock model, with the interface of ``GenaiCacheClient``."""
+
+    def __init__(self, model: MockGenerativeModel):
+        self.model = model
+        self.store = MockCacheStore()
+
+    def create(self, contents: List[Any], ttl_seconds: float) -> Tuple[CachedContent, MockGenerativeModel]:
+        prompt, images = split_contents(contents)
+        name, token_count = self.store.create(prompt, images, ttl_seconds)
+        bound_model = MockGenerativeModel(
+            self.model.model_name, self.model.behavior, cached_content=name, cache_store=self.store
+        )
+        return CachedContent(name, token_count, time.time() + ttl_seconds), bound_model
+
+    def delete(self, name: str):
+        self.store.delete(name)
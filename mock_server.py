@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Gemini generateContent REST endpoint.
+
+Usage:
+    python mock_server.py --port 8765 --latency-mean 0.5 --latency-distribution lognormal --rate-limit-rate 0.05
+
+Point the processor at it with ``--transport rest --api-base-url http://127.0.0.1:8765``.
+Context caches can be created under ``/v1beta/cachedContents`` and named in requests.
+"""
+
+import argparse
+import asyncio
+import base64
+import logging
+from typing import Any, Dict, List, Tuple
+
+from aiohttp import web
+
+from mock_model import (
+    CACHE_NOT_FOUND_MESSAGE, MockBehavior, MockCacheStore, build_mock_answer, estimate_mock_tokens, parse_error_mix
+)
+
+logger = logging.getLogger(__name__)
+
+# Request counters of a running mock server, for tests that hold the application
+STATS_KEY = web.AppKey("stats", dict)
+
+def _error_response(status: int, message: str, retry_after: float = None) -> web.Response:
+    error: Dict[str, Any] = {"code": status, "message": message}
+    headers = {}
+    if retry_after is not None:
+        error["details"] = [{
+            "@type": "type.googleapis.com/google.rpc.RetryInfo",
+            "retryDelay": f"{retry_after}s"
+        }]
+        headers["Retry-After"] = str(retry_after)
+    return web.json_response({"error": error}, status=status, headers=headers)
+
+def _parse_parts(parts: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+    prompt = " ".join(part["text"] for part in parts if "text" in part)
+    images = [
+        {"mime_type": part["inline_data"]["mime_type"], "data": base64.b64decode(part["inline_data"]["data"])}
+        for part in parts if "inline_data" in part
+    ]
+    return prompt, images
+
+def create_app(behavior: MockBehavior) -> web.Application:
+    """Build an aiohttp application serving ``/v1beta/models/{model}:generateContent`` and ``cachedContents``."""
+    stats = {"requests": 0, "rate_limited": 0, "errors": 0, "caches_created": 0}
+    cache_store = MockCacheStore()
+
+    async def generate_content(request: web.Request) -> web.Response:
+        stats["requests"] += 1
+        try:
+            body = await request.json()
+            parts = body["contents"][0]["parts"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            stats["errors"] += 1
+            return _error_response(400, "Invalid JSON payload received.")
+
+        await asyncio.sleep(behavior.sample_latency())
+
+        failure = behavior.sample_failure()
+        if failure is not None:
+            status, message = failure
+            if status == 429:
+                stats["rate_limited"] += 1
+                return _error_response(status, message, behavior.retry_after)
+            stats["errors"] += 1
+            return _error_response(status, message)
+
+        cached_tokens = 0
+        if body.get("cachedContent"):
+            cached_tokens = cache_store.token_count(body["cachedContent"])
+            if cached_tokens is None:
+                stats["errors"] += 1
+                return _error_response(403, CACHE_NOT_FOUND_MESSAGE)
+
+        prompt, images = _parse_parts(parts)
+        text = build_mock_answer(prompt, images)
+        prompt_tokens, response_tokens = estimate_mock_tokens(prompt, images, text)
+        prompt_tokens += cached_tokens
+        return web.json_response({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": response_tokens,
+                "totalTokenCount": prompt_tokens + response_tokens,
+                "cachedContentTokenCount": cached_tokens
+            }
+        })
+
+    async def create_cached_content(request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+            parts = body["contents"][0]["parts"]
+            ttl_seconds = float(body.get("ttl", "3600s").rstrip("s"))
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+            return _error_response(400, "Invalid JSON payload received.")
+        prompt, images = _parse_parts(parts)
+        name, token_count = cache_store.create(prompt, images, ttl_seconds)
+        stats["caches_created"] += 1
+        return web.json_response({
+            "name": name,
+            "model": body.get("model", ""),
+            "usageMetadata": {"totalTokenCount": token_count}
+        })
+
+    async def delete_cached_content(request: web.Request) -> web.Response:
+        cache_store.delete(f"cachedContents/{request.match_info['cache_id']}")
+        return web.json_response({})
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app[STATS_KEY] = stats
+    app.router.add_post("/v1beta/models/{model}", generate_content)
+    app.router.add_post("/v1beta/cachedContents", create_cached_content)
+    app.router.add_delete("/v1beta/cachedContents/{cache_id}", delete_cached_content)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+async def start_mock_server(behavior: MockBehavior, host: str = "127.0.0.1", port: int = 0) -> Tuple[web.AppRunner, str]:
+    """Start the mock server in the running loop; returns the runner and its base URL."""
+    runner = web.AppRunner(create_app(behavior), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = runner.addresses[0][1]
+    return runner, f"http://{host}:{bound_port}"
+
+def add_behavior_arguments(parser: argparse.ArgumentParser):
+    """Register the command line options that describe a MockBehavior."""
+    parser.add_argument('--latency-distribution', choices=['fixed', 'uniform', 'lognormal'], default='fixed',
+                        help='Shape of simulated request latency')
+    parser.add_argument('--latency-mean', type=float, default=0.2, help='Mean (or median for lognormal) latency in seconds')
+    parser.add_argument('--latency-spread', type=float, default=0.0, help='Uniform half-width or lognormal sigma')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry delay advertised on 429 responses')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failing with another error')
+    parser.add_argument('--error-mix', default='500=0.5,503=0.5', help='Status weights for simulated errors')
+    parser.add_argument('--seed', type=int, help='Random seed for reproducible runs')
+
+def behavior_from_args(args) -> MockBehavior:
+    return MockBehavior(
+        latency_distribution=args.latency_distribution,
+        latency_mean=args.latency_mean,
+        latency_spread=args.latency_spread,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        error_rate=args.error_rate,
+        error_mix=parse_error_mix(args.error_mix),
+        seed=args.seed
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Gemini generateContent server')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.info(f"Mock Gemini server listening on http://{args.host}:{args.port}")
+    web.run_app(create_app(behavior_from_args(args)), host=args.host, port=args.port, print=None, access_log=None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Formats Gemini accepts as-is; anything else is re-encoded
+NATIVE_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+OUTPUT_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "png": ("PNG", "image/png"),
+}
+
+class WorkerCrashedError(RuntimeError):
+    """A preprocessing worker died twice on the same image, e.g. killed for running out of memory."""
+
+@dataclass
+class PreparedImage:
+    """Encoded image bytes ready to upload."""
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    original_size: int
+
+def prepare_image(image_path: str, max_edge: int = 0, output_format: str = "original", quality: int = 85) -> PreparedImage:
+    """
+    Decode an image once, optionally downscale it, and encode it for upload.
+
+    Runs in a worker process. The full decode doubles as validation. With the
+    default settings a natively supported image is passed through byte for byte.
+    """
+    # Imported here so that starting the CLI does not load Pillow; worker processes import it once
+    from PIL import Image
+
+    with open(image_path, 'rb') as f:
+        raw = f.read()
+
+    try:
+        img = Image.open(io.BytesIO(raw))
+        img.load()
+    except Exception:
+        raise ValueError(f"Invalid or unsupported image format: {image_path}")
+
+    with img:
+        source_format = img.format
+        needs_resize = max_edge > 0 and max(img.size) > max_edge
+
+        if output_format == "original":
+            if not needs_resize and source_format in NATIVE_MIME_TYPES:
+                return PreparedImage(raw, NATIVE_MIME_TYPES[source_format], img.width, img.height, len(raw))
+            target = source_format.lower() if source_format in NATIVE_MIME_TYPES else "png"
+        else:
+            target = output_format
+        pil_format, mime_type = OUTPUT_FORMATS[target]
+
+        if needs_resize:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        if pil_format == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA")
+
+        buffer = io.BytesIO()
+        save_kwargs = {"quality": quality} if pil_format in ("JPEG", "WEBP") else {"optimize": True}
+        img.save(buffer, format=pil_format, **save_kwargs)
+        return PreparedImage(buffer.getvalue(), mime_type, img.width, img.height, len(raw))
+
+class ImagePreprocessor:
+    """
+    Runs image preparation in a process pool, off the event loop thread.
+
+    Decoding and re-encoding large photos is CPU bound, so it is kept out of
+    both the event loop and the thread pool used for blocking API calls.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, max_edge: int = 0,
+                 output_format: str = "original", quality: int = 85):
+        if output_format != "original" and output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format: {output_format}")
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_edge = max_edge
+        self.output_format = output_format
+        self.quality = quality
+        self._executor = None
+        self.pool_restarts = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Created lazily so dry runs and cache-only runs never spawn processes
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def prepare(self, image_path: str) -> PreparedImage:
+        """Prepare an image for upload in the process pool."""
+        return await self.run(prepare_image, image_path, self.max_edge, self.output_format, self.quality)
+
+    async def run(self, func, *args):
+        """
+        Run a CPU-bound, picklable image function in the process pool.
+
+        A worker that dies (an OOM kill on a huge image) breaks the whole
+        pool, failing every task in it. The pool is then replaced and the
+        task tried once more; if it breaks the pool again, it is given up
+        with ``WorkerCrashedError``, which is not retried.
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                return await loop.run_in_executor(executor, func, *args)
+            except BrokenProcessPool as e:
+                # Every task of the broken pool ends up here; only the first replaces it
+                if self._executor is executor:
+                    self._executor = None
+                    self.pool_restarts += 1
+                    executor.shutdown(wait=False)
+                    logger.warning("A preprocessing worker died, restarting the process pool")
+                if attempt:
+                    raise WorkerCrashedError(f"Preprocessing worker died twice: {str(e)}") from e
+    
+    def close(self):
+        """Shut down the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
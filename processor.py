@@ -1,155 +1,881 @@
 import asyncio
 import os
 import logging
+import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from PIL import Image
-import google.generativeai as genai
-from google.generativeai.types import GenerationConfig
+from typing import Awaitable, Callable, Iterable, List, Dict, Any, Optional, Tuple
+from tqdm import tqdm
 
 from config import Config
-from retry_handler import RetryHandler
-from prompt_optimizer import PromptOptimizer
+from retry_handler import BREAKER_CLOSED, ERROR_CONTENT_SAFETY, RetryHandler, classify_error
+from prompt_optimizer import PROMPT_ERROR_CATEGORIES, VARIANT_BASE, PromptOptimizer
 from archiver import Archiver
+from preprocessor import ImagePreprocessor
+from ledger import Ledger, hash_file
+from response_cache import ResponseCache
+from rate_limiter import SharedRateLimiter, default_state_file
+from mock_model import MockCacheClient, MockGenerativeModel
+from transport import (
+    ContentBlockedError, EmptyResponseError, GenaiCacheClient, RestTransport, SdkTransport, is_cache_not_found
+)
+from routing import RoutingPool
+from metrics import MetricsRegistry, MetricsServer, TimingLog, current_image_timings, current_image_tokens
+from context_cache import SharedContext, load_context_parts
+from dedup import Deduplicator
+from scheduling import ORDER_DISCOVERY, RequestHedger, order_by_cost
+from request_packing import build_packed_prompt, image_label, parse_packed_response
+from concurrency import (
+    AdaptiveConcurrencyLimiter, OUTCOME_CANCELLED, OUTCOME_ERROR, OUTCOME_OVERLOAD, OUTCOME_SUCCESS, is_overload_error
+)
 
 logger = logging.getLogger(__name__)
 
+# Bounded queue depth per worker; keeps discovery only slightly ahead of processing
+QUEUE_DEPTH_PER_WORKER = 2
+
+MODEL_NAME = 'gemini-1.5-pro'
+
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+@dataclass
+class ImageResult:
+    """Outcome of processing a single image."""
+    text: Optional[str]
+    prompt: str
+    attempts: int
+    error: Optional[str] = None
+    route: Optional[str] = None  # routing pool route that answered, when routing
+    tokens: Optional[Dict[str, int]] = None  # overrides the tokens counted for the current image
+
 class GeminiBatchProcessor:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, work_queue=None):
         self.config = config
-        self.retry_handler = RetryHandler(config.max_retries)
+        # In distributed mode, finished images are reported back to the shared queue
+        self.work_queue = work_queue
         self.prompt_optimizer = PromptOptimizer()
-        self.archiver = Archiver(config.output_dir, config.archive_format)
+        self.archiver = Archiver(
+            config.output_dir,
+            config.archive_format,
+            result_sink=config.result_sink,
+            shard_max_mb=config.result_shard_mb,
+            archive_codec=config.archive_codec
+        )
+        self.metrics = MetricsRegistry()
+        self.retry_handler = RetryHandler(
+            config.max_retries,
+            budget_ratio=config.retry_budget_ratio,
+            breaker_threshold=config.circuit_breaker_threshold,
+            breaker_timeout=config.circuit_breaker_timeout,
+            sleep=self._backoff_sleep
+        )
+        self.metrics_server = None
+        self._progress = None
+        self._timing_log = None
+        # Dry runs make no API calls, so they must not mark anything as completed
+        self.ledger = None if config.dry_run else Ledger(config.output_dir)
+        self.response_cache = None
+        if config.cache_dir and not config.dry_run:
+            self.response_cache = ResponseCache(config.cache_dir, config.cache_max_mb * 1024 * 1024)
+        
+        # The worker pool is sized to the ceiling; the limiter decides how many call the API at once
+        if config.adaptive_concurrency:
+            self.concurrency_limiter = AdaptiveConcurrencyLimiter(
+                config.min_concurrent_requests, config.max_concurrent_requests
+            )
+        else:
+            self.concurrency_limiter = AdaptiveConcurrencyLimiter(
+                config.max_concurrent_requests, config.max_concurrent_requests
+            )
+        
+        self.preprocessor = ImagePreprocessor(
+            max_workers=config.preprocess_workers,
+            max_edge=config.max_image_edge,
+            output_format=config.upload_format,
+            quality=config.upload_quality
+        )
+        self.hedger = None
+        if config.hedge_requests:
+            self.hedger = RequestHedger(config.hedge_quantile, config.hedge_max_ratio)
+        self.deduplicator = None
+        if config.dedup:
+            self.deduplicator = Deduplicator(self.preprocessor, config.dedup_method, config.dedup_max_distance)
+        # Members whose representative failed are processed on their own in these tasks
+        self._duplicate_tasks = set()
+        self._base_prompt = None
+        # Accumulated over every call to process_images, so a watch daemon reports running totals
+        self._counters = {
+            "total": 0, "successful": 0, "failed": 0, "skipped": 0,
+            "packed_requests": 0, "packed_images": 0, "pack_fallbacks": 0, "duplicate_copies": 0
+        }
+        self.rate_limiter = SharedRateLimiter(
+            config.rate_limit_state_file or default_state_file(config.gemini_api_key),
+            rpm_limit=config.rpm_limit,
+            tpm_limit=config.tpm_limit
+        )
         
         # Configure Gemini API
-        genai.configure(api_key=config.gemini_api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-pro')
+        self.model_name = MODEL_NAME
+        self.router = None
+        if config.dry_run:
+            # Dry runs never call the model, so no client (and no SDK import) is needed
+            self.model = None
+            self.transport = None
+        elif config.routes_file:
+            # Each route brings its own key, transport and rate limits
+            self.router = RoutingPool.from_file(
+                config.routes_file,
+                connection_limit=config.http_connection_limit,
+                timeout=config.request_timeout
+            )
+            self.model_name = self.router.primary_model
+            self.model = None
+            self.transport = None
+        elif config.model_backend == "mock":
+            self.model = MockGenerativeModel(self.model_name)
+            self.transport = SdkTransport(self.model, cache_client=MockCacheClient(self.model))
+        elif config.transport == "rest":
+            self.model = None
+            self.transport = RestTransport(
+                config.gemini_api_key,
+                self.model_name,
+                base_url=config.api_base_url,
+                connection_limit=config.http_connection_limit,
+                timeout=config.request_timeout
+            )
+        else:
+            # The SDK takes about a second to import, so only the SDK transport pays for it
+            import google.generativeai as genai
+            genai.configure(api_key=config.gemini_api_key)
+            self.model = genai.GenerativeModel(self.model_name)
+            self.transport = SdkTransport(self.model, cache_client=GenaiCacheClient(self.model_name))
+        
+        self.shared_context = None
+        if config.context_file or config.context_images:
+            self.shared_context = SharedContext(
+                load_context_parts(config.context_file, config.context_images),
+                # A cache belongs to one key and model, so routed requests carry the context inline
+                transport=None if self.router else self.transport,
+                mode=config.context_cache,
+                ttl_seconds=config.context_cache_ttl
+            )
+    
+    async def process_image_batch(self, image_paths: Iterable[str], base_prompt: str) -> Dict[str, Any]:
+        """Process a batch of images through a bounded producer/consumer pipeline.
+
+        Paths are pulled lazily from ``image_paths`` into a bounded queue that a
+        fixed pool of workers drains. Each result is handed to the archiver as
+        soon as it completes, so memory use depends on the concurrency level
+        rather than on the size of the batch.
+        """
+        await self.process_images(image_paths, base_prompt)
+        return await self.finish()
     
-    async def process_image_batch(self, image_paths: List[str], base_prompt: str) -> Dict[str, Any]:
-        """Process a batch of images concurrently."""
-        semaphore = asyncio.Semaphore(self.config.max_concurrent_requests)
-        tasks = []
+    async def process_images(self, image_paths: Iterable[str], base_prompt: str):
+        """
+        Run the pipeline over ``image_paths`` without finishing the run.
         
-        for image_path in image_paths:
-            task = self._process_single_image_with_semaphore(
-                image_path, base_prompt, semaphore
+        May be called repeatedly, e.g. once per micro-batch in watch mode; the
+        model client, connections and worker processes stay warm in between.
+        """
+        worker_count = max(1, self.config.max_concurrent_requests)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=worker_count * QUEUE_DEPTH_PER_WORKER)
+        counters = self._counters
+        self._base_prompt = base_prompt
+        
+        if self.config.metrics_port and self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics, self.config.metrics_port)
+            await self.metrics_server.start()
+        self.metrics.register_gauge_callback("queued_images", queue.qsize)
+        if self.config.schedule_order != ORDER_DISCOVERY:
+            image_paths = order_by_cost(
+                image_paths, self.config.schedule_order, self.config.schedule_cost, self.config.schedule_window
             )
-            tasks.append(task)
-        
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Process results
-        successful_count = 0
-        failed_count = 0
-        total_processed = len(results)
-        
-        for i, result in enumerate(results):
-            image_name = Path(image_paths[i]).stem
-            if isinstance(result, Exception):
-                logger.error(f"Failed to process {image_name}: {str(result)}")
-                self.archiver.save_failed_result(image_name, str(result))
-                failed_count += 1
-            elif result is None:
-                logger.warning(f"Processing returned None for {image_name}")
-                self.archiver.save_failed_result(image_name, "Processing returned None")
-                failed_count += 1
-            else:
-                self.archiver.save_successful_result(image_name, result)
-                successful_count += 1
+        self._timing_log = TimingLog(self.archiver.metadata_dir / "image_timings.jsonl")
+        # Total grows as discovery proceeds, so the ETA firms up once the tree has been walked
+        self._progress = tqdm(total=0, unit="img", desc="Processing", disable=not self.config.show_progress)
+        
+        producer = asyncio.create_task(self._produce_image_paths(image_paths, queue, worker_count))
+        workers = [
+            asyncio.create_task(self._worker(queue, base_prompt, counters))
+            for _ in range(worker_count)
+        ]
+        
+        try:
+            # Gathered together: if a worker dies, the error surfaces at once and the producer is
+            # cancelled below, instead of waiting forever for room in a queue nobody drains
+            await asyncio.gather(producer, *workers)
+            while self._duplicate_tasks:
+                await asyncio.gather(*list(self._duplicate_tasks))
+        finally:
+            for task in [producer, *workers]:
+                if not task.done():
+                    task.cancel()
+            self._progress.close()
+            self._timing_log.close()
+    
+    async def finish(self, extra_stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Flush the results, write the final stats and create the archive."""
+        # Wait for queued result records to be fsynced; their ledger updates run meanwhile
+        await asyncio.get_running_loop().run_in_executor(None, self.archiver.close)
+        if self.hedger:
+            # Losing copies are billed too; count them before the totals are written
+            await self.hedger.wait_abandoned()
+        stats = self.save_stats(extra_stats)
         
-        # Save statistics
+        # Create archive if requested
+        if self.config.archive_format != "none":
+            self.archiver.create_archive()
+        
+        return stats
+    
+    def save_stats(self, extra_stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Write the statistics so far, and the prompt evolution data, to the metadata directory."""
+        counters = self._counters
+        total_processed = counters["total"]
+        successful_count = counters["successful"]
         stats = {
             "total_images": total_processed,
             "successful": successful_count,
-            "failed": failed_count,
+            "failed": counters["failed"],
+            "skipped_completed": counters["skipped"],
             "success_rate": successful_count / total_processed if total_processed > 0 else 0,
             "max_concurrent_requests": self.config.max_concurrent_requests,
-            "max_retries": self.config.max_retries
+            "max_retries": self.config.max_retries,
+            "resume": self.config.resume
         }
+        if self.config.images_per_request > 1:
+            stats["request_packing"] = {
+                "images_per_request": self.config.images_per_request,
+                "packed_requests": counters["packed_requests"],
+                "packed_images": counters["packed_images"],
+                "fallback_images": counters["pack_fallbacks"]
+            }
+        if self.hedger:
+            stats["hedging"] = self.hedger.get_stats()
+        if self.deduplicator:
+            stats["dedup"] = {**self.deduplicator.get_stats(), "results_copied": counters["duplicate_copies"]}
+            self.archiver.save_duplicate_groups(self.deduplicator.get_groups())
+        if self.ledger:
+            stats["ledger"] = self.ledger.get_summary()
+        if self.response_cache:
+            stats["response_cache"] = self.response_cache.get_stats()
+        if self.archiver.result_sink:
+            stats["result_sink"] = self.archiver.result_sink.get_stats()
+        if self.rate_limiter.enabled:
+            stats["rate_limiter"] = self.rate_limiter.get_stats()
+        if self.router:
+            stats["routing"] = self.router.get_stats()
+        if self.concurrency_limiter.adaptive:
+            stats["adaptive_concurrency"] = self.concurrency_limiter.get_stats()
+        if self.shared_context:
+            stats["context_cache"] = self.shared_context.get_stats()
+        if self.preprocessor.pool_restarts:
+            stats["preprocess_pool_restarts"] = self.preprocessor.pool_restarts
+        stats["retry"] = self.retry_handler.get_stats()
+        stats.update(self.metrics.get_stats())
+        if total_processed:
+            stats["tokens"]["average_per_image"] = round(stats["tokens"]["total"] / total_processed, 1)
+        stats.update(extra_stats or {})
         self.archiver.save_processing_stats(stats)
         
         # Save prompt evolution data
         evolution_stats = self.prompt_optimizer.get_evolution_stats()
         self.archiver.save_prompt_evolution(evolution_stats)
         
-        # Create archive if requested
-        if self.config.archive_format != "none":
-            self.archiver.create_archive()
-        
         return stats
     
-    async def _process_single_image_with_semaphore(
-        self, 
-        image_path: str, 
-        base_prompt: str, 
-        semaphore: asyncio.Semaphore
-    ) -> Optional[str]:
-        """Process single image with semaphore control."""
-        async with semaphore:
-            return await self._process_single_image(image_path, base_prompt)
-    
-    async def _process_single_image(self, image_path: str, base_prompt: str) -> Optional[str]:
-        """Process a single image with retry and prompt optimization."""
-        current_prompt = base_prompt
-        original_prompt = base_prompt
+    async def _produce_image_paths(self, image_paths: Iterable[str], queue: asyncio.Queue, worker_count: int):
+        """Feed image paths into the work queue, then one stop marker per worker."""
+        loop = asyncio.get_running_loop()
+        iterator = iter(image_paths)
+        while True:
+            # Discovery may hit the filesystem, so advance it off the event loop
+            with self.metrics.time_stage("discovery"):
+                image_path = await loop.run_in_executor(None, next, iterator, None)
+            if image_path is None:
+                break
+            self._progress.total += 1
+            await queue.put(image_path)
+        # Only on success; after an error the workers are cancelled rather than stopped
+        for _ in range(worker_count):
+            await queue.put(None)
+    
+    async def _worker(self, queue: asyncio.Queue, base_prompt: str, counters: Dict[str, int]):
+        """Consume image paths from the queue until a stop marker is received."""
+        pack_size = 1 if self.config.dry_run else max(1, self.config.images_per_request)
+        while True:
+            image_path = await queue.get()
+            if image_path is None:
+                return
+            if pack_size == 1:
+                await self._handle_image(image_path, base_prompt, counters)
+                continue
+            
+            # Fill a pack only from what is already queued, so the tail of a batch isn't delayed
+            group = [image_path]
+            stop = False
+            while len(group) < pack_size and not queue.empty():
+                next_path = queue.get_nowait()
+                if next_path is None:
+                    stop = True
+                    break
+                group.append(next_path)
+            await self._handle_image_group(group, base_prompt, counters)
+            if stop:
+                return
+    
+    async def _handle_image(self, image_path: str, base_prompt: str, counters: Dict[str, int]):
+        """Process one image and immediately write its outcome through the archiver."""
+        current_image_timings.set({})
+        self.metrics.add_gauge("images_in_progress", 1)
+        try:
+            should_process, content_hash = await self._claim_image(image_path, counters)
+            if not should_process:
+                return
+            if await self._route_duplicate(image_path, content_hash, counters):
+                return
+            await self._process_and_record(image_path, base_prompt, content_hash, counters)
+        finally:
+            self.metrics.add_gauge("images_in_progress", -1)
+    
+    async def _process_and_record(
+        self,
+        image_path: str,
+        base_prompt: str,
+        content_hash: Optional[str],
+        counters: Dict[str, int]
+    ):
+        start_time = time.monotonic()
+        # Fresh even for a duplicate's task, which inherits its representative's context
+        current_image_tokens.set({})
+        try:
+            result = await self._process_single_image(image_path, base_prompt, content_hash)
+        except Exception as e:
+            result = ImageResult(text=None, prompt=base_prompt, attempts=1, error=str(e))
+        self._record_result(image_path, content_hash, result, time.monotonic() - start_time, counters)
+    
+    async def _handle_image_group(self, image_paths: List[str], base_prompt: str, counters: Dict[str, int]):
+        """Process several images in one packed request, falling back to single requests."""
+        # Stages of a packed request are shared by every image in it
+        current_image_timings.set({})
+        current_image_tokens.set({})
+        self.metrics.add_gauge("images_in_progress", len(image_paths))
+        try:
+            await self._process_image_group(image_paths, base_prompt, counters)
+        finally:
+            self.metrics.add_gauge("images_in_progress", -len(image_paths))
+    
+    async def _process_image_group(self, image_paths: List[str], base_prompt: str, counters: Dict[str, int]):
+        start_time = time.monotonic()
+        claimed = []
+        for image_path in image_paths:
+            should_process, content_hash = await self._claim_image(image_path, counters)
+            if should_process and not await self._route_duplicate(image_path, content_hash, counters):
+                claimed.append((image_path, content_hash))
         
-        for attempt in range(self.config.max_retries + 1):
+        pending = []
+        for image_path, content_hash in claimed:
+            cached = await self._lookup_cache(content_hash, base_prompt)
+            if cached is not None:
+                logger.info(f"Cache hit for {Path(image_path).name}")
+                result = ImageResult(cached, base_prompt, 1)
+                self._record_result(image_path, content_hash, result, time.monotonic() - start_time, counters)
+            else:
+                pending.append((image_path, content_hash))
+        
+        answers, route = {}, None
+        if len(pending) > 1:
+            answers, route = await self._process_packed_request(
+                [path for path, _ in pending], base_prompt, counters
+            )
+        # The packed request's tokens are split evenly over the images it answered
+        pack_tokens = current_image_tokens.get() or {}
+        token_share = {kind: count // max(1, len(answers)) for kind, count in pack_tokens.items()}
+        
+        fallback = []
+        for image_path, content_hash in pending:
+            if image_path in answers:
+                await self._store_cache(content_hash, base_prompt, answers[image_path], route)
+                result = ImageResult(answers[image_path], base_prompt, 1, route=route, tokens=token_share)
+                self._record_result(image_path, content_hash, result, time.monotonic() - start_time, counters)
+            else:
+                fallback.append((image_path, content_hash))
+        
+        if len(pending) > 1:
+            counters["pack_fallbacks"] += len(fallback)
+        
+        async def process_alone(image_path: str, content_hash: Optional[str]):
+            # Runs as its own task, so its retries get a private copy of the shared timings
+            current_image_timings.set(dict(current_image_timings.get() or {}))
+            current_image_tokens.set({})
             try:
-                if self.config.dry_run:
-                    logger.info(f"[DRY RUN] Would process {image_path} with prompt: {current_prompt}")
-                    return f"[DRY RUN] Result for {Path(image_path).name}"
-                
-                # Validate image
-                if not self._validate_image(image_path):
-                    raise ValueError(f"Invalid or unsupported image format: {image_path}")
-                
-                # Check file size (Gemini has 20MB limit)
-                if os.path.getsize(image_path) > 20 * 1024 * 1024:
-                    raise ValueError(f"Image too large (>20MB): {image_path}")
-                
-                # Process with Gemini
-                image = Image.open(image_path)
-                response = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: self.model.generate_content([current_prompt, image])
-                )
-                
-                if response.text:
-                    logger.info(f"Successfully processed {Path(image_path).name}")
-                    return response.text
-                else:
-                    raise ValueError("Empty response from Gemini API")
-                    
+                result = await self._process_single_image(image_path, base_prompt, content_hash)
             except Exception as e:
-                error_msg = str(e)
-                logger.warning(f"Attempt {attempt + 1} failed for {Path(image_path).name}: {error_msg}")
-                
-                if attempt < self.config.max_retries:
-                    # Optimize prompt for next attempt
-                    if self.config.enable_prompt_optimization:
-                        failure_analysis = self.prompt_optimizer.analyze_failure(current_prompt, error_msg)
-                        optimized_prompt = self.prompt_optimizer.optimize_prompt(current_prompt, failure_analysis)
-                        self.prompt_optimizer.record_prompt_evolution(
-                            Path(image_path).name, current_prompt, optimized_prompt
-                        )
-                        current_prompt = optimized_prompt
-                    
-                    # Wait before retry (exponential backoff handled by retry_handler)
-                    await asyncio.sleep(min(1.0 * (2 ** attempt), 30.0))
-                else:
-                    logger.error(f"Max retries exceeded for {Path(image_path).name}")
-                    return None
-        
-        return None
-    
-    def _validate_image(self, image_path: str) -> bool:
-        """Validate if the file is a supported image format."""
+                result = ImageResult(text=None, prompt=base_prompt, attempts=1, error=str(e))
+            self._record_result(image_path, content_hash, result, time.monotonic() - start_time, counters)
+        
+        await asyncio.gather(*(process_alone(path, content_hash) for path, content_hash in fallback))
+    
+    async def _process_packed_request(
+        self,
+        image_paths: List[str],
+        base_prompt: str,
+        counters: Dict[str, int]
+    ) -> Tuple[Dict[str, str], Optional[str]]:
+        """Send several images in one request; returns the answers that could be split out and the route used."""
+        with self.metrics.time_stage("preprocessing"):
+            prepared_results = await asyncio.gather(
+                *(self.preprocessor.prepare(path) for path in image_paths), return_exceptions=True
+            )
+        # Images that fail to prepare are left to the single-image path, which reports the error
+        packable = [
+            (path, prepared) for path, prepared in zip(image_paths, prepared_results)
+            if not isinstance(prepared, BaseException)
+        ]
+        if len(packable) < 2:
+            return {}, None
+        if sum(len(prepared.data) for _, prepared in packable) > MAX_UPLOAD_BYTES:
+            logger.info("Packed request would exceed the upload limit, falling back to single requests")
+            return {}, None
+        image_paths = [path for path, _ in packable]
+        prepared_images = [prepared for _, prepared in packable]
+        
+        contents = [build_packed_prompt(base_prompt, len(image_paths))]
+        for index, prepared in enumerate(prepared_images, start=1):
+            contents.append(image_label(index))
+            contents.append({"mime_type": prepared.mime_type, "data": prepared.data})
+        
+        counters["packed_requests"] += 1
         try:
-            with Image.open(image_path) as img:
-                img.verify()
-            return True
-        except Exception:
+            response, route = await self._call_model(
+                contents, self.config.estimated_tokens_per_request * len(image_paths)
+            )
+            answers = parse_packed_response(self._response_text(response), len(image_paths))
+        except Exception as e:
+            logger.warning(f"Packed request for {len(image_paths)} images failed: {str(e)}")
+            self.metrics.count_error(classify_error(e).category)
+            return {}, None
+        
+        counters["packed_images"] += len(answers)
+        if len(answers) < len(image_paths):
+            logger.warning(
+                f"Packed response answered {len(answers)}/{len(image_paths)} images, "
+                f"retrying the rest individually"
+            )
+        return {image_paths[index - 1]: text for index, text in answers.items()}, route
+    
+    async def _claim_image(self, image_path: str, counters: Dict[str, int]) -> Tuple[bool, Optional[str]]:
+        """Hash an image and consult the ledger; returns (should_process, content_hash)."""
+        image_name = Path(image_path).stem
+        content_hash = None
+        
+        if self.ledger or self.response_cache:
+            try:
+                with self.metrics.time_stage("hashing"):
+                    content_hash = await asyncio.get_running_loop().run_in_executor(None, hash_file, image_path)
+            except OSError as e:
+                logger.warning(f"Could not hash {image_name}: {str(e)}")
+            
+            if self.ledger and content_hash is not None:
+                ledger_key = os.path.abspath(image_path)
+                if self.config.resume and self.ledger.is_completed(ledger_key, content_hash):
+                    logger.debug(f"Skipping already completed image {image_name}")
+                    counters["skipped"] += 1
+                    self._progress.update(1)
+                    if self.work_queue:
+                        self.work_queue.complete(image_path, True)
+                    return False, content_hash
+                self.ledger.mark_pending(ledger_key, content_hash)
+        
+        counters["total"] += 1
+        return True, content_hash
+    
+    async def _route_duplicate(self, image_path: str, content_hash: Optional[str], counters: Dict[str, int]) -> bool:
+        """Attach a near-duplicate to its representative; True if it needs no request of its own."""
+        if not self.deduplicator:
             return False
+        with self.metrics.time_stage("perceptual_hashing"):
+            representative = await self.deduplicator.assign(image_path)
+        if representative is None:
+            return False
+        
+        logger.debug(f"{Path(image_path).name} is a near-duplicate of {Path(representative).name}")
+        if self.deduplicator.is_in_flight(representative):
+            self.deduplicator.wait_for(representative, image_path, content_hash)
+            return True
+        result = self.deduplicator.result_for(representative)
+        if result is not None and result.text is not None:
+            self._record_duplicate(image_path, content_hash, result, counters)
+            return True
+        # The representative failed (or its result was forgotten), so ask the model directly
+        return False
+    
+    def _record_duplicate(
+        self,
+        image_path: str,
+        content_hash: Optional[str],
+        representative_result: ImageResult,
+        counters: Dict[str, int]
+    ):
+        counters["duplicate_copies"] += 1
+        result = ImageResult(
+            representative_result.text, representative_result.prompt, attempts=0,
+            route=representative_result.route, tokens={}
+        )
+        self._record_result(image_path, content_hash, result, 0.0, counters)
+    
+    def _release_duplicates(self, image_path: str, result: ImageResult, counters: Dict[str, int]):
+        """Hand a representative's outcome to the members waiting for it."""
+        for member_path, member_hash in self.deduplicator.complete(image_path, result):
+            if result.text is not None:
+                self._record_duplicate(member_path, member_hash, result, counters)
+                continue
+            task = asyncio.ensure_future(
+                self._process_and_record(member_path, self._base_prompt, member_hash, counters)
+            )
+            self._duplicate_tasks.add(task)
+            task.add_done_callback(self._duplicate_tasks.discard)
+    
+    def _record_result(
+        self,
+        image_path: str,
+        content_hash: Optional[str],
+        result: ImageResult,
+        latency: float,
+        counters: Dict[str, int]
+    ):
+        """Write one image's outcome through the archiver, then record it in the ledger."""
+        image_name = Path(image_path).stem
+        ledger_key = os.path.abspath(image_path)
+        stages = {stage: round(seconds, 4) for stage, seconds in (current_image_timings.get() or {}).items()}
+        tokens = result.tokens if result.tokens is not None else dict(current_image_tokens.get() or {})
+        
+        # Sharded sinks keep the full record; the per-file layout stays as before
+        metadata = None
+        if self.archiver.result_sink:
+            metadata = {
+                "path": image_path,
+                "prompt": result.prompt,
+                "attempts": result.attempts,
+                "total_seconds": round(latency, 4),
+                "route": result.route,
+                "tokens": tokens,
+                "stages": stages
+            }
+        
+        # The ledger is only updated once the result is on disk, so --resume never skips a lost result
+        if result.text is None:
+            status = "failed"
+            error_message = result.error or "Processing returned None"
+            logger.error(f"Failed to process {image_name}: {error_message}")
+            ledger_update = None
+            if self.ledger and content_hash is not None:
+                ledger_update = lambda: self.ledger.record_failure(
+                    ledger_key, content_hash, result.attempts, latency, error_message
+                )
+            on_saved = self._on_result_saved(image_path, False, ledger_update)
+            with self.metrics.time_stage("archive_write"):
+                self.archiver.save_failed_result(image_name, error_message, metadata, on_saved)
+            counters["failed"] += 1
+        else:
+            status = "successful"
+            ledger_update = None
+            if self.ledger and content_hash is not None:
+                ledger_update = lambda: self.ledger.record_success(
+                    ledger_key, content_hash, result.attempts, latency, result.prompt
+                )
+            on_saved = self._on_result_saved(image_path, True, ledger_update)
+            with self.metrics.time_stage("archive_write"):
+                self.archiver.save_successful_result(image_name, result.text, metadata, on_saved)
+            counters["successful"] += 1
+        
+        self.metrics.count_image(status)
+        self._progress.update(1)
+        self._timing_log.write({
+            "image": image_name,
+            "path": image_path,
+            "status": status,
+            "attempts": result.attempts,
+            "total_seconds": round(latency, 4),
+            "route": result.route,
+            "tokens": tokens,
+            "stages": stages
+        })
+        
+        if self.deduplicator:
+            self._release_duplicates(image_path, result, counters)
+    
+    def _on_result_saved(
+        self,
+        image_path: str,
+        succeeded: bool,
+        ledger_update: Optional[Callable[[], Any]]
+    ) -> Optional[Callable[[], Any]]:
+        """Callback for once a result is on disk: update the ledger and the shared work queue."""
+        if not self.work_queue:
+            return ledger_update
+        
+        def on_saved():
+            if ledger_update:
+                ledger_update()
+            self.work_queue.complete(image_path, succeeded)
+        return on_saved
+    
+    def _cache_scope(self, model_name: str) -> str:
+        """Everything besides image and prompt that shapes an answer: model, preprocessing and shared context."""
+        scope = (
+            f"{model_name}|edge={self.config.max_image_edge}|format={self.config.upload_format}"
+            f"|quality={self.config.upload_quality}"
+        )
+        if self.shared_context:
+            scope += f"|context={self.shared_context.digest}"
+        return scope
+    
+    async def _lookup_cache(self, content_hash: Optional[str], prompt: str) -> Optional[str]:
+        """Return a cached response for this image and prompt, if any."""
+        if not self.response_cache or content_hash is None:
+            return None
+        # With routing, an answer from any of the routes' models will do, preferred models first
+        models = self.router.models if self.router else [self.model_name]
+        cache_keys = [ResponseCache.make_key(content_hash, prompt, self._cache_scope(model)) for model in models]
+        return await asyncio.get_running_loop().run_in_executor(None, self.response_cache.get_any, cache_keys)
+    
+    async def _store_cache(self, content_hash: Optional[str], prompt: str, result: str, route: Optional[str] = None):
+        """Store a response for this image and prompt under the model that gave it."""
+        if not self.response_cache or content_hash is None:
+            return
+        model_name = self.router.model_for(route) if self.router and route else self.model_name
+        cache_key = ResponseCache.make_key(content_hash, prompt, self._cache_scope(model_name))
+        await asyncio.get_running_loop().run_in_executor(None, self.response_cache.put, cache_key, result)
+    
+    async def _call_model(self, contents: List[Any], estimated_tokens: int) -> Tuple[Any, Optional[str]]:
+        """
+        Call the model under the circuit breaker, the shared rate limiter and the concurrency limiter.
+        
+        Returns the response and the name of the route that answered (None without routing).
+        """
+        # The shared context is referenced by cache name when it could be cached, else prepended
+        cached_content = None
+        if self.shared_context:
+            contents, cached_content = await self.shared_context.build(contents)
+        probe = None
+        try:
+            # During an outage every worker waits here instead of hammering the API
+            with self.metrics.time_stage("circuit_breaker_wait"):
+                probe = await self.retry_handler.circuit_breaker.before_call()
+            # Wait for a shared RPM/TPM permit before taking a concurrency slot; routes have their own
+            if not self.router:
+                with self.metrics.time_stage("rate_limit_wait"):
+                    await self.rate_limiter.acquire(estimated_tokens)
+            with self.metrics.time_stage("concurrency_wait"):
+                started_at = await self.concurrency_limiter.acquire()
+            with self.metrics.time_stage("api_call"):
+                if self.hedger:
+                    return await self.hedger.run(
+                        lambda: self._send_in_slot(started_at, contents, estimated_tokens, cached_content),
+                        start_hedge=lambda: self._start_hedge(contents, estimated_tokens, cached_content)
+                    )
+                return await self._send_in_slot(started_at, contents, estimated_tokens, cached_content)
+        finally:
+            await self.retry_handler.circuit_breaker.release_probe(probe)
+            if self.shared_context:
+                await self.shared_context.release(cached_content)
+    
+    async def _send_in_slot(
+        self,
+        started_at: float,
+        contents: List[Any],
+        estimated_tokens: int,
+        cached_content: Optional[str] = None
+    ) -> Tuple[Any, Optional[str]]:
+        """
+        Make one API call in a concurrency slot the caller has taken.
+        
+        The slot is released and the outcome and token usage recorded when the
+        call ends, also for a hedged copy that lost and finished in the background.
+        """
+        self.metrics.add_gauge("api_calls_in_flight", 1)
+        try:
+            response, route = await self._send(contents, estimated_tokens, cached_content)
+        except asyncio.CancelledError:
+            await self.concurrency_limiter.release(started_at, OUTCOME_CANCELLED)
+            raise
+        except Exception as e:
+            outcome = OUTCOME_OVERLOAD if is_overload_error(e) else OUTCOME_ERROR
+            await self.concurrency_limiter.release(started_at, outcome)
+            await self.retry_handler.record_call_result(e)
+            raise
+        finally:
+            self.metrics.add_gauge("api_calls_in_flight", -1)
+        await self.concurrency_limiter.release(started_at, OUTCOME_SUCCESS)
+        await self.retry_handler.record_call_result()
+        
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            # Counted before the text is checked; blocked answers are billed too
+            self.metrics.count_tokens(usage)
+        if not self.router and usage is not None and getattr(usage, "total_token_count", 0):
+            self.rate_limiter.reconcile_tokens(estimated_tokens, usage.total_token_count)
+        return response, route
+    
+    async def _send(
+        self,
+        contents: List[Any],
+        estimated_tokens: int,
+        cached_content: Optional[str] = None
+    ) -> Tuple[Any, Optional[str]]:
+        if self.router:
+            return await self.router.generate_content(contents, estimated_tokens)
+        try:
+            return await self.transport.generate_content(contents, cached_content=cached_content), None
+        except Exception as e:
+            if cached_content is not None and is_cache_not_found(e):
+                # The retry builds its request against a new cache
+                self.shared_context.invalidate(cached_content)
+            raise
+    
+    async def _start_hedge(
+        self,
+        contents: List[Any],
+        estimated_tokens: int,
+        cached_content: Optional[str]
+    ) -> Optional[Awaitable[Tuple[Any, Optional[str]]]]:
+        """
+        Take a concurrency slot and a rate limit permit for a hedge, or return None.
+        
+        A hedge is only worth sending if it needs no waiting for the breaker, a
+        slot or the rate limit; it then counts against all of them like any call.
+        """
+        if self.retry_handler.circuit_breaker.state != BREAKER_CLOSED:
+            return None
+        if self.router and not self.router.has_capacity():
+            return None
+        started_at = self.concurrency_limiter.try_acquire()
+        if started_at is None:
+            return None
+        if not self.router and self.rate_limiter.enabled and await self.rate_limiter.request_permit(estimated_tokens) > 0:
+            await self.concurrency_limiter.release(started_at, OUTCOME_CANCELLED)
+            return None
+        return self._send_in_slot(started_at, contents, estimated_tokens, cached_content)
+    
+    @staticmethod
+    def _response_text(response: Any) -> str:
+        """Extract the response text, raising typed errors for blocked or empty answers."""
+        try:
+            text = response.text
+        except ValueError as e:
+            # The SDK's text accessor raises when the candidate was blocked
+            raise ContentBlockedError(str(e)) from e
+        if not text:
+            raise EmptyResponseError("Empty response from Gemini API")
+        return text
+    
+    async def _backoff_sleep(self, delay: float):
+        with self.metrics.time_stage("backoff_sleep"):
+            await asyncio.sleep(delay)
+    
+    async def _process_single_image(
+        self,
+        image_path: str,
+        base_prompt: str,
+        content_hash: Optional[str] = None
+    ) -> ImageResult:
+        """Process a single image with retry and prompt optimization."""
+        image_name = Path(image_path).name
+        prepared = None
+        attempts = 0
+        
+        if self.config.dry_run:
+            logger.info(f"[DRY RUN] Would process {image_path} with prompt: {base_prompt}")
+            return ImageResult(f"[DRY RUN] Result for {image_name}", base_prompt, 1)
+        
+        # Start with the variant that has worked best across the batch so far
+        variant = VARIANT_BASE
+        if self.config.enable_prompt_optimization:
+            variant = self.prompt_optimizer.select_variant()
+        current_prompt = self.prompt_optimizer.apply_variant(base_prompt, variant)
+        last_error_type = None
+        route = None
+        looked_up_prompt = None
+        
+        async def attempt() -> str:
+            nonlocal prepared, attempts, route, looked_up_prompt
+            attempts += 1
+            
+            # Identical image bytes, prompt and model were answered before. A retry with the
+            # same prompt cannot hit where the first attempt missed, so it is not looked up again
+            if current_prompt != looked_up_prompt:
+                looked_up_prompt = current_prompt
+                cached = await self._lookup_cache(content_hash, current_prompt)
+                if cached is not None:
+                    logger.info(f"Cache hit for {image_name}")
+                    return cached
+            
+            # Decode, validate and encode once; the bytes are reused across retries
+            if prepared is None:
+                with self.metrics.time_stage("preprocessing"):
+                    prepared = await self.preprocessor.prepare(image_path)
+            
+            # Check upload size (Gemini has 20MB limit)
+            if len(prepared.data) > MAX_UPLOAD_BYTES:
+                raise ValueError(f"Image too large (>20MB): {image_path}")
+            
+            # Process with Gemini
+            image_part = {"mime_type": prepared.mime_type, "data": prepared.data}
+            response, route = await self._call_model(
+                [current_prompt, image_part], self.config.estimated_tokens_per_request
+            )
+            text = self._response_text(response)
+            logger.info(f"Successfully processed {image_name}")
+            self.prompt_optimizer.record_outcome(variant, after_error=last_error_type)
+            await self._store_cache(content_hash, current_prompt, text, route)
+            return text
+        
+        def on_retry(error: Exception, classification):
+            nonlocal current_prompt, variant, last_error_type
+            self.metrics.count_error(classification.category)
+            self.prompt_optimizer.record_outcome(variant, classification.category, after_error=last_error_type)
+            last_error_type = classification.category
+            # Rewrite the prompt only for failures its wording can cause
+            if self.config.enable_prompt_optimization and classification.category in PROMPT_ERROR_CATEGORIES:
+                failure_analysis = self.prompt_optimizer.analyze_failure(
+                    current_prompt, str(error), classification.category
+                )
+                variant = self.prompt_optimizer.next_variant(variant, failure_analysis)
+                current_prompt = self.prompt_optimizer.apply_variant(base_prompt, variant)
+        
+        # A blocked answer is worth retrying only with a rewritten prompt
+        retry_categories = (ERROR_CONTENT_SAFETY,) if self.config.enable_prompt_optimization else ()
+        try:
+            text = await self.retry_handler.execute_with_retry(
+                attempt, retry_categories=retry_categories, on_retry=on_retry
+            )
+        except Exception as e:
+            category = classify_error(e).category
+            self.metrics.count_error(category)
+            self.prompt_optimizer.record_outcome(variant, category, after_error=last_error_type)
+            logger.error(f"Giving up on {image_name} after {attempts} attempt(s): {str(e)}")
+            return ImageResult(None, current_prompt, attempts, error=str(e), route=route)
+        return ImageResult(text, current_prompt, attempts, route=route)
+    
+    async def close(self):
+        """Release worker processes, network connections and the ledger."""
+        self.preprocessor.close()
+        # As in finish(): off the loop, so the ledger updates of the last fsynced records run before it closes
+        await asyncio.get_running_loop().run_in_executor(None, self.archiver.close)
+        if self.hedger:
+            await self.hedger.close()
+        if self.shared_context:
+            await self.shared_context.close()
+        if self.router:
+            await self.router.close()
+        elif self.transport:
+            await self.transport.close()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        if self.ledger:
+            self.ledger.close()
     
     def get_supported_formats(self) -> List[str]:
         """Get list of supported image formats."""
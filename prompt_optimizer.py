@@ -1,40 +1,129 @@
-import json
 import logging
-from typing import Dict, List, Optional
+import random
+from typing import Callable, Dict, Optional
+
+from retry_handler import ERROR_CONTENT_SAFETY, ERROR_EMPTY_RESPONSE, ERROR_OTHER
 
 logger = logging.getLogger(__name__)
 
-class PromptOptimizer:
+VARIANT_BASE = "base"
+
+# Every variant is one rewrite of the batch prompt, so the set of arms stays fixed
+PROMPT_VARIANTS: Dict[str, Callable[[str], str]] = {
+    VARIANT_BASE: lambda prompt: prompt,
+    "safe_for_work": lambda prompt: f"{prompt}, safe for work",
+    "more_specific": lambda prompt: f"detailed {prompt}",
+    "style": lambda prompt: f"{prompt}, anime style illustration",
+    "shortened": lambda prompt: " ".join(prompt.split()[:20]),
+    "quality": lambda prompt: f"{prompt}, high quality, detailed",
+}
+
+# Variants that may be used on an image's first attempt. The others change what is
+# asked for (a different style, more detail), so they are only retry rewrites.
+UP_FRONT_VARIANTS = frozenset({VARIANT_BASE, "safe_for_work"})
+
+# Failures the wording of the prompt can cause; outages and bad images say nothing about a variant
+PROMPT_ERROR_CATEGORIES = frozenset({ERROR_CONTENT_SAFETY, ERROR_EMPTY_RESPONSE, ERROR_OTHER})
+
+# Attempts a variant needs before it may be chosen for an image's first attempt
+MIN_OBSERVATIONS = 5
+
+class _Arm:
+    """Success/failure counts of one prompt variant."""
+    
+    __slots__ = ("successes", "failures")
+    
     def __init__(self):
-        self.failure_patterns = {}
-        self.prompt_evolution_history = {}
+        self.successes = 0
+        self.failures = 0
+    
+    @property
+    def trials(self) -> int:
+        return self.successes + self.failures
+    
+    def sample(self, rng: random.Random) -> float:
+        # Thompson sampling from the Beta posterior with a uniform prior
+        return rng.betavariate(self.successes + 1, self.failures + 1)
+    
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "attempts": self.trials,
+            "successes": self.successes,
+            "success_rate": self.successes / self.trials if self.trials else None
+        }
+
+class PromptOptimizer:
+    """
+    Learns across the batch which prompt variant to use.
+    
+    Outcomes are counted per variant for every attempt, and per (error
+    category, variant) for the retry that follows a failure. New images
+    start with the variant that Thompson sampling favors among those tried
+    at least ``min_observations`` times, so when a rewrite reliably fixes a
+    common failure it is used up front. Only rewrites that leave the task
+    unchanged (``UP_FRONT_VARIANTS``) are used up front. After a failure the next variant is
+    chosen from the rewrites suggested for that category, again by sampling
+    the recovery counts. All history is kept as these bounded counters.
+    """
+    
+    def __init__(self, min_observations: int = MIN_OBSERVATIONS, seed: Optional[int] = None):
+        self.min_observations = min_observations
+        self._rng = random.Random(seed)
+        self.arms: Dict[str, _Arm] = {name: _Arm() for name in PROMPT_VARIANTS}
+        self.recoveries: Dict[str, Dict[str, _Arm]] = {}
+        self.selected_up_front: Dict[str, int] = {}
+        self.rewrites: Dict[str, int] = {}
+        self.total_optimizations = 0
+    
+    def select_variant(self) -> str:
+        """Variant for an image's first attempt."""
+        candidates = [
+            name for name, arm in self.arms.items()
+            if name == VARIANT_BASE or (name in UP_FRONT_VARIANTS and arm.trials >= self.min_observations)
+        ]
+        variant = max(candidates, key=lambda name: self.arms[name].sample(self._rng))
+        self.selected_up_front[variant] = self.selected_up_front.get(variant, 0) + 1
+        return variant
     
-    def analyze_failure(self, original_prompt: str, error_message: str) -> Dict[str, any]:
+    def analyze_failure(
+        self,
+        original_prompt: str,
+        error_message: str,
+        error_type: Optional[str] = None
+    ) -> Dict[str, any]:
         """
         Analyze failure patterns and suggest prompt modifications.
+        
+        ``error_type`` is the category assigned by the retry engine; without it
+        the category is guessed from the message. ``candidate_variants`` lists
+        the matching rewrites in order of preference.
         """
         analysis = {
             "original_prompt": original_prompt,
-            "error_type": self._categorize_error(error_message),
-            "suggested_modifications": []
+            "error_type": error_type or self._categorize_error(error_message),
+            "suggested_modifications": [],
+            "candidate_variants": []
         }
         
         # Common failure patterns and solutions
-        if "content safety" in error_message.lower():
+        if analysis["error_type"] == ERROR_CONTENT_SAFETY or "content safety" in error_message.lower():
             analysis["suggested_modifications"].extend([
                 "Add 'safe for work' to the prompt",
                 "Make the description more specific and less ambiguous",
                 "Avoid potentially sensitive topics"
             ])
+            analysis["candidate_variants"].extend(["safe_for_work", "more_specific"])
         elif "prompt too long" in error_message.lower():
             analysis["suggested_modifications"].append(
                 "Shorten the prompt to be more concise"
             )
+            analysis["candidate_variants"].append("shortened")
         elif "invalid image" in error_message.lower():
             analysis["suggested_modifications"].extend([
                 "Specify image format requirements",
                 "Add 'clear, high-quality image' to prompt"
             ])
+            analysis["candidate_variants"].append("quality")
         else:
             # Generic optimizations
             analysis["suggested_modifications"].extend([
@@ -42,34 +131,52 @@ class PromptOptimizer:
                 "Add style descriptors (e.g., 'anime style', 'cartoon')",
                 "Include technical terms (e.g., 'high resolution', 'detailed')"
             ])
+            analysis["candidate_variants"].extend(["more_specific", "style", "quality"])
         
         return analysis
     
-    def optimize_prompt(self, original_prompt: str, failure_analysis: Dict[str, any]) -> str:
-        """
-        Generate an optimized prompt based on failure analysis.
-        """
-        if not failure_analysis["suggested_modifications"]:
-            return original_prompt
-        
-        # Apply the first suggested modification
-        modification = failure_analysis["suggested_modifications"][0]
+    def next_variant(self, current_variant: str, failure_analysis: Dict[str, any]) -> str:
+        """Pick the rewrite to retry with after a failure."""
+        category = failure_analysis["error_type"]
+        candidates = [name for name in failure_analysis["candidate_variants"] if name != current_variant]
+        if not candidates:
+            return current_variant
         
-        if "safe for work" in modification:
-            optimized = f"{original_prompt}, safe for work"
-        elif "more specific" in modification:
-            optimized = f"detailed {original_prompt}"
-        elif "anime style" in modification:
-            optimized = f"{original_prompt}, anime style illustration"
-        elif "shorten" in modification:
-            # Simple truncation for now
-            words = original_prompt.split()
-            optimized = " ".join(words[:20]) if len(words) > 20 else original_prompt
+        recoveries = self.recoveries.setdefault(category, {})
+        # Try each suggestion once, in order, before trusting the counts
+        untried = [name for name in candidates if name not in recoveries]
+        if untried:
+            variant = untried[0]
         else:
-            optimized = f"{original_prompt}, high quality, detailed"
+            variant = max(candidates, key=lambda name: recoveries[name].sample(self._rng))
         
-        logger.info(f"Prompt optimized: '{original_prompt}' -> '{optimized}'")
-        return optimized
+        transition = f"{current_variant}->{variant}"
+        self.rewrites[transition] = self.rewrites.get(transition, 0) + 1
+        self.total_optimizations += 1
+        logger.info(f"Prompt optimized after {category}: {current_variant} -> {variant}")
+        return variant
+    
+    @staticmethod
+    def apply_variant(base_prompt: str, variant: str) -> str:
+        return PROMPT_VARIANTS[variant](base_prompt)
+    
+    def record_outcome(self, variant: str, error_type: Optional[str] = None, after_error: Optional[str] = None):
+        """
+        Count one attempt with ``variant``; ``error_type`` is None on success.
+        
+        ``after_error`` is the category of the failure this attempt retried, if
+        any. Other errors are ignored since they say nothing about the prompt.
+        """
+        if error_type is not None and error_type not in PROMPT_ERROR_CATEGORIES:
+            return
+        arms = [self.arms[variant]]
+        if after_error in PROMPT_ERROR_CATEGORIES:
+            arms.append(self.recoveries.setdefault(after_error, {}).setdefault(variant, _Arm()))
+        for arm in arms:
+            if error_type is None:
+                arm.successes += 1
+            else:
+                arm.failures += 1
     
     def _categorize_error(self, error_message: str) -> str:
         """Categorize error types for better handling."""
@@ -85,18 +192,15 @@ class PromptOptimizer:
         else:
             return "other"
     
-    def record_prompt_evolution(self, image_name: str, original_prompt: str, optimized_prompt: str):
-        """Record prompt evolution for tracking."""
-        if image_name not in self.prompt_evolution_history:
-            self.prompt_evolution_history[image_name] = []
-        self.prompt_evolution_history[image_name].append({
-            "original": original_prompt,
-            "optimized": optimized_prompt
-        })
-    
     def get_evolution_stats(self) -> Dict[str, any]:
         """Get statistics about prompt optimization."""
         return {
-            "total_optimizations": len(self.prompt_evolution_history),
-            "evolution_history": self.prompt_evolution_history
-        }
\ No newline at end of file
+            "total_optimizations": self.total_optimizations,
+            "variants": {name: arm.to_dict() for name, arm in self.arms.items() if arm.trials},
+            "selected_up_front": dict(self.selected_up_front),
+            "recoveries": {
+                category: {name: arm.to_dict() for name, arm in arms.items()}
+                for category, arms in self.recoveries.items()
+            },
+            "rewrites": dict(self.rewrites)
+        }
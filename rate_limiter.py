@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict
+
+try:
+    import fcntl
+except ImportError:  # Non-POSIX platforms only get in-process coordination
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on a single sleep so waiters notice capacity freed by other processes
+MAX_WAIT_SLICE = 5.0
+
+def default_state_file(api_key: str) -> str:
+    """Return a per-API-key state file so processes sharing a key share a budget."""
+    key_id = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"gemini-batch-ratelimit-{key_id}.json")
+
+class SharedRateLimiter:
+    """
+    Token-bucket limiter for requests and tokens per minute.
+
+    Bucket levels live in a small JSON file guarded by an exclusive ``flock``,
+    so every process on the host that points at the same file draws from one
+    budget. Callers wait for a permit instead of being rejected; a limit of 0
+    disables that bucket. From async code the file-locked section runs on the
+    limiter's own thread, so a contended ``flock`` never stalls the event loop.
+    """
+
+    def __init__(self, state_file: str, rpm_limit: int = 0, tpm_limit: int = 0):
+        self.state_file = Path(state_file)
+        self.lock_file = self.state_file.with_name(self.state_file.name + ".lock")
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self._thread_lock = threading.Lock()
+        # One thread: the locked section is serialised anyway, and API calls cannot crowd it out
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rate-limiter")
+        if fcntl is None:
+            logger.warning("fcntl unavailable; rate limits are enforced per process only")
+
+        self.permits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm_limit > 0 or self.tpm_limit > 0
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            with open(self.lock_file, 'a') as lock_handle:
+                if fcntl is not None:
+                    fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_handle.fileno(), fcntl.LOCK_UN)
+
+    def _load_state(self, now: float) -> Dict[str, float]:
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {"requests": float(self.rpm_limit), "tokens": float(self.tpm_limit), "updated": now}
+
+        # Refill both buckets for the time elapsed since the last writer
+        elapsed = max(0.0, now - state.get("updated", now))
+        state["requests"] = min(float(self.rpm_limit), state.get("requests", 0.0) + elapsed * self.rpm_limit / 60.0)
+        state["tokens"] = min(float(self.tpm_limit), state.get("tokens", 0.0) + elapsed * self.tpm_limit / 60.0)
+        state["updated"] = now
+        return state
+
+    def _save_state(self, state: Dict[str, float]):
+        tmp_path = self.state_file.with_name(self.state_file.name + f".{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_file)
+
+    def try_acquire(self, tokens: int) -> float:
+        """Take a permit if available; otherwise return the seconds to wait."""
+        with self._locked():
+            now = time.time()
+            state = self._load_state(now)
+            wait = 0.0
+            if self.rpm_limit > 0 and state["requests"] < 1.0:
+                wait = max(wait, (1.0 - state["requests"]) * 60.0 / self.rpm_limit)
+            if self.tpm_limit > 0:
+                # A request larger than the whole bucket can only ever wait for a full bucket
+                needed = min(float(tokens), float(self.tpm_limit))
+                if state["tokens"] < needed:
+                    wait = max(wait, (needed - state["tokens"]) * 60.0 / self.tpm_limit)
+            if wait == 0.0:
+                if self.rpm_limit > 0:
+                    state["requests"] -= 1.0
+                if self.tpm_limit > 0:
+                    state["tokens"] -= tokens
+            self._save_state(state)
+            return wait
+
+    async def request_permit(self, tokens: int) -> float:
+        """``try_acquire`` off the event loop thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.try_acquire, tokens)
+
+    async def acquire(self, tokens: int = 0) -> float:
+        """Wait until a request for ``tokens`` tokens fits in both buckets."""
+        if not self.enabled:
+            return 0.0
+        started = time.monotonic()
+        while True:
+            wait = await self.request_permit(tokens)
+            if wait == 0.0:
+                break
+            await asyncio.sleep(min(wait, MAX_WAIT_SLICE))
+
+        waited = time.monotonic() - started
+        self.permits += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def reconcile_tokens(self, estimated: int, actual: int):
+        """Correct the token bucket once a response reports its real usage; written in the background."""
+        if self.tpm_limit <= 0 or actual == estimated:
+            return
+        self._executor.submit(self._reconcile, estimated, actual)
+
+    def _reconcile(self, estimated: int, actual: int):
+        try:
+            with self._locked():
+                state = self._load_state(time.time())
+                state["tokens"] = min(float(self.tpm_limit), state["tokens"] + estimated - actual)
+                self._save_state(state)
+        except OSError as e:
+            logger.warning(f"Could not update rate limit state: {str(e)}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get permit and wait-time counters."""
+        return {
+            "rpm_limit": self.rpm_limit,
+            "tpm_limit": self.tpm_limit,
+            "state_file": str(self.state_file),
+            "permits": self.permits,
+            "total_wait_seconds": round(self.total_wait, 3),
+            "max_wait_seconds": round(self.max_wait, 3),
+            "average_wait_seconds": round(self.total_wait / self.permits, 3) if self.permits else 0
+        }
@@ -0,0 +1,65 @@
+import json
+import logging
+import re
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+PACKED_INSTRUCTION = (
+    "You will receive {count} images, labelled Image 1 to Image {count}. "
+    "Apply the following task to each image independently:\n\n{prompt}\n\n"
+    "Respond with only a JSON array of exactly {count} objects, one per image and in order, "
+    'each of the form {{"index": <image number>, "result": "<answer for that image>"}}. '
+    "Do not add any text outside the JSON array."
+)
+
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*(.*?)\s*```$", re.DOTALL)
+
+def build_packed_prompt(prompt: str, count: int) -> str:
+    """Wrap a per-image prompt in a structured-output instruction for several images."""
+    return PACKED_INSTRUCTION.format(prompt=prompt, count=count)
+
+def image_label(index: int) -> str:
+    """Text part placed before each image in a packed request."""
+    return f"Image {index}:"
+
+def parse_packed_response(text: str, count: int) -> Dict[int, str]:
+    """
+    Split a packed response into per-image answers.
+
+    Returns a mapping from 1-based image index to answer text. Entries that are
+    missing, duplicated, out of range or empty are left out so the caller can
+    fall back to single-image requests for exactly those images.
+    """
+    text = text.strip()
+    fenced = _CODE_FENCE.match(text)
+    if fenced:
+        text = fenced.group(1)
+
+    try:
+        items = json.loads(text)
+    except ValueError:
+        logger.debug("Packed response is not valid JSON")
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    answers = {}
+    duplicates = set()
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index = item.get("index")
+        result = item.get("result")
+        if not isinstance(index, int) or not 1 <= index <= count:
+            continue
+        if not isinstance(result, str) or not result.strip():
+            continue
+        if index in answers:
+            duplicates.add(index)
+        answers[index] = result
+
+    # An image answered twice is ambiguous; retry it on its own
+    for index in duplicates:
+        del answers[index]
+    return answers
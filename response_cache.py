@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# After eviction the cache is trimmed to this fraction of its limit, so a full
+# cache doesn't rescan the directory on every write
+EVICTION_TARGET_RATIO = 0.9
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of model responses.
+
+    Entries are keyed by a hash of the image bytes, the final prompt and a
+    scope: the model plus whatever else shapes the answer, such as
+    preprocessing settings. Writes go to a temporary file that is atomically renamed into
+    place, so concurrent workers and processes never observe partial entries.
+    Each hit refreshes the entry's mtime, and eviction removes the least
+    recently used entries once the cache grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size_bytes = sum(size for _, size, _ in self._scan_entries())
+
+    @staticmethod
+    def make_key(image_hash: str, prompt: str, scope: str) -> str:
+        """Build a cache key from image content hash, prompt and scope."""
+        digest = hashlib.sha256()
+        for part in (image_hash, prompt, scope):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        # Two-level fan-out keeps directories small on large caches
+        return self.cache_dir / key[:2] / f"{key}.txt"
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for a key, or None on a miss."""
+        return self.get_any([key])
+
+    def get_any(self, keys: List[str]) -> Optional[str]:
+        """Return the response stored under the first key that has one; counts as one lookup."""
+        for key in keys:
+            entry_path = self._entry_path(key)
+            try:
+                with open(entry_path, 'r', encoding='utf-8') as f:
+                    result = f.read()
+                os.utime(entry_path)
+            except (FileNotFoundError, OSError):
+                continue
+            with self._lock:
+                self.hits += 1
+            return result
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, result: str):
+        """Atomically store a response and evict old entries if over budget."""
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        data = result.encode('utf-8')
+
+        fd, tmp_path = tempfile.mkstemp(dir=entry_path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # An overwritten entry no longer counts towards the size
+            try:
+                replaced_size = entry_path.stat().st_size
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            self._size_bytes += len(data) - replaced_size
+            needs_eviction = self._size_bytes > self.max_bytes
+        if needs_eviction:
+            self._evict()
+
+    def _scan_entries(self):
+        """Yield (path, size, mtime) for every cache entry on disk."""
+        for entry_path in self.cache_dir.glob("*/*.txt"):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            yield entry_path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        """Remove least recently used entries until under the target size."""
+        # Rescan rather than trusting the running total: other processes may share the cache
+        entries = sorted(self._scan_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICTION_TARGET_RATIO
+        evicted = 0
+
+        for entry_path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                entry_path.unlink()
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        with self._lock:
+            self._size_bytes = total
+            self.evictions += evicted
+        if evicted:
+            logger.debug(f"Evicted {evicted} entries from response cache")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0,
+                "evictions": self.evictions,
+                "size_bytes": self._size_bytes,
+                "max_bytes": self.max_bytes
+            }
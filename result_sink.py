@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import re
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet shards are optional
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+SINK_FILES = "files"
+SINK_JSONL = "jsonl"
+SINK_PARQUET = "parquet"
+
+RESULTS_DIRNAME = "results"
+
+# Columns of a Parquet shard; per-stage timings are stored as a JSON string
+PARQUET_COLUMNS = (
+    ("image", "string"),
+    ("path", "string"),
+    ("status", "string"),
+    ("prompt", "string"),
+    ("response", "string"),
+    ("error", "string"),
+    ("attempts", "int32"),
+    ("total_seconds", "float64"),
+    ("route", "string"),
+    ("tokens", "string"),
+    ("stages", "string"),
+)
+
+def resolve_sink_format(requested: str) -> str:
+    """Return the sink format to use, falling back to JSONL when pyarrow is missing."""
+    if requested == SINK_PARQUET and pa is None:
+        logger.warning("pyarrow is not installed; writing JSONL result shards instead of Parquet")
+        return SINK_JSONL
+    return requested
+
+class _JsonlShard:
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, 'ab')
+
+    def write(self, records: List[Dict[str, Any]]):
+        self._file.write(b"".join(json.dumps(record).encode("utf-8") + b"\n" for record in records))
+
+    def sync(self) -> int:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+class _ParquetShard:
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in PARQUET_COLUMNS])
+        self._writer = pq.ParquetWriter(self._file, self._schema, compression="zstd")
+
+    def write(self, records: List[Dict[str, Any]]):
+        columns = {name: [] for name, _ in PARQUET_COLUMNS}
+        for record in records:
+            for name, _ in PARQUET_COLUMNS:
+                value = record.get(name)
+                if name in ("stages", "tokens") and value is not None:
+                    value = json.dumps(value)
+                columns[name].append(value)
+        # One row group per batch
+        self._writer.write_table(pa.table(columns, schema=self._schema))
+
+    def sync(self) -> int:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        # The footer is written on close; until then the shard is not readable
+        self._writer.close()
+        self._file.close()
+
+class ShardedResultSink:
+    """
+    Appends one record per image to size-rotated JSONL or Parquet shards.
+
+    Records are handed to a background thread that writes them in batches
+    and fsyncs each batch, so the event loop never touches the disk. A
+    callback given to ``write`` runs on the caller's event loop once the
+    record is durable. ``close`` drains the queue and finishes the current
+    shard; a later ``write`` starts a new one.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        sink_format: str = SINK_JSONL,
+        shard_max_bytes: int = 128 * 1024 * 1024,
+        batch_size: int = 1000,
+        flush_interval: float = 1.0
+    ):
+        self.results_dir = Path(output_dir) / RESULTS_DIRNAME
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self.sink_format = resolve_sink_format(sink_format)
+        self.shard_max_bytes = shard_max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue: "queue.Queue[Optional[Tuple[Dict[str, Any], Any, Optional[Callable]]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._shard = None
+        self.records_written = 0
+        self.shards: List[str] = []
+
+    @property
+    def extension(self) -> str:
+        return "parquet" if self.sink_format == SINK_PARQUET else "jsonl"
+
+    def write(self, record: Dict[str, Any], on_durable: Optional[Callable[[], Any]] = None):
+        """Queue a record; ``on_durable`` runs on the calling event loop after it is fsynced."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="result-sink", daemon=True)
+            self._thread.start()
+        self._queue.put((record, loop, on_durable))
+
+    def close(self):
+        """Flush everything queued so far and finish the current shard."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _next_shard_path(self) -> Path:
+        # Continue numbering after shards left by earlier runs into the same directory
+        pattern = re.compile(rf"results-(\d+)\.{self.extension}$")
+        indices = [int(m.group(1)) for m in map(pattern.match, os.listdir(self.results_dir)) if m]
+        return self.results_dir / f"results-{max(indices, default=-1) + 1:05d}.{self.extension}"
+
+    def _open_shard(self):
+        path = self._next_shard_path()
+        self._shard = _ParquetShard(path) if self.sink_format == SINK_PARQUET else _JsonlShard(path)
+        self.shards.append(str(path))
+        logger.debug(f"Writing results to {path}")
+
+    def _close_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stopping = True
+
+            if batch:
+                self._write_batch(batch)
+        self._close_shard()
+
+    def _write_batch(self, batch: List[Tuple[Dict[str, Any], Any, Optional[Callable]]]):
+        try:
+            if self._shard is None:
+                self._open_shard()
+            self._shard.write([record for record, _, _ in batch])
+            size = self._shard.sync()
+        except Exception as e:
+            # Callbacks are not run, so the ledger does not mark these images as done
+            logger.error(f"Failed to write {len(batch)} result records: {str(e)}")
+            return
+        self.records_written += len(batch)
+
+        for _, loop, on_durable in batch:
+            if on_durable is None:
+                continue
+            if loop is None:
+                on_durable()
+            elif not loop.is_closed():
+                loop.call_soon_threadsafe(on_durable)
+
+        if size >= self.shard_max_bytes:
+            self._close_shard()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "format": self.sink_format,
+            "records_written": self.records_written,
+            "shards": self.shards
+        }
@@ -1,55 +1,406 @@
 import asyncio
 import random
 import logging
-from typing import Callable, Any, Optional
-from google.generativeai.types import GenerationConfig
+import socket
+import sys
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Any, Dict, Iterable, Optional
+
+from preprocessor import WorkerCrashedError
+from transport import ContentBlockedError, EmptyResponseError, is_cache_not_found
 
 logger = logging.getLogger(__name__)
 
+ERROR_RATE_LIMIT = "rate_limit"
+ERROR_TIMEOUT = "timeout"
+ERROR_SERVER = "server_error"
+ERROR_NETWORK = "network"
+ERROR_CONTENT_SAFETY = "content_safety"
+ERROR_EMPTY_RESPONSE = "empty_response"
+ERROR_INVALID_REQUEST = "invalid_request"
+ERROR_AUTH = "auth"
+ERROR_CACHE_EXPIRED = "cache_expired"
+ERROR_OTHER = "other"
+
+# Categories that indicate the API itself is unavailable or saturated
+OUTAGE_CATEGORIES = frozenset({ERROR_RATE_LIMIT, ERROR_TIMEOUT, ERROR_SERVER, ERROR_NETWORK})
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+@dataclass
+class ErrorClassification:
+    """How a failed call should be treated by the retry engine."""
+    category: str
+    retryable: bool
+    retry_after: Optional[float] = None
+
+def _status_of(error: Exception) -> Optional[int]:
+    """HTTP status carried by an ``ApiError`` or a ``google.api_core`` exception."""
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+def _google_retry_delay(error: Exception) -> Optional[float]:
+    """Retry delay from a ``google.rpc.RetryInfo`` detail attached to an SDK error."""
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    return None
+
+def _classify_status(status: int) -> ErrorClassification:
+    if status == 429:
+        return ErrorClassification(ERROR_RATE_LIMIT, True)
+    if status in (408, 504):
+        return ErrorClassification(ERROR_TIMEOUT, True)
+    if status >= 500:
+        return ErrorClassification(ERROR_SERVER, True)
+    if status in (401, 403):
+        return ErrorClassification(ERROR_AUTH, False)
+    return ErrorClassification(ERROR_INVALID_REQUEST, False)
+
+def classify_error(error: Exception) -> ErrorClassification:
+    """
+    Classify a failed call by exception type and HTTP status.
+
+    Server-provided retry delays (``Retry-After`` or ``RetryInfo``) are
+    carried along so the engine can honor them.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return ErrorClassification(ERROR_TIMEOUT, True)
+    if isinstance(error, ContentBlockedError):
+        return ErrorClassification(ERROR_CONTENT_SAFETY, False)
+    if isinstance(error, EmptyResponseError):
+        return ErrorClassification(ERROR_EMPTY_RESPONSE, True)
+    # The pool was already rebuilt once for this image; another attempt would likely kill it again
+    if isinstance(error, WorkerCrashedError):
+        return ErrorClassification(ERROR_INVALID_REQUEST, False)
+
+    # SDK exceptions can only occur once the SDK is loaded; importing it here would cost a second
+    sdk_types = sys.modules.get("google.generativeai.types")
+    if sdk_types is not None:
+        if isinstance(error, (sdk_types.BlockedPromptException, sdk_types.StopCandidateException)):
+            return ErrorClassification(ERROR_CONTENT_SAFETY, False)
+
+    # The caller rebuilds the context cache, so the retry does not hit the same 403/404
+    if is_cache_not_found(error):
+        return ErrorClassification(ERROR_CACHE_EXPIRED, True)
+
+    status = _status_of(error)
+    if status is not None:
+        classification = _classify_status(status)
+        retry_after = getattr(error, "retry_after", None)
+        classification.retry_after = retry_after if retry_after is not None else _google_retry_delay(error)
+        return classification
+
+    if isinstance(error, TimeoutError):
+        return ErrorClassification(ERROR_TIMEOUT, True)
+    if isinstance(error, (ConnectionError, socket.gaierror)):
+        return ErrorClassification(ERROR_NETWORK, True)
+    # Likewise, aiohttp is only loaded once the REST transport opens a session
+    aiohttp = sys.modules.get("aiohttp")
+    if aiohttp is not None and isinstance(error, aiohttp.ClientError):
+        return ErrorClassification(ERROR_NETWORK, True)
+    # Local validation (unreadable or vanished image, upload too large) fails the same way every time.
+    # Other OSErrors come from the local filesystem, so they must not spend the retry budget.
+    if isinstance(error, (ValueError, TypeError, OSError)):
+        return ErrorClassification(ERROR_INVALID_REQUEST, False)
+    return ErrorClassification(ERROR_OTHER, True)
+
+class RetryBudget:
+    """
+    Caps the rate of retries at a fraction of requests across all workers.
+
+    Every first attempt deposits ``ratio`` tokens and every retry withdraws
+    one. The balance starts at, and is capped by, ``reserve`` so a quiet
+    period cannot bank enough tokens for a retry storm later. A retry that
+    finds the budget empty is not given up; it waits for new requests to
+    deposit a token, for at most ``max_wait`` seconds.
+    """
+
+    # How often a deferred retry checks the balance again
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, ratio: float = 0.1, reserve: float = 10.0):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = reserve
+        self.deferred = 0
+        self.deferred_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ratio > 0
+
+    def record_request(self):
+        self.balance = min(self.reserve, self.balance + self.ratio)
+
+    def try_spend(self) -> bool:
+        if not self.enabled:
+            return True
+        if self.balance < 1.0:
+            return False
+        self.balance -= 1.0
+        return True
+
+    async def spend(self, max_wait: float, sleep: Callable[[float], Awaitable[Any]] = asyncio.sleep) -> float:
+        """
+        Withdraw a token for one retry, waiting while the budget is empty; returns the seconds waited.
+
+        The wait is bounded so workers that are all retrying, and so make no
+        new deposits, cannot stall each other forever.
+        """
+        if self.try_spend():
+            return 0.0
+        self.deferred += 1
+        waited = 0.0
+        while waited < max_wait:
+            interval = min(self.POLL_INTERVAL, max_wait - waited)
+            await sleep(interval)
+            waited += interval
+            if self.try_spend():
+                break
+        self.deferred_seconds += waited
+        return waited
+
+class CircuitBreaker:
+    """
+    Pauses every caller during a sustained outage.
+
+    After ``failure_threshold`` consecutive outage failures (429, timeout,
+    5xx, connection errors) the breaker opens and callers wait in
+    ``before_call``. Once ``reset_timeout`` has passed a single probe call is
+    let through: success closes the breaker, failure reopens it with the
+    timeout doubled up to ``max_reset_timeout``, and a probe that ends
+    without an answer hands the slot to the next caller. A threshold of 0
+    disables it.
+    """
+
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 30.0, max_reset_timeout: float = 300.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(max_reset_timeout, reset_timeout)
+
+        self.state = BREAKER_CLOSED
+        self._condition = asyncio.Condition()
+        self._consecutive_failures = 0
+        self._current_timeout = reset_timeout
+        self._opened_at = 0.0
+        self._probe = 0
+        self.trips = 0
+        self.open_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    async def before_call(self) -> Optional[int]:
+        """
+        Wait until calls are allowed; in half-open state only the probe proceeds.
+
+        Returns an id for the probe call, which must be passed to
+        ``release_probe`` once it ends, or None for an ordinary call.
+        """
+        if not self.enabled or self.state == BREAKER_CLOSED:
+            return None
+        async with self._condition:
+            while self.state != BREAKER_CLOSED:
+                if self.state == BREAKER_OPEN:
+                    remaining = self._opened_at + self._current_timeout - time.monotonic()
+                    if remaining <= 0:
+                        self.state = BREAKER_HALF_OPEN
+                        self._probe += 1
+                        logger.info("Circuit breaker half-open, sending a probe request")
+                        return self._probe
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    # A probe is in flight; wait for its verdict
+                    await self._condition.wait()
+        return None
+
+    async def release_probe(self, probe: Optional[int]):
+        """
+        Give up the half-open probe slot if the probe ended without a verdict.
+
+        A probe that was cancelled (a lost hedge, shutdown) or failed before
+        reaching the API says nothing about it. The breaker goes back to open
+        with its timeout already elapsed, so the next waiter probes instead.
+        """
+        if probe is None or self.state != BREAKER_HALF_OPEN or probe != self._probe:
+            return
+        # Shielded so that a cancelled probe still hands over its slot
+        await asyncio.shield(self._reopen_after_probe(probe))
+
+    async def _reopen_after_probe(self, probe: int):
+        async with self._condition:
+            if self.state == BREAKER_HALF_OPEN and probe == self._probe:
+                self.state = BREAKER_OPEN
+                self._condition.notify_all()
+
+    async def record_success(self):
+        if not self.enabled:
+            return
+        self._consecutive_failures = 0
+        if self.state == BREAKER_CLOSED:
+            return
+        async with self._condition:
+            if self.state != BREAKER_CLOSED:
+                self.open_seconds += time.monotonic() - self._opened_at
+                self.state = BREAKER_CLOSED
+                self._current_timeout = self.reset_timeout
+                logger.info("Circuit breaker closed, resuming requests")
+                self._condition.notify_all()
+
+    async def record_failure(self):
+        if not self.enabled:
+            return
+        self._consecutive_failures += 1
+        if self.state == BREAKER_HALF_OPEN:
+            async with self._condition:
+                if self.state == BREAKER_HALF_OPEN:
+                    self.open_seconds += time.monotonic() - self._opened_at
+                    self._current_timeout = min(self._current_timeout * 2, self.max_reset_timeout)
+                    self._open()
+                    self._condition.notify_all()
+        elif self.state == BREAKER_CLOSED and self._consecutive_failures >= self.failure_threshold:
+            self._open()
+            self.trips += 1
+
+    def _open(self):
+        self.state = BREAKER_OPEN
+        self._opened_at = time.monotonic()
+        logger.warning(
+            f"Circuit breaker open after {self._consecutive_failures} consecutive failures, "
+            f"pausing requests for {self._current_timeout:.0f}s"
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "trips": self.trips,
+            "open_seconds": round(self.open_seconds, 3)
+        }
+
 class RetryHandler:
-    def __init__(self, max_retries: int = 5):
+    """
+    Retry engine shared by every worker.
+
+    Failures are classified by type and status; only transient ones are
+    retried, after the server-provided retry delay or, without one, a
+    decorrelated-jitter backoff. Retries draw from a global ``RetryBudget``
+    and API calls pass through a shared ``CircuitBreaker``.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        budget_ratio: float = 0.1,
+        budget_reserve: float = 10.0,
+        breaker_threshold: int = 10,
+        breaker_timeout: float = 30.0,
+        sleep: Callable[[float], Awaitable[Any]] = asyncio.sleep
+    ):
         self.max_retries = max_retries
-    
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = RetryBudget(budget_ratio, budget_reserve)
+        self.circuit_breaker = CircuitBreaker(breaker_threshold, breaker_timeout)
+        self.sleep = sleep
+        self.retries = 0
+        self.retries_by_category: Dict[str, int] = {}
+
+    def next_delay(self, classification: ErrorClassification, previous_delay: Optional[float]) -> float:
+        """
+        The server's retry delay plus up to 20% jitter when it gave one.
+
+        Otherwise decorrelated jitter: uniform between the base and three
+        times the previous delay.
+        """
+        if classification.retry_after is not None:
+            return classification.retry_after * random.uniform(1.0, 1.2)
+        if classification.category == ERROR_CACHE_EXPIRED:
+            # Nothing to wait for once the cache is rebuilt
+            return 0.0
+        base = self.base_delay * (2 if classification.category == ERROR_RATE_LIMIT else 1)
+        previous = previous_delay if previous_delay is not None else base
+        return min(self.max_delay, random.uniform(base, max(base, previous * 3)))
+
+    async def record_call_result(self, error: Optional[Exception] = None):
+        """Report an API call's outcome to the circuit breaker."""
+        if error is None or classify_error(error).category not in OUTAGE_CATEGORIES:
+            # Any answer from the API, even a rejection, shows it is up
+            await self.circuit_breaker.record_success()
+        else:
+            await self.circuit_breaker.record_failure()
+
     async def execute_with_retry(
         self,
         func: Callable,
         *args,
+        retry_categories: Iterable[str] = (),
+        on_retry: Optional[Callable[[Exception, ErrorClassification], Any]] = None,
         **kwargs
-    ) -> Optional[Any]:
+    ) -> Any:
         """
-        Execute a function with exponential backoff retry logic.
+        Run ``func`` with up to ``max_retries`` retries and return its result.
+
+        ``retry_categories`` makes otherwise permanent categories retryable
+        (e.g. content safety when the prompt is rewritten between attempts);
+        ``on_retry`` is called with the error before each retry. The last
+        error is raised once retrying stops.
         """
-        last_exception = None
-        
-        for attempt in range(self.max_retries):
+        self.budget.record_request()
+        previous_delay = None
+
+        for attempt in range(self.max_retries + 1):
             try:
                 if asyncio.iscoroutinefunction(func):
-                    result = await func(*args, **kwargs)
-                else:
-                    result = func(*args, **kwargs)
-                return result
-                
+                    return await func(*args, **kwargs)
+                return func(*args, **kwargs)
             except Exception as e:
-                last_exception = e
-                logger.warning(f"Attempt {attempt + 1}/{self.max_retries} failed: {str(e)}")
-                
-                # Determine delay based on error type
-                if "429" in str(e) or "rate limit" in str(e).lower():
-                    # Rate limit - use longer delay
-                    base_delay = 2.0
-                elif "400" in str(e) or "invalid" in str(e).lower():
-                    # Invalid request - don't retry
-                    logger.error(f"Invalid request, skipping retry: {str(e)}")
-                    return None
-                else:
-                    # Other errors - standard exponential backoff
-                    base_delay = 1.0
-                
-                if attempt < self.max_retries - 1:
-                    delay = min(base_delay * (2 ** attempt) + random.uniform(0, 1), 60.0)
-                    logger.info(f"Waiting {delay:.2f} seconds before retry...")
-                    await asyncio.sleep(delay)
-                else:
+                classification = classify_error(e)
+                logger.warning(f"Attempt {attempt + 1}/{self.max_retries + 1} failed ({classification.category}): {str(e)}")
+
+                if not (classification.retryable or classification.category in retry_categories):
+                    logger.error(f"Not retrying {classification.category} error: {str(e)}")
+                    raise
+                if attempt >= self.max_retries:
                     logger.error(f"Max retries exceeded: {str(e)}")
-        
-        return None
\ No newline at end of file
+                    raise
+                # The budget's wait replaces (part of) the backoff
+                budget_wait = await self.budget.spend(self.max_delay, self.sleep)
+                if budget_wait > 0:
+                    logger.info(f"Retry budget exhausted, deferred retry by {budget_wait:.2f} seconds")
+
+                self.retries += 1
+                self.retries_by_category[classification.category] = self.retries_by_category.get(classification.category, 0) + 1
+                if on_retry is not None:
+                    on_retry(e, classification)
+
+                delay = self.next_delay(classification, previous_delay)
+                previous_delay = delay
+                delay -= budget_wait
+                if delay > 0:
+                    logger.info(f"Waiting {delay:.2f} seconds before retry...")
+                    await self.sleep(delay)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Retry counts, budget deferrals and circuit breaker activity."""
+        return {
+            "retries": self.retries,
+            "retries_by_category": dict(self.retries_by_category),
+            "budget_ratio": self.budget.ratio,
+            "budget_deferred": self.budget.deferred,
+            "budget_deferred_seconds": round(self.budget.deferred_seconds, 3),
+            "circuit_breaker": self.circuit_breaker.get_stats()
+        }
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, fields
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from mock_model import MockGenerativeModel
+from rate_limiter import MAX_WAIT_SLICE, SharedRateLimiter, default_state_file
+from retry_handler import ERROR_RATE_LIMIT, classify_error
+from transport import DEFAULT_API_BASE_URL, RestTransport, SdkTransport
+
+logger = logging.getLogger(__name__)
+
+BACKEND_GEMINI = "gemini"
+BACKEND_MOCK = "mock"
+
+# Cooldown after a 429 that carried no Retry-After
+DEFAULT_COOLDOWN = 10.0
+
+@dataclass
+class RouteSpec:
+    """One API key and model as configured in the routes file."""
+    name: str
+    model: str
+    api_key: str = ""
+    backend: str = BACKEND_GEMINI
+    base_url: str = DEFAULT_API_BASE_URL
+    max_concurrent: int = 5
+    rpm_limit: int = 0
+    tpm_limit: int = 0
+    priority: int = 0  # lower is preferred; higher priorities are fallbacks
+
+ROUTE_FIELDS = frozenset(field.name for field in fields(RouteSpec))
+
+def load_route_specs(path: str) -> List[RouteSpec]:
+    """
+    Read route specs from a JSON file of the form ``{"routes": [{...}, ...]}``.
+
+    A key can be given inline as ``api_key`` or, to keep it out of the file,
+    as the name of an environment variable in ``api_key_env``.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    specs = []
+    for index, entry in enumerate(data.get("routes", [])):
+        entry = dict(entry)
+        if "model" not in entry:
+            raise ValueError(f"Route {index} in {path} has no model")
+        key_env = entry.pop("api_key_env", None)
+        if key_env:
+            entry["api_key"] = os.getenv(key_env, "")
+        entry.setdefault("name", f"{entry['model']}#{index}")
+        unknown = sorted(set(entry) - ROUTE_FIELDS)
+        if unknown:
+            raise ValueError(f"Route {entry['name']} in {path} has unknown field(s): {', '.join(unknown)}")
+        spec = RouteSpec(**entry)
+        if spec.backend != BACKEND_MOCK and not spec.api_key:
+            raise ValueError(f"Route {spec.name} has no API key")
+        # Rate limits of 0 disable the bucket, but a route needs at least one slot
+        if not isinstance(spec.max_concurrent, int) or spec.max_concurrent < 1:
+            raise ValueError(f"Route {spec.name} in {path} needs max_concurrent of at least 1")
+        for limit in ("rpm_limit", "tpm_limit"):
+            if not isinstance(getattr(spec, limit), int) or getattr(spec, limit) < 0:
+                raise ValueError(f"Route {spec.name} in {path} needs a non-negative {limit}")
+        specs.append(spec)
+    if not specs:
+        raise ValueError(f"No routes configured in {path}")
+    return specs
+
+class Route:
+    """A configured route with its own transport, rate limiter and concurrency cap."""
+
+    def __init__(self, spec: RouteSpec, transport: Any, rate_limiter: SharedRateLimiter):
+        self.spec = spec
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.failovers = 0
+
+    @property
+    def name(self) -> str:
+        return self.spec.name
+
+    def is_open(self, now: float) -> bool:
+        return self.in_flight < self.spec.max_concurrent and now >= self.cooldown_until
+
+    def free_fraction(self) -> float:
+        return 1.0 - self.in_flight / self.spec.max_concurrent
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.spec.model,
+            "priority": self.spec.priority,
+            "calls": self.calls,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "failovers": self.failovers
+        }
+
+class RoutingPool:
+    """
+    Spreads requests over several API keys and models.
+
+    Each route has its own concurrency cap and RPM/TPM buckets (shared with
+    other processes using the same key and model). A request goes to the
+    open route with the lowest priority number, and among equals to the one
+    with the most free capacity; higher priority numbers are only used while
+    every preferred route is full, cooling down or out of rate limit
+    permits. A route that answers 429 cools down for its Retry-After, and
+    the request fails over to another route right away.
+    """
+
+    def __init__(self, routes: List[Route], default_cooldown: float = DEFAULT_COOLDOWN):
+        self.routes = sorted(routes, key=lambda route: route.spec.priority)
+        self.default_cooldown = default_cooldown
+        self._condition = asyncio.Condition()
+        self.wait_seconds = 0.0
+
+    @classmethod
+    def from_file(cls, path: str, connection_limit: int = 100, timeout: float = 120.0) -> "RoutingPool":
+        routes = []
+        for spec in load_route_specs(path):
+            if spec.backend == BACKEND_MOCK:
+                transport = SdkTransport(MockGenerativeModel(spec.model))
+            else:
+                transport = RestTransport(
+                    spec.api_key, spec.model, base_url=spec.base_url,
+                    connection_limit=connection_limit, timeout=timeout
+                )
+            # Quotas are per key and model, so that pair names the shared bucket
+            rate_limiter = SharedRateLimiter(
+                default_state_file(f"{spec.api_key}:{spec.model}"), rpm_limit=spec.rpm_limit, tpm_limit=spec.tpm_limit
+            )
+            routes.append(Route(spec, transport, rate_limiter))
+        logger.info(f"Routing over {len(routes)} routes: {', '.join(route.name for route in routes)}")
+        return cls(routes)
+
+    @property
+    def primary_model(self) -> str:
+        return self.routes[0].spec.model
+
+    @property
+    def models(self) -> List[str]:
+        """Distinct models of the routes, most preferred first."""
+        return list(dict.fromkeys(route.spec.model for route in self.routes))
+
+    def model_for(self, route_name: str) -> str:
+        for route in self.routes:
+            if route.name == route_name:
+                return route.spec.model
+        raise KeyError(route_name)
+
+    def has_capacity(self) -> bool:
+        now = time.monotonic()
+        return any(route.is_open(now) for route in self.routes)
+
+    async def _try_take(self, tokens: int, exclude: Set[str]) -> Tuple[Optional[Route], float]:
+        """Take a slot and rate limit permit on the best open route, else return the time to wait."""
+        now = time.monotonic()
+        wait = MAX_WAIT_SLICE
+        candidates = [route for route in self.routes if route.name not in exclude]
+        # Sorting is stable, so priority groups keep their order
+        candidates.sort(key=lambda route: (route.spec.priority, -route.free_fraction()))
+        for route in candidates:
+            if now < route.cooldown_until:
+                wait = min(wait, route.cooldown_until - now)
+                continue
+            if route.in_flight >= route.spec.max_concurrent:
+                continue
+            # Off the event loop; only route selection waits while the state file is locked
+            permit_wait = await route.rate_limiter.request_permit(tokens) if route.rate_limiter.enabled else 0.0
+            if permit_wait > 0:
+                wait = min(wait, permit_wait)
+                continue
+            route.in_flight += 1
+            route.calls += 1
+            return route, 0.0
+        return None, wait
+
+    async def _acquire(self, tokens: int, exclude: Set[str]) -> Route:
+        started = time.monotonic()
+        async with self._condition:
+            while True:
+                route, wait = await self._try_take(tokens, exclude)
+                if route is not None:
+                    self.wait_seconds += time.monotonic() - started
+                    return route
+                # Woken early when another request frees a slot
+                try:
+                    await asyncio.wait_for(self._condition.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release(self, route: Route):
+        async with self._condition:
+            route.in_flight -= 1
+            self._condition.notify_all()
+
+    def _has_alternative(self, exclude: Set[str]) -> bool:
+        now = time.monotonic()
+        return any(route.name not in exclude and now >= route.cooldown_until for route in self.routes)
+
+    async def generate_content(self, contents: List[Any], estimated_tokens: int = 0) -> Tuple[Any, str]:
+        """Send a request over the pool; returns the response and the name of the route that answered."""
+        rate_limited: Set[str] = set()
+        while True:
+            route = await self._acquire(estimated_tokens, rate_limited)
+            try:
+                response = await route.transport.generate_content(contents)
+            except Exception as e:
+                await self._release(route)
+                route.failures += 1
+                classification = classify_error(e)
+                if classification.category != ERROR_RATE_LIMIT:
+                    raise
+                route.rate_limited += 1
+                route.cooldown_until = time.monotonic() + (classification.retry_after or self.default_cooldown)
+                rate_limited.add(route.name)
+                if not self._has_alternative(rate_limited):
+                    raise
+                route.failovers += 1
+                logger.info(f"Route {route.name} is rate limited, failing over")
+                continue
+            await self._release(route)
+            route.successes += 1
+            usage = getattr(response, "usage_metadata", None)
+            if usage is not None and getattr(usage, "total_token_count", 0):
+                route.rate_limiter.reconcile_tokens(estimated_tokens, usage.total_token_count)
+            return response, route.name
+
+    async def close(self):
+        for route in self.routes:
+            await route.transport.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "wait_seconds": round(self.wait_seconds, 3),
+            "routes": {route.name: route.get_stats() for route in self.routes}
+        }
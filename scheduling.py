@@ -0,0 +1,187 @@
+import asyncio
+import heapq
+import logging
+import os
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+ORDER_DISCOVERY = "discovery"
+ORDER_LARGEST_FIRST = "largest-first"
+ORDER_SMALLEST_FIRST = "smallest-first"
+
+COST_BYTES = "bytes"
+COST_PIXELS = "pixels"
+
+def estimate_cost(image_path: str, method: str = COST_BYTES) -> int:
+    """Cheap proxy for how long an image takes: file size, or pixel count from the header."""
+    try:
+        if method == COST_PIXELS:
+            from PIL import Image
+            # Opening only parses the header; pixel data is not decoded
+            with Image.open(image_path) as img:
+                return img.width * img.height
+        return os.path.getsize(image_path)
+    except Exception:
+        # Unreadable files fail fast anyway, so they go wherever cost 0 sorts
+        return 0
+
+def order_by_cost(
+    image_paths: Iterable[str],
+    order: str = ORDER_LARGEST_FIRST,
+    method: str = COST_BYTES,
+    window: int = 10000
+) -> Iterator[str]:
+    """
+    Reorder paths by estimated cost through a bounded heap.
+
+    Up to ``window`` paths are buffered, so batches no larger than the window
+    are fully sorted while memory stays bounded for bigger ones. Largest
+    first keeps slow images from starting last and stretching the tail;
+    smallest first minimizes the mean time to a result.
+    """
+    sign = -1 if order == ORDER_LARGEST_FIRST else 1
+    heap = []
+    for sequence, image_path in enumerate(image_paths):
+        # The sequence number keeps discovery order among equal costs
+        heapq.heappush(heap, (sign * estimate_cost(image_path, method), sequence, image_path))
+        if len(heap) > window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+class RequestHedger:
+    """
+    Sends a duplicate of a request that runs past the observed latency quantile.
+
+    Whichever copy answers successfully first wins. The other is not
+    cancelled but left to finish in the background: an SDK call keeps running
+    in its thread anyway and the API bills it either way, so the copy's own
+    code can still release its resources and account for its usage. Hedges
+    are capped at ``max_ratio`` of all calls, and none are sent until
+    ``min_samples`` latencies have been observed.
+    """
+
+    def __init__(
+        self,
+        quantile: float = 0.95,
+        max_ratio: float = 0.05,
+        min_samples: int = 20,
+        window: int = 1000
+    ):
+        self.quantile = quantile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self._latencies: deque = deque(maxlen=window)
+        self._delay: Optional[float] = None
+        self._samples_since_update = 0
+        self._abandoned: Set[asyncio.Future] = set()
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds after which a request is hedged, or None while there is too little data."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        # Sorting the window on every call would dominate; refresh every few samples
+        if self._delay is None or self._samples_since_update >= max(1, self.min_samples // 2):
+            ordered = sorted(self._latencies)
+            self._delay = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+            self._samples_since_update = 0
+        return self._delay
+
+    def _observe(self, seconds: float):
+        self._latencies.append(seconds)
+        self._samples_since_update += 1
+
+    async def _timed(self, call: Awaitable[Any]) -> Any:
+        started = asyncio.get_running_loop().time()
+        result = await call
+        self._observe(asyncio.get_running_loop().time() - started)
+        return result
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable[Any]],
+        start_hedge: Optional[Callable[[], Awaitable[Optional[Awaitable[Any]]]]] = None
+    ) -> Any:
+        """
+        Run ``call``, hedging it once if it is slow.
+
+        ``start_hedge`` is awaited right before a hedge is sent, e.g. to take
+        a concurrency slot and a rate limit permit without waiting. It returns
+        the hedge's awaitable, or None to skip the hedge; without it the hedge
+        is another ``call()``. If both copies fail, the first copy's error is
+        raised.
+        """
+        self.calls += 1
+        primary = asyncio.ensure_future(self._timed(call()))
+        hedge = None
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                await asyncio.wait({primary}, timeout=delay)
+            if primary.done() or delay is None:
+                return await primary
+
+            hedge_call = None
+            if self.hedges < self.max_ratio * self.calls:
+                hedge_call = await start_hedge() if start_hedge is not None else call()
+            if hedge_call is None:
+                self.skipped += 1
+                return await primary
+            self.hedges += 1
+            hedge = asyncio.ensure_future(self._timed(hedge_call))
+
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        self._abandon(pending)
+                        return task.result()
+            return primary.result()
+        except BaseException:
+            # The caller gave up (or both copies failed); nothing is left to account for
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+            raise
+
+    def _abandon(self, tasks: Set[asyncio.Future]):
+        for task in tasks:
+            self._abandoned.add(task)
+            task.add_done_callback(self._forget)
+
+    def _forget(self, task: asyncio.Future):
+        self._abandoned.discard(task)
+        if not task.cancelled():
+            # Retrieved, so a losing copy that failed is not reported as an unhandled error
+            task.exception()
+
+    async def wait_abandoned(self):
+        """Wait for losing copies still running, so their usage is counted before the stats are written."""
+        if self._abandoned:
+            await asyncio.gather(*list(self._abandoned), return_exceptions=True)
+
+    async def close(self):
+        """Cancel losing copies still running, e.g. when a run is aborted."""
+        for task in list(self._abandoned):
+            task.cancel()
+        await self.wait_abandoned()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.skipped,
+            "hedge_rate": self.hedges / self.calls if self.calls else 0,
+            "hedge_delay_seconds": round(self._delay, 4) if self._delay is not None else None
+        }
@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+try:
+    import zstandard
+except ImportError:  # falls back to the zstd command line tool, then gzip
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CODEC_AUTO = "auto"
+CODEC_ZSTD = "zstd"
+CODEC_GZIP = "gzip"
+
+CODEC_EXTENSIONS = {CODEC_ZSTD: "tar.zst", CODEC_GZIP: "tar.gz"}
+
+MANIFEST_NAME = "manifest.json"
+
+def resolve_codec(requested: str = CODEC_AUTO) -> str:
+    """Pick zstd when a zstd implementation is available, otherwise gzip."""
+    zstd_available = zstandard is not None or shutil.which("zstd") is not None
+    if requested == CODEC_ZSTD and not zstd_available:
+        logger.warning("Neither the zstandard package nor the zstd binary is available; using gzip")
+        return CODEC_GZIP
+    if requested == CODEC_AUTO:
+        return CODEC_ZSTD if zstd_available else CODEC_GZIP
+    return requested
+
+class _ProcessCompressor:
+    """File-like writer that pipes data through an external multi-threaded compressor."""
+
+    def __init__(self, command: List[str], output):
+        self.command = command
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output)
+
+    def write(self, data: bytes) -> int:
+        self._process.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        self._process.stdin.close()
+        if self._process.wait() != 0:
+            raise RuntimeError(f"{self.command[0]} exited with status {self._process.returncode}")
+
+def _open_compressor(codec: str, output, level: Optional[int]):
+    """Return (writer, description) for the codec, preferring multi-threaded implementations."""
+    threads = os.cpu_count() or 1
+    if codec == CODEC_ZSTD:
+        if zstandard is not None:
+            compressor = zstandard.ZstdCompressor(level=level or 3, threads=-1)
+            return compressor.stream_writer(output, closefd=False), "zstandard"
+        return _ProcessCompressor(["zstd", "-q", "-c", f"-{level or 3}", f"-T{threads}"], output), "zstd"
+    if shutil.which("pigz"):
+        return _ProcessCompressor(["pigz", "-c", f"-{level or 6}", "-p", str(threads)], output), "pigz"
+    return gzip.GzipFile(fileobj=output, mode="wb", compresslevel=level or 6), "gzip"
+
+class StreamingArchive:
+    """
+    Tar archive that is compressed and written while results are produced.
+
+    Members are appended by a background thread as soon as they are queued,
+    so closing the archive only adds the final metadata files and the
+    manifest. The manifest lists every member with its size and SHA-256 and
+    is written both as the last member and next to the archive, together
+    with the checksum of the archive itself.
+    """
+
+    def __init__(self, archive_path: Path, codec: str = CODEC_AUTO, level: Optional[int] = None):
+        self.codec = resolve_codec(codec)
+        self.archive_path = Path(archive_path)
+        self.level = level
+        self.manifest: List[Dict[str, Any]] = []
+        self.queued_names: Set[str] = set()
+        self._queue: "queue.Queue[Optional[Tuple[str, bytes]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[Exception] = None
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.archive_path.with_name(f"{self.archive_path.name}.{MANIFEST_NAME}")
+
+    def add(self, arcname: str, data: bytes):
+        """Queue one member for appending."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="streaming-archive", daemon=True)
+            self._thread.start()
+        self.queued_names.add(arcname)
+        self._queue.put((arcname, data))
+
+    def add_file(self, file_path: Path, arcname: str):
+        with open(file_path, 'rb') as f:
+            self.add(arcname, f.read())
+
+    def close(self) -> Path:
+        """Append the manifest, finish compression and write the external manifest."""
+        if self._thread is None:
+            # Nothing was streamed; still produce a (possibly empty) archive
+            self._thread = threading.Thread(target=self._run, name="streaming-archive", daemon=True)
+            self._thread.start()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            raise self._error
+
+        digest = hashlib.sha256()
+        with open(self.archive_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "archive": self.archive_path.name,
+                "codec": self.codec,
+                "sha256": digest.hexdigest(),
+                "size": self.archive_path.stat().st_size,
+                "files": self.manifest
+            }, f, indent=2)
+        return self.archive_path
+
+    def _append(self, tar: tarfile.TarFile, arcname: str, data: bytes):
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+        self.manifest.append({"path": arcname, "size": len(data), "sha256": hashlib.sha256(data).hexdigest()})
+
+    def _run(self):
+        finished = False
+        try:
+            with open(self.archive_path, 'wb') as output:
+                writer, implementation = _open_compressor(self.codec, output, self.level)
+                logger.info(f"Streaming archive to {self.archive_path} ({implementation})")
+                try:
+                    with tarfile.open(fileobj=writer, mode="w|") as tar:
+                        while True:
+                            item = self._queue.get()
+                            if item is None:
+                                finished = True
+                                break
+                            self._append(tar, *item)
+                        manifest = json.dumps(self.manifest, indent=2).encode("utf-8")
+                        self._append(tar, MANIFEST_NAME, manifest)
+                finally:
+                    writer.close()
+        except Exception as e:
+            logger.error(f"Streaming archive failed: {str(e)}")
+            self._error = e
+            # Keep draining so producers never block on a dead writer
+            while not finished:
+                finished = self._queue.get() is None
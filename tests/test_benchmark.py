@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+
+import pytest
+
+from benchmark import percentile, wait_for_result
+
+def _report(result_queue):
+    result_queue.put({"images": 1})
+
+def _crash(result_queue):
+    os._exit(3)
+
+def test_nearest_rank_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 95) == 95.0
+    assert percentile(values, 99) == 99.0
+    assert percentile(values, 100) == 100.0
+    assert all(percentile(values, pct) == pct for pct in range(1, 101))
+    assert percentile(values, 0) == 1.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 75) == 3.0
+    assert percentile([7.0], 99) == 7.0
+    assert percentile([], 50) == 0.0
+
+def _run_child(target):
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    child = context.Process(target=target, args=(result_queue,))
+    child.start()
+    try:
+        return wait_for_result(child, result_queue, poll_interval=0.1)
+    finally:
+        child.join()
+
+def test_result_of_a_finished_child_is_returned():
+    assert _run_child(_report) == {"images": 1}
+
+def test_crashed_child_is_reported_instead_of_hanging():
+    with pytest.raises(RuntimeError, match="code 3"):
+        _run_child(_crash)
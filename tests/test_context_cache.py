@@ -0,0 +1,230 @@
+import asyncio
+import time
+
+import context_cache
+from config import Config
+from context_cache import CACHE_OFF, SharedContext
+from mock_model import MockBehavior, MockCacheClient, MockGenerativeModel
+from mock_server import start_mock_server
+from processor import GeminiBatchProcessor
+from retry_handler import ERROR_CACHE_EXPIRED, classify_error
+from transport import ApiError, RestTransport, SdkTransport
+
+PREFIX = ["Long instructions shared by every request. " * 20]
+IMAGE = [{"mime_type": "image/jpeg", "data": b"x"}]
+
+class FailingCacheClient(MockCacheClient):
+    """Rejects every cache, like the API does for a prefix below the minimum cacheable size."""
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.attempts = 0
+
+    def create(self, contents, ttl_seconds):
+        self.attempts += 1
+        raise ApiError(400, "Cached content is too small.")
+
+class FlakyCacheClient(MockCacheClient):
+    """Fails the first ``failures`` creations with a 503."""
+
+    def __init__(self, model, failures):
+        super().__init__(model)
+        self.failures = failures
+        self.attempts = 0
+
+    def create(self, contents, ttl_seconds):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ApiError(503, "The model is overloaded.")
+        return super().create(contents, ttl_seconds)
+
+def test_requests_name_the_cache():
+    model = MockGenerativeModel()
+    transport = SdkTransport(model, MockCacheClient(model))
+    context = SharedContext(PREFIX, transport)
+
+    async def run():
+        contents, cache_name = await context.build(IMAGE)
+        response = await transport.generate_content(contents, cache_name)
+        await context.build(IMAGE)
+        return contents, cache_name, response
+
+    contents, cache_name, response = asyncio.run(run())
+    assert contents == IMAGE
+    assert cache_name is not None
+    assert response.usage_metadata.cached_content_token_count > 0
+    stats = context.get_stats()
+    assert (stats["caches_created"], stats["requests_cached"], stats["requests_inline"]) == (1, 2, 0)
+
+def test_falls_back_to_inline_when_cache_creation_fails():
+    model = MockGenerativeModel()
+    cache_client = FailingCacheClient(model)
+    transport = SdkTransport(model, cache_client)
+    context = SharedContext(PREFIX, transport)
+
+    async def run():
+        results = [await context.build(IMAGE) for _ in range(3)]
+        response = await transport.generate_content(*results[0])
+        return results, response
+
+    results, response = asyncio.run(run())
+    assert results[0] == (PREFIX + IMAGE, None)
+    assert response.usage_metadata.cached_content_token_count == 0
+    # Creation is not retried for every request
+    assert cache_client.attempts == 1
+    stats = context.get_stats()
+    assert (stats["caches_created"], stats["requests_cached"], stats["requests_inline"]) == (0, 0, 3)
+    assert "too small" in stats["fallback_reason"]
+
+def test_transient_failure_is_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(context_cache, "CREATE_RETRY_BASE_DELAY", 0.1)
+    model = MockGenerativeModel()
+    cache_client = FlakyCacheClient(model, failures=1)
+    context = SharedContext(PREFIX, SdkTransport(model, cache_client))
+
+    async def run():
+        first = await context.build(IMAGE)
+        # Within the backoff the prefix is inlined without another attempt
+        second = await context.build(IMAGE)
+        attempts_during_backoff = cache_client.attempts
+        await asyncio.sleep(0.15)
+        third = await context.build(IMAGE)
+        return first, second, attempts_during_backoff, third
+
+    first, second, attempts_during_backoff, third = asyncio.run(run())
+    assert first == second == (PREFIX + IMAGE, None)
+    assert attempts_during_backoff == 1
+    assert third[0] == IMAGE and third[1] is not None
+    stats = context.get_stats()
+    assert (stats["caches_created"], stats["create_failures"]) == (1, 1)
+    assert stats["fallback_reason"] is None
+
+def _due_for_refresh(context):
+    context._cache.expires_at = time.time() + context_cache.REFRESH_MARGIN / 2
+
+def test_replaced_cache_is_deleted_once_unused():
+    model = MockGenerativeModel()
+    cache_client = MockCacheClient(model)
+    context = SharedContext(PREFIX, SdkTransport(model, cache_client))
+
+    async def run():
+        _, idle = await context.build(IMAGE)
+        await context.release(idle)
+        _due_for_refresh(context)
+        _, busy = await context.build(IMAGE)
+        # Replacing an unused cache deletes it right away
+        assert cache_client.store.token_count(idle) is None
+        _due_for_refresh(context)
+        _, current = await context.build(IMAGE)
+        # A cache still named by a request in flight is deleted when that request ends
+        assert cache_client.store.token_count(busy) is not None
+        await context.release(busy)
+        assert cache_client.store.token_count(busy) is None
+        await context.release(current)
+        return current
+
+    current = asyncio.run(run())
+    assert cache_client.store.token_count(current) is not None
+    stats = context.get_stats()
+    assert (stats["caches_created"], stats["caches_deleted"]) == (3, 2)
+
+def test_sdk_transport_forgets_replaced_caches():
+    model = MockGenerativeModel()
+    transport = SdkTransport(model, MockCacheClient(model))
+
+    async def run():
+        expired = await transport.create_cached_content(PREFIX, 0.05)
+        await asyncio.sleep(0.1)
+        replaced = await transport.create_cached_content(PREFIX, 3600)
+        current = await transport.create_cached_content(PREFIX, 3600)
+        await transport.delete_cached_content(replaced.name)
+        try:
+            await transport.generate_content(IMAGE, expired.name)
+            status = None
+        except ApiError as e:
+            status = e.status
+        return current, status
+
+    current, status = asyncio.run(run())
+    assert list(transport._cached_models) == [current.name]
+    assert status == 404
+
+def test_falls_back_to_inline_without_cache_support():
+    context = SharedContext(PREFIX, SdkTransport(MockGenerativeModel()))
+    assert asyncio.run(context.build(IMAGE)) == (PREFIX + IMAGE, None)
+    assert context.fallback_reason
+
+def test_caching_off_sends_prefix_inline():
+    model = MockGenerativeModel()
+    cache_client = MockCacheClient(model)
+    context = SharedContext(PREFIX, SdkTransport(model, cache_client), mode=CACHE_OFF)
+    assert asyncio.run(context.build(IMAGE)) == (PREFIX + IMAGE, None)
+    assert cache_client.store.created == 0
+
+def test_rest_cache_against_mock_server():
+    async def run():
+        runner, base_url = await start_mock_server(MockBehavior())
+        transport = RestTransport("test-key", "mock-model", base_url=base_url)
+        context = SharedContext(PREFIX, transport)
+        try:
+            contents, cache_name = await context.build(IMAGE)
+            response = await transport.generate_content(contents, cache_name)
+            await context.close()
+            # A request naming the deleted cache is rejected
+            try:
+                await transport.generate_content(contents, cache_name)
+                rejected = None
+            except ApiError as e:
+                rejected = e.status
+        finally:
+            await transport.close()
+            await runner.cleanup()
+        return contents, cache_name, response, rejected
+
+    contents, cache_name, response, rejected = asyncio.run(run())
+    assert contents == IMAGE
+    assert cache_name.startswith("cachedContents/")
+    assert response.usage_metadata.cached_content_token_count > 0
+    assert rejected == 403
+
+def test_lost_cache_is_rebuilt_and_the_request_retried(tmp_path):
+    from PIL import Image
+
+    context_file = tmp_path / "context.txt"
+    context_file.write_text(PREFIX[0])
+    image_paths = []
+    for i in range(2):
+        image_path = tmp_path / f"image_{i}.png"
+        Image.new("RGB", (16, 16), (i * 100, 0, 0)).save(image_path)
+        image_paths.append(str(image_path))
+    config = Config(
+        gemini_api_key="test",
+        output_dir=str(tmp_path / "output"),
+        model_backend="mock",
+        context_file=str(context_file),
+        rate_limit_state_file=str(tmp_path / "rate_limit.json")
+    )
+
+    async def run():
+        processor = GeminiBatchProcessor(config)
+        try:
+            first = await processor._process_single_image(image_paths[0], "Describe")
+            # The API drops the cache early, as it may after an eviction
+            store = processor.transport.cache_client.store
+            lost = processor.shared_context._cache.name
+            store.delete(lost)
+            second = await processor._process_single_image(image_paths[1], "Describe")
+            return first, second, store.token_count(processor.shared_context._cache.name)
+        finally:
+            await processor.close()
+
+    first, second, rebuilt_tokens = asyncio.run(run())
+    assert first.error is None and first.attempts == 1
+    assert second.error is None and second.attempts == 2
+    assert rebuilt_tokens is not None
+
+def test_cache_not_found_is_retryable():
+    classification = classify_error(ApiError(403, "CachedContent not found (or permission denied)"))
+    assert classification.category == ERROR_CACHE_EXPIRED
+    assert classification.retryable
+    assert not classify_error(ApiError(403, "Permission denied")).retryable
@@ -0,0 +1,55 @@
+import asyncio
+
+from PIL import Image, ImageDraw
+
+from dedup import Deduplicator, compute_image_hash, hamming_distance, is_degenerate
+
+class InlinePreprocessor:
+    """Runs hash functions in-process instead of in the preprocessing pool."""
+
+    async def run(self, func, *args):
+        return func(*args)
+
+def _solid(path, colour):
+    Image.new("RGB", (64, 48), colour).save(path)
+    return str(path)
+
+def _pattern(path, brightness=0):
+    img = Image.new("RGB", (64, 48), (40 + brightness, 60 + brightness, 80 + brightness))
+    draw = ImageDraw.Draw(img)
+    for x in range(0, 64, 8):
+        draw.rectangle([x, (x * 3) % 40, x + 3, 47], fill=(220, 200 - x, 30 + x))
+    img.save(path)
+    return str(path)
+
+def _assign_all(deduplicator, paths):
+    async def run():
+        return [await deduplicator.assign(path) for path in paths]
+    return asyncio.run(run())
+
+def test_solid_colours_stay_in_separate_groups(tmp_path):
+    red = _solid(tmp_path / "red.png", (255, 0, 0))
+    blue = _solid(tmp_path / "blue.png", (0, 0, 255))
+    assert is_degenerate(compute_image_hash(red)[0])
+
+    for method in ("dhash", "phash"):
+        deduplicator = Deduplicator(InlinePreprocessor(), method)
+        assert _assign_all(deduplicator, [red, blue]) == [None, None]
+        assert deduplicator.get_stats()["duplicates"] == 0
+
+def test_same_hash_with_different_colour_is_not_grouped(tmp_path):
+    dark = _pattern(tmp_path / "dark.png")
+    bright = _pattern(tmp_path / "bright.png", brightness=100)
+    deduplicator = Deduplicator(InlinePreprocessor(), "phash", max_distance=8)
+    dark_hash, bright_hash = (compute_image_hash(path, "phash")[0] for path in (dark, bright))
+    assert hamming_distance(dark_hash, bright_hash) <= deduplicator.max_distance
+    assert _assign_all(deduplicator, [dark, bright]) == [None, None]
+
+def test_near_duplicates_are_grouped(tmp_path):
+    original = _pattern(tmp_path / "original.png")
+    copy = str(tmp_path / "copy.jpg")
+    with Image.open(original) as img:
+        img.resize((128, 96)).save(copy, quality=85)
+    deduplicator = Deduplicator(InlinePreprocessor())
+    assert _assign_all(deduplicator, [original, copy]) == [None, original]
+    assert deduplicator.get_groups()["groups"][0]["members"][0]["path"] == copy
@@ -0,0 +1,70 @@
+import os
+
+import discovery
+from discovery import DiscoveryManifest, ImageWalker
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n" + b"\x00" * 8
+
+def _write_images(directory, count):
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = directory / f"image_{i}.dat"
+        path.write_bytes(PNG_HEADER)
+        paths.append(str(path))
+    return paths
+
+class CountingManifest(DiscoveryManifest):
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self.lookups = 0
+
+    def lookup(self, paths):
+        self.lookups += 1
+        return super().lookup(paths)
+
+def test_manifest_is_queried_once_per_batch_of_a_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(discovery, "LOOKUP_BATCH_SIZE", 4)
+    paths = _write_images(tmp_path / "images" / "a", 6) + _write_images(tmp_path / "images" / "b", 2)
+    manifest = CountingManifest(str(tmp_path / "manifest.sqlite"))
+
+    walker = ImageWalker(str(tmp_path / "images"), manifest=manifest)
+    assert sorted(walker) == sorted(paths)
+    # Two batches for the six files of a, one for b
+    assert manifest.lookups == 3
+    manifest.close()
+
+def test_only_changed_lists_new_and_modified_files(tmp_path):
+    paths = _write_images(tmp_path / "images", 3)
+    manifest = DiscoveryManifest(str(tmp_path / "manifest.sqlite"))
+    list(ImageWalker(str(tmp_path / "images"), manifest=manifest))
+    manifest.commit()
+
+    with open(paths[0], "ab") as f:
+        f.write(b"more")
+    new_paths = _write_images(tmp_path / "images" / "new", 1)
+    walker = ImageWalker(str(tmp_path / "images"), manifest=manifest, only_changed=True)
+    assert sorted(walker) == sorted([paths[0]] + new_paths)
+    assert walker.get_stats()["unchanged_skipped"] == 2
+    manifest.close()
+
+def test_staged_rows_are_looked_up_before_committed_ones(tmp_path):
+    manifest = DiscoveryManifest(str(tmp_path / "manifest.sqlite"))
+    manifest.record([("a", 1, 1, ".png"), ("b", 1, 1, ".png")])
+    manifest.commit()
+    manifest.record([("a", 2, 2, ".jpg")])
+    assert manifest.lookup(["a", "b", "missing"]) == {"a": (2, 2, ".jpg"), "b": (1, 1, ".png")}
+    manifest.close()
+
+def test_classify_file_matches_the_walk(tmp_path):
+    (path,) = _write_images(tmp_path / "images", 1)
+    text_path = tmp_path / "images" / "notes.jpg"
+    text_path.write_text("not an image")
+    manifest = DiscoveryManifest(str(tmp_path / "manifest.sqlite"))
+    walker = ImageWalker(str(tmp_path / "images"), manifest=manifest, only_changed=True)
+    assert walker.classify_file(path) == path
+    assert walker.classify_file(str(text_path)) is None
+    assert walker.classify_file(os.path.join(str(tmp_path), "gone.png")) is None
+    # Recorded by the first call, so unchanged now
+    assert walker.classify_file(path) is None
+    manifest.close()
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import sqlite3
+import time
+
+from distributed import ITEM_DONE, ITEM_FAILED, MAX_CLAIMS, WorkQueue
+
+def _image_paths(root, count):
+    return [os.path.join(root, f"image_{i}.jpg") for i in range(count)]
+
+def _claim_and_crash(db_path, input_root, paths, conn):
+    """Claim one batch under a short lease, report it, then die without releasing it."""
+    queue = WorkQueue(db_path, input_root, worker_id="crashed", lease_seconds=0.5, claim_batch_size=2, poll_interval=0.05)
+    queue.register()
+    claimed = []
+    for path in queue.claimed_paths(paths):
+        claimed.append(path)
+        if len(claimed) == 2:
+            break
+    while not queue._is_seeded():
+        time.sleep(0.05)
+    conn.send(claimed)
+    os._exit(1)
+
+def _statuses(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return dict(conn.execute("SELECT path, status FROM items").fetchall())
+
+def test_expired_leases_of_a_crashed_worker_are_reclaimed(tmp_path):
+    db_path = str(tmp_path / "work_queue.sqlite")
+    input_root = str(tmp_path / "images")
+    paths = _image_paths(input_root, 6)
+
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=_claim_and_crash, args=(db_path, input_root, paths, sender))
+    child.start()
+    assert receiver.poll(30)
+    crashed_batch = receiver.recv()
+    child.join(30)
+    assert child.exitcode == 1
+
+    survivor = WorkQueue(db_path, input_root, worker_id="survivor", lease_seconds=30, poll_interval=0.05)
+    survivor.register()
+    processed = []
+    for path in survivor.claimed_paths(paths):
+        processed.append(path)
+        survivor.complete(path, True)
+    survivor.finish({})
+    survivor.close()
+
+    assert sorted(processed) == sorted(paths)
+    assert set(crashed_batch) <= set(processed)
+    assert survivor.reclaimed == len(crashed_batch) == 2
+    assert set(_statuses(db_path).values()) == {ITEM_DONE}
+
+def test_path_is_failed_after_max_claims(tmp_path):
+    db_path = str(tmp_path / "work_queue.sqlite")
+    input_root = str(tmp_path / "images")
+    paths = _image_paths(input_root, 1)
+
+    # Without register() there is no heartbeat, so every lease runs out like a crashed worker's
+    queues = [
+        WorkQueue(db_path, input_root, worker_id=f"worker-{i}", lease_seconds=0.05, poll_interval=0.01)
+        for i in range(MAX_CLAIMS + 1)
+    ]
+    for queue in queues[:MAX_CLAIMS]:
+        assert next(queue.claimed_paths(paths)) == paths[0]
+        time.sleep(0.1)
+    assert queues[1].reclaimed == 1
+
+    assert list(queues[-1].claimed_paths(paths)) == []
+    assert _statuses(db_path) == {"image_0.jpg": ITEM_FAILED}
+    for queue in queues:
+        queue.close()
+
+def test_close_hands_leased_paths_back(tmp_path):
+    db_path = str(tmp_path / "work_queue.sqlite")
+    input_root = str(tmp_path / "images")
+    paths = _image_paths(input_root, 3)
+
+    first = WorkQueue(db_path, input_root, worker_id="first", claim_batch_size=3, poll_interval=0.01)
+    next(first.claimed_paths(paths))
+    first.close()
+
+    second = WorkQueue(db_path, input_root, worker_id="second", poll_interval=0.01)
+    assert sorted(second.claimed_paths(paths)) == sorted(paths)
+    assert second.reclaimed == 0
+    second.close()
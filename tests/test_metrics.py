@@ -0,0 +1,25 @@
+from metrics import Histogram
+
+def test_quantiles_are_interpolated_within_a_bucket():
+    histogram = Histogram()
+    for i in range(1000):
+        histogram.observe(0.001 + i * 0.000001)
+    summary = histogram.summary()
+    # Every value falls in the first (0 - 5ms) bucket; its upper bound is not reported
+    assert abs(summary["p50_seconds"] - summary["mean_seconds"]) <= 0.0001
+    assert summary["p50_seconds"] <= summary["p95_seconds"] <= summary["max_seconds"]
+    assert summary["p95_seconds"] == round(summary["p95_seconds"], 4)
+
+def test_quantiles_across_buckets():
+    histogram = Histogram(buckets=(1.0, 2.0, 4.0))
+    for value in (0.5, 1.5, 1.5, 3.0, 10.0):
+        histogram.observe(value)
+    assert histogram.quantile(0.2) == 1.0
+    assert histogram.quantile(0.4) == 1.5
+    assert histogram.quantile(0.6) == 2.0
+    assert 2.0 < histogram.quantile(0.7) < 4.0
+    assert 4.0 < histogram.quantile(0.9) <= 10.0
+    assert histogram.quantile(1.0) == 10.0
+
+def test_empty_histogram():
+    assert Histogram().quantile(0.5) == 0.0
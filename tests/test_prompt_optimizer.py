@@ -0,0 +1,29 @@
+from prompt_optimizer import UP_FRONT_VARIANTS, VARIANT_BASE, PromptOptimizer
+from retry_handler import ERROR_CONTENT_SAFETY
+
+def _train(optimizer, variant, successes, failures=0):
+    for _ in range(successes):
+        optimizer.record_outcome(variant)
+    for _ in range(failures):
+        optimizer.record_outcome(variant, ERROR_CONTENT_SAFETY)
+
+def test_task_changing_variants_are_never_chosen_up_front():
+    optimizer = PromptOptimizer(seed=0)
+    _train(optimizer, VARIANT_BASE, successes=0, failures=50)
+    for variant in ("more_specific", "style", "quality", "shortened"):
+        _train(optimizer, variant, successes=50)
+    chosen = {optimizer.select_variant() for _ in range(200)}
+    assert chosen == {VARIANT_BASE}
+
+def test_reliable_safe_rewrite_is_used_up_front():
+    optimizer = PromptOptimizer(seed=0)
+    _train(optimizer, VARIANT_BASE, successes=5, failures=45)
+    _train(optimizer, "safe_for_work", successes=50)
+    chosen = [optimizer.select_variant() for _ in range(200)]
+    assert set(chosen) <= UP_FRONT_VARIANTS
+    assert chosen.count("safe_for_work") > 190
+
+def test_untried_variant_is_not_chosen_up_front():
+    optimizer = PromptOptimizer(seed=0)
+    _train(optimizer, "safe_for_work", successes=2)
+    assert {optimizer.select_variant() for _ in range(50)} == {VARIANT_BASE}
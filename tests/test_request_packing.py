@@ -0,0 +1,49 @@
+import json
+
+from mock_model import MockGenerativeModel
+from request_packing import build_packed_prompt, image_label, parse_packed_response
+
+def _packed(*items):
+    return json.dumps(list(items))
+
+def test_parses_one_answer_per_image():
+    text = _packed({"index": 1, "result": "a cat"}, {"index": 2, "result": "a dog"})
+    assert parse_packed_response(text, 2) == {1: "a cat", 2: "a dog"}
+
+def test_strips_code_fence():
+    text = "```json\n" + _packed({"index": 1, "result": "a cat"}) + "\n```"
+    assert parse_packed_response(text, 1) == {1: "a cat"}
+
+def test_malformed_array_yields_nothing():
+    assert parse_packed_response('[{"index": 1, "result": "a cat"},', 2) == {}
+    assert parse_packed_response("Image 1 is a cat, image 2 is a dog", 2) == {}
+    assert parse_packed_response("", 2) == {}
+
+def test_non_array_yields_nothing():
+    assert parse_packed_response(json.dumps({"index": 1, "result": "a cat"}), 1) == {}
+
+def test_invalid_entries_are_left_out():
+    text = _packed(
+        "a cat",
+        {"index": 0, "result": "out of range"},
+        {"index": 3, "result": "out of range"},
+        {"index": "2", "result": "not an int"},
+        {"index": 2, "result": "   "},
+        {"index": 2},
+        {"index": 1, "result": "a cat"}
+    )
+    assert parse_packed_response(text, 2) == {1: "a cat"}
+
+def test_duplicated_index_is_dropped():
+    text = _packed({"index": 1, "result": "a cat"}, {"index": 1, "result": "a dog"}, {"index": 2, "result": "a bird"})
+    assert parse_packed_response(text, 2) == {2: "a bird"}
+
+def test_mock_model_answers_packed_request():
+    count = 3
+    contents = [build_packed_prompt("Describe the image.", count)]
+    for index in range(1, count + 1):
+        contents += [image_label(index), {"mime_type": "image/jpeg", "data": b"x" * index}]
+    response = MockGenerativeModel().generate_content(contents)
+    answers = parse_packed_response(response.text, count)
+    assert sorted(answers) == [1, 2, 3]
+    assert "3 bytes" in answers[3]
@@ -0,0 +1,23 @@
+from response_cache import ResponseCache
+
+def test_overwriting_an_entry_replaces_its_size(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=1000)
+    key = ResponseCache.make_key("image", "prompt", "model")
+    for _ in range(20):
+        cache.put(key, "x" * 100)
+    cache.put(key, "y" * 40)
+    assert cache.get(key) == "y" * 40
+    assert cache.get_stats()["size_bytes"] == 40
+    assert cache.get_stats()["evictions"] == 0
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=1000)
+    keys = [ResponseCache.make_key(f"image-{i}", "prompt", "model") for i in range(11)]
+    for key in keys[:10]:
+        cache.put(key, "x" * 100)
+    assert cache.get_stats()["evictions"] == 0
+    cache.put(keys[10], "x" * 100)
+    stats = cache.get_stats()
+    assert 0 < stats["evictions"] <= 2
+    assert stats["size_bytes"] <= 900
+    assert cache.get(keys[10]) is not None
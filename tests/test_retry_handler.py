@@ -0,0 +1,87 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+from retry_handler import (
+    BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN, CircuitBreaker, ERROR_RATE_LIMIT, ErrorClassification, RetryHandler
+)
+from transport import ApiError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class FakeClock:
+    """Records sleeps instead of waiting."""
+
+    def __init__(self):
+        self.sleeps = []
+
+    async def sleep(self, delay):
+        self.sleeps.append(delay)
+
+def test_retry_after_is_used_as_the_delay():
+    handler = RetryHandler(base_delay=1.0)
+    for _ in range(20):
+        delay = handler.next_delay(ErrorClassification(ERROR_RATE_LIMIT, True, retry_after=0.1), None)
+        assert 0.1 <= delay <= 0.12
+
+def test_backoff_without_retry_after():
+    handler = RetryHandler(base_delay=1.0, max_delay=30.0)
+    for _ in range(20):
+        delay = handler.next_delay(ErrorClassification(ERROR_RATE_LIMIT, True), 4.0)
+        assert 2.0 <= delay <= 12.0
+
+def test_exhausted_budget_defers_the_retry():
+    clock = FakeClock()
+    handler = RetryHandler(max_retries=3, max_delay=5.0, budget_ratio=0.1, budget_reserve=1.0, sleep=clock.sleep)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ApiError(503, "overloaded", retry_after=0.1)
+        return "ok"
+
+    assert asyncio.run(handler.execute_with_retry(flaky)) == "ok"
+    assert len(attempts) == 3
+    stats = handler.get_stats()
+    assert stats["retries"] == 2
+    # The reserve covered one retry; the second waited out the maximum backoff
+    assert stats["budget_deferred"] == 1
+    assert stats["budget_deferred_seconds"] == 5.0
+
+def test_cancelled_probe_hands_over_to_the_next_caller():
+    async def run():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        await breaker.record_failure()
+        assert breaker.state == BREAKER_OPEN
+
+        probe_started = asyncio.Event()
+
+        async def call(hang):
+            probe = await breaker.before_call()
+            try:
+                if hang:
+                    probe_started.set()
+                    await asyncio.sleep(3600)
+                await breaker.record_success()
+            finally:
+                await breaker.release_probe(probe)
+
+        hanging = asyncio.create_task(call(hang=True))
+        await probe_started.wait()
+        assert breaker.state == BREAKER_HALF_OPEN
+        waiting = asyncio.create_task(call(hang=False))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        hanging.cancel()
+        await asyncio.wait_for(waiting, 1.0)
+        assert breaker.state == BREAKER_CLOSED
+
+    asyncio.run(run())
+
+def test_importing_the_processor_does_not_load_aiohttp():
+    code = "import sys, processor; print('aiohttp' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=ROOT)
+    assert output.stdout.strip() == "False"
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from mock_model import MockBehavior, MockGenerativeModel
+from rate_limiter import SharedRateLimiter
+from routing import Route, RouteSpec, RoutingPool, load_route_specs
+from transport import ApiError, SdkTransport
+
+CONTENTS = ["Describe the image.", {"mime_type": "image/jpeg", "data": b"x"}]
+
+def _route(tmp_path, name, priority, behavior=None, max_concurrent=5):
+    spec = RouteSpec(name=name, model="mock-model", backend="mock", max_concurrent=max_concurrent, priority=priority)
+    model = MockGenerativeModel(spec.model, behavior)
+    # Limits of zero disable the shared buckets
+    rate_limiter = SharedRateLimiter(str(tmp_path / f"{name}.json"))
+    return Route(spec, SdkTransport(model), rate_limiter)
+
+def test_preferred_route_takes_all_requests(tmp_path):
+    fallback = _route(tmp_path, "fallback", priority=1)
+    primary = _route(tmp_path, "primary", priority=0)
+    pool = RoutingPool([fallback, primary])
+
+    async def run():
+        return [await pool.generate_content(CONTENTS) for _ in range(3)]
+
+    answered_by = [route_name for _, route_name in asyncio.run(run())]
+    assert answered_by == ["primary"] * 3
+    assert fallback.calls == 0
+
+def test_fallback_route_takes_overflow(tmp_path):
+    primary = _route(tmp_path, "primary", priority=0, behavior=MockBehavior(latency_mean=0.1), max_concurrent=1)
+    fallback = _route(tmp_path, "fallback", priority=1, behavior=MockBehavior(latency_mean=0.1))
+    pool = RoutingPool([primary, fallback])
+
+    async def run():
+        return await asyncio.gather(*(pool.generate_content(CONTENTS) for _ in range(2)))
+
+    answered_by = sorted(route_name for _, route_name in asyncio.run(run()))
+    assert answered_by == ["fallback", "primary"]
+
+def test_rate_limited_route_cools_down_and_fails_over(tmp_path):
+    primary = _route(tmp_path, "primary", priority=0, behavior=MockBehavior(rate_limit_rate=1.0, retry_after=30))
+    fallback = _route(tmp_path, "fallback", priority=1)
+    pool = RoutingPool([primary, fallback])
+
+    async def run():
+        return [await pool.generate_content(CONTENTS) for _ in range(2)]
+
+    answered_by = [route_name for _, route_name in asyncio.run(run())]
+    assert answered_by == ["fallback", "fallback"]
+    assert primary.calls == 1
+    assert primary.rate_limited == 1
+    assert primary.failovers == 1
+    assert primary.cooldown_until > time.monotonic() + 20
+
+def test_error_is_raised_when_every_route_is_rate_limited(tmp_path):
+    behavior = MockBehavior(rate_limit_rate=1.0, retry_after=30)
+    primary = _route(tmp_path, "primary", priority=0, behavior=behavior)
+    fallback = _route(tmp_path, "fallback", priority=1, behavior=behavior)
+    pool = RoutingPool([primary, fallback])
+
+    with pytest.raises(ApiError) as raised:
+        asyncio.run(pool.generate_content(CONTENTS))
+    assert raised.value.status == 429
+    assert (primary.calls, fallback.calls) == (1, 1)
+
+def _write_routes(tmp_path, *routes):
+    path = tmp_path / "routes.json"
+    path.write_text(json.dumps({"routes": list(routes)}))
+    return str(path)
+
+def test_routes_file_is_loaded(tmp_path):
+    path = _write_routes(tmp_path, {"model": "mock-model", "backend": "mock", "max_concurrent": 2, "rpm_limit": 0})
+    (spec,) = load_route_specs(path)
+    assert (spec.name, spec.max_concurrent, spec.rpm_limit) == ("mock-model#0", 2, 0)
+
+def test_unknown_route_field_is_named(tmp_path):
+    path = _write_routes(tmp_path, {"name": "primary", "model": "mock-model", "backend": "mock", "max_conncurrent": 2})
+    with pytest.raises(ValueError, match="primary.*max_conncurrent"):
+        load_route_specs(path)
+
+@pytest.mark.parametrize("field, value", [("max_concurrent", 0), ("rpm_limit", -1), ("tpm_limit", "many")])
+def test_invalid_route_limits_are_rejected(tmp_path, field, value):
+    path = _write_routes(tmp_path, {"name": "primary", "model": "mock-model", "backend": "mock", field: value})
+    with pytest.raises(ValueError, match=f"primary.*{field}"):
+        load_route_specs(path)
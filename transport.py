@@ -0,0 +1,261 @@
+import asyncio
+import base64
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_BASE_URL = "https://generativelanguage.googleapis.com"
+
+class ApiError(Exception):
+    """Non-success HTTP response from the generateContent endpoint."""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status} {message}")
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+class ContentBlockedError(ValueError):
+    """The prompt or the response was blocked by content safety filters."""
+
+class EmptyResponseError(ValueError):
+    """The model returned no text."""
+
+def is_cache_not_found(error: Exception) -> bool:
+    """Whether a request failed because the context cache it named expired or was deleted."""
+    status = getattr(error, "status", None) or getattr(error, "code", None)
+    return status in (403, 404) and "cachedcontent not found" in str(error).lower()
+
+@dataclass
+class UsageMetadata:
+    """Token counts reported by the API, mirroring the SDK field names."""
+    prompt_token_count: int = 0
+    candidates_token_count: int = 0
+    total_token_count: int = 0
+    cached_content_token_count: int = 0
+
+@dataclass
+class CachedContent:
+    """A context cache held by the API, referenced from requests by name."""
+    name: str
+    token_count: int
+    expires_at: float  # time.time() at which the API drops it
+
+@dataclass
+class TransportResponse:
+    """Text and usage of a REST generateContent call."""
+    text: str
+    usage_metadata: UsageMetadata
+
+class GenaiCacheClient:
+    """Context caching through ``google.generativeai.caching``."""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    def create(self, contents: List[Any], ttl_seconds: float) -> Tuple[CachedContent, Any]:
+        """Create a cache; returns it and a model bound to it."""
+        import datetime
+        import google.generativeai as genai
+
+        cache = genai.caching.CachedContent.create(
+            model=f"models/{self.model_name}",
+            contents=contents,
+            ttl=datetime.timedelta(seconds=ttl_seconds)
+        )
+        cached = CachedContent(cache.name, cache.usage_metadata.total_token_count, time.time() + ttl_seconds)
+        return cached, genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+    def delete(self, name: str):
+        import google.generativeai as genai
+        genai.caching.CachedContent.get(name).delete()
+
+class SdkTransport:
+    """
+    Calls a ``GenerativeModel``-like object through the default thread pool.
+
+    Each in-flight request holds one executor thread for the whole call.
+    With a ``cache_client``, requests naming a context cache go to a model
+    bound to that cache.
+    """
+
+    def __init__(self, model: Any, cache_client: Any = None):
+        self.model = model
+        self.cache_client = cache_client
+        # Cache name -> (model bound to it, expiry)
+        self._cached_models: Dict[str, Tuple[Any, float]] = {}
+
+    async def generate_content(self, contents: List[Any], cached_content: Optional[str] = None):
+        model = self.model
+        if cached_content is not None:
+            if cached_content not in self._cached_models:
+                raise ApiError(404, f"CachedContent not found: {cached_content}")
+            model = self._cached_models[cached_content][0]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: model.generate_content(contents))
+
+    async def create_cached_content(self, contents: List[Any], ttl_seconds: float) -> CachedContent:
+        if self.cache_client is None:
+            raise NotImplementedError("This model does not support context caching")
+        loop = asyncio.get_running_loop()
+        cached, model = await loop.run_in_executor(None, self.cache_client.create, contents, ttl_seconds)
+        # Models bound to caches that were replaced and have expired since are no use to anyone
+        now = time.time()
+        for name in [name for name, (_, expires_at) in self._cached_models.items() if expires_at <= now]:
+            del self._cached_models[name]
+        self._cached_models[cached.name] = (model, cached.expires_at)
+        return cached
+
+    async def delete_cached_content(self, name: str):
+        # Requests still in flight keep their reference to the bound model
+        self._cached_models.pop(name, None)
+        await asyncio.get_running_loop().run_in_executor(None, self.cache_client.delete, name)
+
+    async def close(self):
+        pass
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parse a protobuf duration such as ``"12s"`` or ``"1.5s"``."""
+    match = re.fullmatch(r"\s*([0-9.]+)s\s*", value or "")
+    return float(match.group(1)) if match else None
+
+class RestTransport:
+    """
+    Calls the Gemini REST endpoint directly over a pooled ``aiohttp`` session.
+
+    Requests are coroutines rather than blocking threads, so hundreds can be
+    in flight at once over a bounded set of keep-alive connections.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str,
+        base_url: str = DEFAULT_API_BASE_URL,
+        connection_limit: int = 100,
+        timeout: float = 120.0
+    ):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.base_url = base_url.rstrip("/")
+        self.connection_limit = connection_limit
+        self.timeout = timeout
+        self._session = None
+
+    def _get_session(self):
+        # The session must be created inside the running event loop
+        if self._session is None or self._session.closed:
+            # Imported here so that starting the CLI with the SDK transport does not load aiohttp
+            import aiohttp
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    @staticmethod
+    def _to_part(part: Any) -> Dict[str, Any]:
+        if isinstance(part, str):
+            return {"text": part}
+        if isinstance(part, dict) and "data" in part:
+            return {
+                "inline_data": {
+                    "mime_type": part["mime_type"],
+                    "data": base64.b64encode(part["data"]).decode("ascii")
+                }
+            }
+        raise TypeError(f"Unsupported content part for REST transport: {type(part).__name__}")
+
+    def build_request(self, contents: List[Any], cached_content: Optional[str] = None) -> Dict[str, Any]:
+        """Build the JSON body of a generateContent request."""
+        body = {"contents": [{"role": "user", "parts": [self._to_part(part) for part in contents]}]}
+        if cached_content is not None:
+            body["cachedContent"] = cached_content
+        return body
+
+    async def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        session = self._get_session()
+        async with session.request(
+            method,
+            f"{self.base_url}/v1beta/{path}",
+            json=body,
+            headers={"x-goog-api-key": self.api_key}
+        ) as response:
+            try:
+                payload = await response.json(content_type=None)
+            except ValueError:
+                payload = {}
+            if response.status != 200:
+                raise self._build_error(response.status, response.headers, payload)
+        return payload or {}
+
+    async def generate_content(self, contents: List[Any], cached_content: Optional[str] = None) -> TransportResponse:
+        payload = await self._request(
+            "POST", f"models/{self.model_name}:generateContent", self.build_request(contents, cached_content)
+        )
+        return self._parse_response(payload)
+
+    async def create_cached_content(self, contents: List[Any], ttl_seconds: float) -> CachedContent:
+        """Upload a shared prefix once as a ``cachedContents`` resource."""
+        body = self.build_request(contents)
+        body["model"] = f"models/{self.model_name}"
+        body["ttl"] = f"{ttl_seconds:g}s"
+        payload = await self._request("POST", "cachedContents", body)
+        token_count = payload.get("usageMetadata", {}).get("totalTokenCount", 0)
+        return CachedContent(payload["name"], token_count, time.time() + ttl_seconds)
+
+    async def delete_cached_content(self, name: str):
+        await self._request("DELETE", name)
+
+    @staticmethod
+    def _build_error(status: int, headers: Any, payload: Dict[str, Any]) -> ApiError:
+        error = payload.get("error", {}) if isinstance(payload, dict) else {}
+        message = error.get("message") or error.get("status") or "Request failed"
+
+        retry_after = None
+        header_value = headers.get("Retry-After") if headers else None
+        if header_value:
+            try:
+                retry_after = float(header_value)
+            except ValueError:
+                pass
+        for detail in error.get("details", []):
+            if detail.get("@type", "").endswith("RetryInfo"):
+                retry_after = _parse_duration(detail.get("retryDelay", "")) or retry_after
+        return ApiError(status, message, retry_after)
+
+    @staticmethod
+    def _parse_response(payload: Dict[str, Any]) -> TransportResponse:
+        usage = payload.get("usageMetadata", {})
+        usage_metadata = UsageMetadata(
+            prompt_token_count=usage.get("promptTokenCount", 0),
+            candidates_token_count=usage.get("candidatesTokenCount", 0),
+            total_token_count=usage.get("totalTokenCount", 0),
+            cached_content_token_count=usage.get("cachedContentTokenCount", 0)
+        )
+
+        candidates = payload.get("candidates") or []
+        if not candidates:
+            reason = payload.get("promptFeedback", {}).get("blockReason", "no candidates")
+            raise ContentBlockedError(f"Response blocked: {reason}")
+
+        candidate = candidates[0]
+        parts = candidate.get("content", {}).get("parts", [])
+        text = "".join(part.get("text", "") for part in parts)
+        if not text and candidate.get("finishReason") == "SAFETY":
+            raise ContentBlockedError("Response blocked by content safety filters")
+        return TransportResponse(text=text, usage_metadata=usage_metadata)
+
+    async def close(self):
+        """Close the pooled session and its connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,260 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+from typing import Any, Callable, Dict, List
+
+from discovery import ImageWalker
+
+logger = logging.getLogger(__name__)
+
+WATCH_AUTO = "auto"
+WATCH_INOTIFY = "inotify"
+WATCH_POLL = "poll"
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# A file is complete once its writer closes it or it is renamed into place
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+EVENT_BUFFER_SIZE = 64 * 1024
+
+class InotifyWatcher:
+    """
+    Reports files written or moved into the tree, using Linux inotify via ctypes.
+
+    Every directory gets its own watch; directories created later are
+    watched as they appear and scanned once, so files written before their
+    watch was added are not missed. If the kernel's event queue overflows,
+    the tree is walked again for anything new or changed.
+    """
+
+    name = WATCH_INOTIFY
+
+    def __init__(self, walker_factory: Callable[[], ImageWalker]):
+        self.walker_factory = walker_factory
+        # Also answers for single files, with the same globs, sniffing and manifest as a walk
+        self.walker = walker_factory()
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch_call = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._watches: Dict[int, str] = {}
+        try:
+            self._add_tree(self.walker.root)
+        except OSError:
+            os.close(self._fd)
+            raise
+        logger.info(f"Watching {len(self._watches)} directories with inotify")
+
+    def _add_watch(self, directory: str):
+        wd = self._add_watch_call(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # ENOSPC here means fs.inotify.max_user_watches is exhausted
+            raise OSError(error, os.strerror(error), directory)
+        self._watches[wd] = directory
+
+    def _add_tree(self, directory: str) -> List[str]:
+        """Watch a directory and everything below it; returns the files already in it."""
+        files = []
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = [name for name in dirs if not self.walker.excludes_directory(os.path.join(root, name))]
+            self._add_watch(root)
+            files.extend(os.path.join(root, name) for name in names)
+        return files
+
+    def _read_events(self) -> List[tuple]:
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, EVENT_BUFFER_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, name))
+
+    async def _wait_readable(self):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self._fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(self._fd)
+
+    def _collect(self, events: List[tuple]) -> List[str]:
+        candidates = []
+        for wd, mask, name in events:
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not self.walker.excludes_directory(path):
+                    try:
+                        candidates.extend(self._add_tree(path))
+                    except OSError as e:
+                        logger.warning(f"Could not watch {path}: {str(e)}")
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                candidates.append(path)
+        # Unchanged files, e.g. closed again without writing, are dropped by the manifest
+        return [path for path in dict.fromkeys(candidates) if self.walker.classify_file(path)]
+
+    async def changes(self) -> List[str]:
+        """Wait for the next events and return the new or changed images they report."""
+        await self._wait_readable()
+        events = self._read_events()
+        loop = asyncio.get_running_loop()
+        if any(mask & IN_Q_OVERFLOW for _, mask, _ in events):
+            logger.warning("inotify event queue overflowed, rescanning the tree")
+            return await loop.run_in_executor(None, lambda: list(self.walker_factory()))
+        return await loop.run_in_executor(None, self._collect, events)
+
+    def close(self):
+        os.close(self._fd)
+
+class PollingWatcher:
+    """Reports new or changed images by walking the tree against the discovery manifest."""
+
+    name = WATCH_POLL
+
+    def __init__(self, walker_factory: Callable[[], ImageWalker], interval: float = 5.0):
+        self.walker_factory = walker_factory
+        self.interval = interval
+
+    async def changes(self) -> List[str]:
+        await asyncio.sleep(self.interval)
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: list(self.walker_factory()))
+
+    def close(self):
+        pass
+
+def create_watcher(backend: str, walker_factory: Callable[[], ImageWalker], poll_interval: float = 5.0):
+    """
+    Build the change source for watch mode.
+
+    ``walker_factory`` must return walkers over the input tree with
+    ``only_changed`` set and a shared manifest. With ``auto``, polling is
+    used wherever inotify is unavailable (other platforms, some network
+    filesystems, or too few inotify watches).
+    """
+    if backend in (WATCH_AUTO, WATCH_INOTIFY):
+        try:
+            return InotifyWatcher(walker_factory)
+        except (OSError, AttributeError) as e:
+            if backend == WATCH_INOTIFY:
+                raise
+            logger.info(f"inotify is not available ({str(e)}), polling every {poll_interval}s instead")
+    return PollingWatcher(walker_factory, poll_interval)
+
+class FolderWatcher:
+    """
+    Collects new images from a change source and hands them out in micro-batches.
+
+    The source is read in the background, so files that arrive while a batch
+    is being processed are queued for the next one. A batch is released
+    ``batch_window`` seconds after its first image arrived, or as soon as it
+    holds ``batch_size`` images. Once stopped, images already queued are
+    still handed out, without waiting for the window, so none are dropped.
+    """
+
+    def __init__(self, source, batch_size: int = 100, batch_window: float = 2.0):
+        self.source = source
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self._pending: Dict[str, None] = {}  # insertion-ordered set
+        self._arrived = asyncio.Event()
+        self._stopped = False
+        self._task = None
+
+        self.images_detected = 0
+        self.batches = 0
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                paths = await self.source.changes()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Watching for new images failed: {str(e)}")
+                await asyncio.sleep(1.0)
+                continue
+            if self._stopped:
+                return
+            for path in paths:
+                if path not in self._pending:
+                    self._pending[path] = None
+                    self.images_detected += 1
+            if self._pending:
+                self._arrived.set()
+
+    def stop(self):
+        """Stop taking new images; ``next_batch`` drains the queue, then returns an empty batch. Safe to call from a signal handler."""
+        self._stopped = True
+        self._arrived.set()
+
+    async def next_batch(self) -> List[str]:
+        """Wait for the next micro-batch; an empty list means the watcher was stopped and is drained."""
+        while not self._pending and not self._stopped:
+            self._arrived.clear()
+            await self._arrived.wait()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(self._pending) < self.batch_size and not self._stopped:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        if not self._pending:
+            return []
+
+        batch = list(self._pending)[:self.batch_size]
+        for path in batch:
+            del self._pending[path]
+        self.batches += 1
+        return batch
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.source.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.source.name,
+            "images_detected": self.images_detected,
+            "batches": self.batches,
+            "pending": len(self._pending)
+        }